@@ -0,0 +1,91 @@
+"""Compares two result files of benchmarks/load.py.
+
+    $ python benchmarks/compare.py baseline.json candidate.json --threshold 10
+
+Prints the change of every metric per route and exits with status 1 when
+any route got slower, lost throughput or raised its error rate by more
+than the threshold, in percent.
+"""
+import argparse
+import json
+import sys
+
+# metric -> True when higher is better.
+METRICS = [
+    ('throughput', True),
+    ('p50_ms', False),
+    ('p95_ms', False),
+    ('p99_ms', False),
+    ('queries_per_request', False),
+    ('statements_per_request', False),
+]
+
+
+def _change(before, after):
+    if not before:
+        return None
+    return 100.0 * (after - before) / before
+
+
+def compare(baseline, candidate, threshold):
+    """Returns (rows, regressions), rows being (route, metric, before,
+    after, change in percent)."""
+    rows = []
+    regressions = []
+    for route in sorted(set(baseline) & set(candidate),
+                        key=lambda r: (r == 'total', r)):
+        before, after = baseline[route], candidate[route]
+        for metric, higher_is_better in METRICS:
+            if before.get(metric) is None or after.get(metric) is None:
+                continue
+            change = _change(before[metric], after[metric])
+            rows.append((route, metric, before[metric], after[metric],
+                         change))
+            if change is None:
+                continue
+            if (-change if higher_is_better else change) > threshold:
+                regressions.append((route, metric, change))
+        error_rates = [float(r['errors']) / r['requests'] if r['requests']
+                       else 0.0 for r in (before, after)]
+        if error_rates[1] > error_rates[0]:
+            regressions.append((route, 'errors', None))
+    return rows, regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare two load benchmark results')
+    parser.add_argument('baseline')
+    parser.add_argument('candidate')
+    parser.add_argument('--threshold', type=float, default=10,
+                        help='Allowed change in percent')
+    args = parser.parse_args()
+
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+    if baseline['mix'] != candidate['mix']:
+        sys.stderr.write('Warning: the runs used different mixes\n')
+    if baseline['dataset'] != candidate['dataset']:
+        sys.stderr.write('Warning: the runs used different datasets\n')
+
+    rows, regressions = compare(baseline['results'], candidate['results'],
+                                args.threshold)
+    print('%-36s %-24s %10s %10s %8s' % ('route', 'metric', 'baseline',
+                                         'candidate', 'change'))
+    for route, metric, before, after, change in rows:
+        print('%-36s %-24s %10.2f %10.2f %8s' % (
+            route, metric, before, after,
+            '' if change is None else '%+.1f%%' % change))
+
+    if regressions:
+        print('')
+        for route, metric, change in regressions:
+            print('REGRESSION %s %s%s' % (
+                route, metric, '' if change is None else ' %+.1f%%' % change))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
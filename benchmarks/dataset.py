@@ -0,0 +1,111 @@
+"""Generates a synthetic dataset in the CSV format of "userapi-db export".
+
+    $ python benchmarks/dataset.py --users 2000000 --groups 50000 /tmp/ds
+    $ userapi-db import /tmp/ds
+
+Group sizes follow a power law: the k-th largest group has about
+max_group_size / k ** exponent members, so a few groups are huge and most
+are small. Users are named user000000000 up, and groups group0000000 up,
+largest first. The parameters are written to dataset.json, which
+benchmarks/load.py reads to pick existing users and groups.
+
+With --load the files are imported right away, using the POSTGRES_*
+settings like userapi-db.
+"""
+import argparse
+import csv
+import json
+import os
+import random
+import sys
+
+from userapi.db import dump
+
+MANIFEST_FILE = 'dataset.json'
+USERID_FORMAT = 'user%09d'
+GROUP_NAME_FORMAT = 'group%07d'
+
+
+def group_sizes(users, groups, max_group_size, exponent):
+    return [max(1, min(users, int(max_group_size / (rank ** exponent))))
+            for rank in range(1, groups + 1)]
+
+
+def generate(directory, users, groups, max_group_size, exponent, seed,
+             out=sys.stderr):
+    rng = random.Random(seed)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    def writer(filename, header):
+        f = open(os.path.join(directory, filename), 'w')
+        w = csv.writer(f)
+        w.writerow(header)
+        return f, w
+
+    f, w = writer(dump.USERS_FILE, ['userid', 'first_name', 'last_name'])
+    with f:
+        for i in xrange(users):
+            w.writerow([USERID_FORMAT % i, 'first%d' % (i % 1000),
+                        'last%d' % (i % 10000)])
+
+    f, w = writer(dump.GROUPS_FILE, ['name'])
+    with f:
+        for rank in range(groups):
+            w.writerow([GROUP_NAME_FORMAT % rank])
+
+    sizes = group_sizes(users, groups, max_group_size, exponent)
+    f, w = writer(dump.MEMBERSHIPS_FILE, ['userid', 'name'])
+    with f:
+        for rank, size in enumerate(sizes):
+            name = GROUP_NAME_FORMAT % rank
+            for member in sorted(rng.sample(xrange(users), size)):
+                w.writerow([USERID_FORMAT % member, name])
+            if rank % 1000 == 0:
+                out.write('%s: %d of %d groups\n' %
+                          (dump.MEMBERSHIPS_FILE, rank + 1, groups))
+                out.flush()
+
+    manifest = {'users': users,
+                'groups': groups,
+                'max_group_size': max_group_size,
+                'exponent': exponent,
+                'seed': seed,
+                'memberships': sum(sizes),
+                'userid_format': USERID_FORMAT,
+                'group_name_format': GROUP_NAME_FORMAT}
+    with open(os.path.join(directory, MANIFEST_FILE), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Generate a synthetic userapi dataset')
+    parser.add_argument('directory')
+    parser.add_argument('--users', type=int, default=100000)
+    parser.add_argument('--groups', type=int, default=5000)
+    parser.add_argument('--max-group-size', type=int,
+                        help='Members of the largest group, by default a '
+                             'tenth of the users')
+    parser.add_argument('--exponent', type=float, default=1.0,
+                        help='Power law exponent of the group sizes')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--load', action='store_true',
+                        help='Import the files into the database')
+    args = parser.parse_args()
+
+    manifest = generate(args.directory, args.users, args.groups,
+                        args.max_group_size or max(1, args.users // 10),
+                        args.exponent, args.seed)
+    sys.stderr.write('Generated %(users)d users, %(groups)d groups and '
+                     '%(memberships)d memberships.\n' % manifest)
+
+    if args.load:
+        from userapi.db import cli
+        with cli.connect_database() as database:
+            dump.import_tables(database, args.directory)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,74 @@
+"""Times encoding a GET /groups/<name> body with each installed JSON backend.
+
+    $ python benchmarks/json_encoding.py --members 10000 100000 1000000
+
+Bodies are built the way the API streams them, through
+userapi.api._encode_json_array. "per-item json" is the previous encoding,
+one json.dumps() call per member id.
+"""
+import argparse
+import itertools
+import json
+import time
+
+from userapi import api
+from userapi import serialization
+
+
+def _per_item_json(items, chunk_size=api.STREAM_CHUNK_SIZE):
+    items = iter(items)
+    separator = '['
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        yield separator + ','.join(json.dumps(item) for item in chunk)
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+def _best_time(func, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.time()
+        func()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--members', type=int, nargs='+',
+                        default=[10000, 100000, 1000000])
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    backends = []
+    for name in serialization.BACKENDS:
+        try:
+            serialization.configure(name)
+        except ImportError:
+            print('%s: not installed' % name)
+            continue
+        backends.append(name)
+
+    print('%10s  %-14s %10s %10s' % ('members', 'encoder', 'ms', 'MB/s'))
+    for members in args.members:
+        member_ids = ['user%07d' % i for i in range(members)]
+        size = len(''.join(_per_item_json(member_ids)))
+        for name in [None] + backends:
+            if name is None:
+                name, encode = 'per-item json', _per_item_json
+            else:
+                serialization.configure(name)
+                encode = api._encode_json_array
+            elapsed = _best_time(lambda: ''.join(encode(member_ids)),
+                                 args.repeat)
+            print('%10d  %-14s %10.1f %10.1f' % (
+                members, name, elapsed * 1000, size / elapsed / 1048576))
+    serialization.configure()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,478 @@
+"""Drives a mixed read/write workload against a running API and reports
+throughput and latency per route.
+
+    $ python benchmarks/load.py --url http://127.0.0.1:8000 \\
+          --dataset /tmp/ds --mix read-heavy --duration 60 \\
+          --processes 4 --threads 8 --output results.json
+
+Reads pick users and groups of the dataset generated by
+benchmarks/dataset.py. Writes only touch users and groups the run creates
+itself, which are deleted again afterwards, so the dataset can be reused.
+
+When the API runs with SERVER_TIMING=1, queries per request are reported
+per route from its Server-Timing header. These leave out statements run
+while a streamed body is sent. With --database, statements per request
+overall are derived from pg_stat_statements when the extension is
+installed.
+
+Results, including every option, are written as JSON for
+benchmarks/compare.py.
+"""
+import argparse
+import collections
+import json
+import multiprocessing
+import os
+import random
+import re
+import sys
+import threading
+import time
+
+import requests
+
+MIXES = {
+    'read-heavy': {
+        'GET /users/<userid>': 50,
+        'GET /groups/<name>': 15,
+        'GET /groups/<name>/members': 7,
+        'GET /groups/<name>/members/<userid>': 10,
+        'GET /users/<userid>/groups': 5,
+        'GET /users': 5,
+        'GET /groups': 3,
+        'POST /users/lookup': 2,
+        'POST /groups/lookup': 1,
+        'POST /users': 5,
+        'PUT /users/<userid>': 5,
+        'DELETE /users/<userid>': 3,
+        'POST /users/bulk': 1,
+        'POST /groups': 2,
+        'PUT /groups/<name>': 2,
+        'PATCH /groups/<name>': 2,
+        'PATCH /users/<userid>/groups': 2,
+        'DELETE /groups/<name>': 1,
+        'GET /stats/pool': 1,
+    },
+    'write-heavy': {
+        'GET /users/<userid>': 20,
+        'GET /groups/<name>': 5,
+        'GET /groups/<name>/members': 5,
+        'GET /groups/<name>/members/<userid>': 3,
+        'GET /users/<userid>/groups': 2,
+        'GET /users': 2,
+        'GET /groups': 2,
+        'POST /users': 20,
+        'PUT /users/<userid>': 20,
+        'DELETE /users/<userid>': 10,
+        'POST /users/bulk': 2,
+        'POST /groups': 5,
+        'PUT /groups/<name>': 5,
+        'PATCH /groups/<name>': 5,
+        'PATCH /users/<userid>/groups': 5,
+        'DELETE /groups/<name>': 4,
+    },
+    'reads': {
+        'GET /users/<userid>': 70,
+        'GET /groups/<name>': 20,
+        'GET /groups/<name>/members': 5,
+        'GET /groups/<name>/members/<userid>': 10,
+        'GET /users/<userid>/groups': 5,
+        'GET /users': 3,
+        'GET /groups': 2,
+        'POST /users/lookup': 2,
+        'POST /groups/lookup': 1,
+    },
+}
+
+BULK_SIZE = 100
+MEMBERS_PER_GROUP = 10
+PATCH_SIZE = 3
+LOOKUP_SIZE = 100
+GROUP_LOOKUP_SIZE = 10
+PAGE_SIZE = 100
+
+_SERVER_TIMING_QUERIES = re.compile(r'db;[^,]*desc="(\d+) queries"')
+
+
+class Worker(object):
+    """One thread's share of the load, keeping the users and groups it
+    created so its writes never touch the dataset's own."""
+
+    def __init__(self, url, dataset, prefix, seed):
+        self.url = url.rstrip('/')
+        self.dataset = dataset
+        self.prefix = prefix
+        self.rng = random.Random(seed)
+        self.session = requests.Session()
+        self.users = []
+        self.groups = []
+        self.counter = 0
+
+    def _new_name(self, kind):
+        self.counter += 1
+        return '%s-%s%d' % (self.prefix, kind, self.counter)
+
+    def _userid(self):
+        return self.dataset['userid_format'] % self.rng.randrange(
+            self.dataset['users'])
+
+    def _group_name(self):
+        return self.dataset['group_name_format'] % self.rng.randrange(
+            self.dataset['groups'])
+
+    def _user_body(self, userid):
+        return {'userid': userid,
+                'first_name': 'bench',
+                'last_name': str(self.rng.randrange(1000)),
+                'groups': list(set(self._group_name()
+                                   for _ in range(self.rng.randint(0, 3))))}
+
+    def request(self, method, path, body=None, stream=False):
+        response = self.session.request(method, self.url + path, json=body,
+                                        stream=stream)
+        # Reading the whole body is part of the request's latency.
+        for _ in response.iter_content(64 * 1024):
+            pass
+        return response
+
+    def run(self, route):
+        return getattr(self, 'do_' + _method_name(route))()
+
+    def do_get_users_userid(self):
+        return self.request('GET', '/users/%s' % self._userid())
+
+    def do_get_users_userid_groups(self):
+        return self.request('GET', '/users/%s/groups?limit=%d' %
+                            (self._userid(), PAGE_SIZE))
+
+    def do_get_users(self):
+        return self.request('GET', '/users?limit=%d' % PAGE_SIZE)
+
+    def do_post_users(self):
+        userid = self._new_name('user')
+        response = self.request('POST', '/users', self._user_body(userid))
+        if response.status_code == 201:
+            self.users.append(userid)
+        return response
+
+    def do_post_users_bulk(self):
+        userids = [self._new_name('user') for _ in range(BULK_SIZE)]
+        response = self.request('POST', '/users/bulk',
+                                [self._user_body(u) for u in userids])
+        if response.status_code == 200:
+            self.users.extend(userids)
+        return response
+
+    def do_post_users_lookup(self):
+        return self.request('POST', '/users/lookup', {
+            'ids': [self._userid() for _ in range(LOOKUP_SIZE)]})
+
+    def do_put_users_userid(self):
+        if not self.users:
+            return self.do_post_users()
+        userid = self.rng.choice(self.users)
+        return self.request('PUT', '/users/%s' % userid,
+                            self._user_body(userid))
+
+    def do_patch_users_userid_groups(self):
+        if not self.users:
+            return self.do_post_users()
+        names = list(set(self._group_name() for _ in range(PATCH_SIZE * 2)))
+        return self.request('PATCH', '/users/%s/groups' %
+                            self.rng.choice(self.users),
+                            {'add': names[:PATCH_SIZE],
+                             'remove': names[PATCH_SIZE:]})
+
+    def do_delete_users_userid(self):
+        if not self.users:
+            return self.do_post_users()
+        return self.request('DELETE', '/users/%s' % self.users.pop())
+
+    def do_get_groups(self):
+        return self.request('GET', '/groups?limit=%d' % PAGE_SIZE)
+
+    def do_get_groups_name(self):
+        return self.request('GET', '/groups/%s' % self._group_name(),
+                            stream=True)
+
+    def do_get_groups_name_members(self):
+        return self.request('GET', '/groups/%s/members?limit=%d' %
+                            (self._group_name(), PAGE_SIZE))
+
+    def do_get_groups_name_members_userid(self):
+        return self.request('GET', '/groups/%s/members/%s' %
+                            (self._group_name(), self._userid()))
+
+    def do_post_groups_lookup(self):
+        names = [self._group_name() for _ in range(GROUP_LOOKUP_SIZE)]
+        return self.request('POST', '/groups/lookup', {'names': names})
+
+    def do_post_groups(self):
+        name = self._new_name('group')
+        response = self.request('POST', '/groups', {'name': name})
+        if response.status_code == 201:
+            self.groups.append(name)
+        return response
+
+    def do_put_groups_name(self):
+        if not self.groups:
+            return self.do_post_groups()
+        members = list(set(self._userid()
+                           for _ in range(MEMBERS_PER_GROUP)))
+        return self.request('PUT', '/groups/%s' % self.rng.choice(self.groups),
+                            members)
+
+    def do_patch_groups_name(self):
+        if not self.groups:
+            return self.do_post_groups()
+        userids = list(set(self._userid() for _ in range(PATCH_SIZE * 2)))
+        return self.request('PATCH', '/groups/%s' %
+                            self.rng.choice(self.groups),
+                            {'add': userids[:PATCH_SIZE],
+                             'remove': userids[PATCH_SIZE:]})
+
+    def do_delete_groups_name(self):
+        if not self.groups:
+            return self.do_post_groups()
+        return self.request('DELETE', '/groups/%s' % self.groups.pop())
+
+    def do_get_stats_pool(self):
+        return self.request('GET', '/stats/pool')
+
+    def do_get_stats_cache(self):
+        return self.request('GET', '/stats/cache')
+
+    def cleanup(self):
+        for userid in self.users:
+            self.request('DELETE', '/users/%s' % userid)
+        for name in self.groups:
+            self.request('DELETE', '/groups/%s' % name)
+
+
+def _method_name(route):
+    # "GET /users/<userid>" -> "get_users_userid"
+    words = route.replace('<', '').replace('>', '').replace('/', ' ').split()
+    return '_'.join(words).lower()
+
+
+def _thread_main(worker, routes, weights, warmup_until, stop_at, samples):
+    while True:
+        route = _weighted_choice(worker.rng, routes, weights)
+        start = time.time()
+        if start >= stop_at:
+            break
+        try:
+            response = worker.run(route)
+            status, queries = response.status_code, _queries(response)
+        except requests.RequestException:
+            status, queries = None, None
+        end = time.time()
+        if start >= warmup_until:
+            samples.append((route, end - start, status, queries))
+
+
+def _queries(response):
+    match = _SERVER_TIMING_QUERIES.search(
+        response.headers.get('Server-Timing', ''))
+    return int(match.group(1)) if match else None
+
+
+def _weighted_choice(rng, routes, weights):
+    point = rng.random() * sum(weights)
+    for route, weight in zip(routes, weights):
+        point -= weight
+        if point < 0:
+            return route
+    return routes[-1]
+
+
+def _process_main(args, dataset, mix, index, start_at, queue):
+    routes = sorted(mix)
+    weights = [mix[route] for route in routes]
+    warmup_until = start_at + args.warmup
+    stop_at = warmup_until + args.duration
+    workers = []
+    threads = []
+    samples = []
+    for thread_index in range(args.threads):
+        worker = Worker(args.url, dataset,
+                        'bench%d-%d-%d' % (os.getpid(), index, thread_index),
+                        seed=(args.seed, index, thread_index))
+        thread = threading.Thread(target=_thread_main, args=(
+            worker, routes, weights, warmup_until, stop_at, samples))
+        thread.daemon = True
+        workers.append(worker)
+        threads.append(thread)
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for worker in workers:
+        worker.cleanup()
+    queue.put(samples)
+
+
+def _percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1,
+                int(round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+
+def summarize(latencies, statuses, queries, duration):
+    latencies = sorted(latencies)
+    errors = sum(count for status, count in statuses.items()
+                 if status is None or status >= 500)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'statuses': dict((str(status), count)
+                         for status, count in statuses.items()),
+        'throughput': len(latencies) / duration,
+        'mean_ms': (1000 * sum(latencies) / len(latencies)
+                    if latencies else None),
+        'p50_ms': _ms(_percentile(latencies, 0.50)),
+        'p95_ms': _ms(_percentile(latencies, 0.95)),
+        'p99_ms': _ms(_percentile(latencies, 0.99)),
+        'max_ms': _ms(latencies[-1] if latencies else None),
+        'queries_per_request': (float(sum(queries)) / len(queries)
+                                if queries else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else seconds * 1000
+
+
+class StatementCounter(object):
+    """Counts statements run against the database through
+    pg_stat_statements, or does nothing when it is unavailable."""
+
+    def __init__(self, dsn):
+        self.conn = None
+        if not dsn:
+            return
+        import psycopg2
+        self.conn = psycopg2.connect(dsn)
+        self.conn.autocommit = True
+        try:
+            self.count()
+        except psycopg2.Error as e:
+            sys.stderr.write('pg_stat_statements unavailable: %s\n' % e)
+            self.conn = None
+
+    def count(self):
+        if self.conn is None:
+            return None
+        cursor = self.conn.cursor()
+        cursor.execute('SELECT coalesce(sum(calls), 0) '
+                       'FROM pg_stat_statements s '
+                       'JOIN pg_database d ON d.oid = s.dbid '
+                       'WHERE d.datname = current_database()')
+        # Less this query itself.
+        return int(cursor.fetchone()[0]) - 1
+
+
+def run(args, dataset, mix):
+    counter = StatementCounter(args.database)
+    queue = multiprocessing.Queue()
+    start_at = time.time() + 1
+    processes = [multiprocessing.Process(
+        target=_process_main,
+        args=(args, dataset, mix, index, start_at, queue))
+        for index in range(args.processes)]
+    for process in processes:
+        process.start()
+
+    time.sleep(max(0, start_at + args.warmup - time.time()))
+    statements_before = counter.count()
+    time.sleep(max(0, start_at + args.warmup + args.duration - time.time()))
+    statements_after = counter.count()
+
+    samples = []
+    for _ in processes:
+        samples.extend(queue.get())
+    for process in processes:
+        process.join()
+
+    by_route = collections.defaultdict(
+        lambda: ([], collections.Counter(), []))
+    for route, latency, status, queries in samples:
+        for key in (route, 'total'):
+            by_route[key][0].append(latency)
+            by_route[key][1][status] += 1
+            if queries is not None:
+                by_route[key][2].append(queries)
+
+    results = dict((route, summarize(latencies, statuses, queries,
+                                     args.duration))
+                   for route, (latencies, statuses, queries)
+                   in by_route.items())
+    if statements_before is not None and results.get('total'):
+        results['total']['statements_per_request'] = (
+            float(statements_after - statements_before) /
+            results['total']['requests'])
+    return results
+
+
+def _print_results(results, out=sys.stdout):
+    out.write('%-36s %9s %7s %9s %8s %8s %8s %8s\n' % (
+        'route', 'requests', 'errors', 'req/s', 'p50 ms', 'p95 ms',
+        'p99 ms', 'queries'))
+    for route in sorted(results, key=lambda r: (r == 'total', r)):
+        r = results[route]
+        queries = r['queries_per_request']
+        out.write('%-36s %9d %7d %9.1f %8.1f %8.1f %8.1f %8s\n' % (
+            route, r['requests'], r['errors'], r['throughput'],
+            r['p50_ms'], r['p95_ms'], r['p99_ms'],
+            '-' if queries is None else '%.1f' % queries))
+    statements = results.get('total', {}).get('statements_per_request')
+    if statements is not None:
+        out.write('statements per request: %.2f\n' % statements)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Run a load benchmark against the userapi')
+    parser.add_argument('--url', default='http://127.0.0.1:8000')
+    parser.add_argument('--dataset', required=True,
+                        help='Directory written by benchmarks/dataset.py')
+    parser.add_argument('--mix', default='read-heavy',
+                        help='One of %s, or a JSON object of route weights'
+                             % ', '.join(sorted(MIXES)))
+    parser.add_argument('--duration', type=float, default=30)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--processes', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=4)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--database',
+                        help='libpq connection string used to count '
+                             'statements with pg_stat_statements')
+    parser.add_argument('--label', help='Free form description of the run')
+    parser.add_argument('--output', help='Write results to this JSON file')
+    args = parser.parse_args()
+
+    with open(os.path.join(args.dataset, 'dataset.json')) as f:
+        dataset = json.load(f)
+    mix = MIXES.get(args.mix) or json.loads(args.mix)
+    unknown = [route for route in mix
+               if not hasattr(Worker, 'do_' + _method_name(route))]
+    if unknown:
+        parser.error('Unknown routes in mix: %s' % ', '.join(unknown))
+
+    results = run(args, dataset, mix)
+    _print_results(results)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'label': args.label,
+                       'started_at': time.strftime('%Y-%m-%dT%H:%M:%SZ',
+                                                   time.gmtime()),
+                       'options': vars(args),
+                       'dataset': dataset,
+                       'mix': mix,
+                       'results': results}, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,4 +6,6 @@
 
 . userapi_db.sh create-tables
 
+. userapi_db.sh migrate
+
 . run_api.sh
@@ -11,6 +11,7 @@ setup(name='userapi',
       packages=find_packages(),
       entry_points={
            'console_scripts': [
-               'userapi-db = userapi.db.cli:main'
+               'userapi-db = userapi.db.cli:main',
+               'userapi-profile = userapi.profile_cli:main',
            ],
        })
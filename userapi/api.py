@@ -1,63 +1,242 @@
+import base64
 import functools
+import itertools
 import json
 import logging
+import os
 
 import flask
 from flask import g
-from flask import jsonify
 from flask import request
 
+from userapi import cache
 from userapi import exceptions
+from userapi import metrics
+from userapi import profiling
+from userapi import serialization
+from userapi import streaming
+from userapi import timing
 from userapi.db import api as db_api
+from userapi.db import replicas
 
 APP = flask.Flask(__name__)
+ACCESS_LOG = logging.getLogger('userapi.access')
 
 REQUIRED_USER_FIELDS = ['userid', 'first_name', 'last_name']
 REQUIRED_GROUP_FIELDS = ['name']
 
+NDJSON_MIMETYPE = 'application/x-ndjson'
+BULK_BATCH_SIZE = 1000
+
+STREAM_CHUNK_SIZE = 1000
+
+# Sent with every committed write when replicas are configured, and
+# accepted back from reads.
+POSITION_HEADER = 'X-WAL-Position'
+POSITION_COOKIE = 'userapi_wal_position'
+POSITION_COOKIE_MAX_AGE = 60
+# Sent instead of a position by streamed writes, whose headers go out
+# before they commit: reads carrying it always go to the primary.
+POSITION_PRIMARY = 'primary'
+
+# Reads which may be served by a replica. Cache misses are always loaded
+# from the primary, so a replica that has not yet replayed a write can
+# never put back what its invalidation removed.
+REPLICA_ENDPOINTS = frozenset([
+    'list_users', 'get_user', 'lookup_users', 'list_user_groups',
+    'list_groups', 'get_group', 'lookup_groups', 'list_group_members',
+    'get_group_member'])
+CACHED_ENDPOINTS = frozenset(['get_user', 'get_group'])
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+MIN_ID = -2 ** 31
+MAX_ID = 2 ** 31 - 1
+
+MAX_LOOKUP_SIZE = 10000
+
 
 @APP.before_first_request
 def _setup():
     APP.logger.addHandler(logging.StreamHandler())
     APP.logger.setLevel(logging.INFO)
+    if not ACCESS_LOG.handlers:
+        ACCESS_LOG.addHandler(logging.StreamHandler())
+        ACCESS_LOG.setLevel(logging.INFO)
+        ACCESS_LOG.propagate = False
+
+
+def _server_timing_enabled():
+    return bool(int(os.environ.get('SERVER_TIMING', 0)))
+
+
+def _access_log_enabled():
+    return bool(int(os.environ.get('ACCESS_LOG', 1)))
 
 
 @APP.before_request
 def _before_request():
+    timing.begin(request.url_rule.rule if request.url_rule else None)
+    metrics.REQUESTS_IN_PROGRESS.inc()
+    metrics.start_flusher()
     g.database = db_api.get_database()
-    g.database.connect()
+    g.database.route(_choose_replica())
+    cache.start_listener(db_api.connect_unpooled)
+    replicas.start_monitor(g.database)
+    if request.endpoint == 'get_metrics':
+        # Metrics stay available while the database is not.
+        return
+    if cache.active():
+        # Queries connect on first use, so cache hits skip the database.
+        return
+    try:
+        g.database.connect()
+    except exceptions.BaseAPIException as ae:
+        return _exception_response(ae)
+
+
+def _choose_replica():
+    """Returns the replica to read from, or None for the primary."""
+    if not replicas.enabled() or request.endpoint not in REPLICA_ENDPOINTS:
+        return None
+    if cache.active() and request.endpoint in CACHED_ENDPOINTS:
+        return None
+    position = (request.headers.get(POSITION_HEADER) or
+                request.cookies.get(POSITION_COOKIE))
+    if position is None:
+        return replicas.choose()
+    position = replicas.parse_position(position)
+    if position is None:
+        # POSITION_PRIMARY, or a token this API never sent.
+        return None
+    return replicas.choose(position)
+
+
+@APP.teardown_request
+def _teardown_request(exc):
+    # Runs even when a view raised, so pooled connections always go back.
+    database = g.get('database')
+    if database is not None and not database.is_closed():
+        database.close()
 
 
 @APP.after_request
 def _after_request(response):
-    g.database.close()
+    timer = timing.current()
+    if timer is None:
+        return response
+    # Time until the view returned. Streamed bodies are produced later and
+    # only show up in the access log.
+    view = timer.elapsed()
+    if _server_timing_enabled():
+        response.headers['Server-Timing'] = _server_timing(timer, view)
+    response.call_on_close(functools.partial(
+        _finish_request, timer, request.method, request.path,
+        response.status_code, view, _replica_name()))
     return response
 
 
+def _replica_name():
+    """Returns the name of the replica serving the request, or None when
+    it is served by the primary or without the database."""
+    database = g.get('database')
+    if database is None or database.is_closed():
+        return None
+    replica = database.routed_replica()
+    return replica.name if replica is not None else None
+
+
+def _server_timing(timer, view):
+    return ('db;dur=%.3f;desc="%d queries", serialization;dur=%.3f, '
+            'view;dur=%.3f' % (timer.durations[timing.DB] * 1000,
+                               timer.queries,
+                               timer.durations[timing.SERIALIZATION] * 1000,
+                               view * 1000))
+
+
+def _finish_request(timer, method, path, status, view, replica=None):
+    # Called once the body has been sent.
+    if timing.current() is timer:
+        timing.end()
+    elapsed = timer.elapsed()
+    labels = (method, timer.route or '')
+    metrics.REQUESTS_IN_PROGRESS.dec()
+    metrics.REQUESTS.inc(labels + (str(status),))
+    metrics.REQUEST_DURATION.observe(labels, elapsed)
+    metrics.DB_QUERIES.observe(labels, timer.queries)
+    metrics.DB_DURATION.observe(labels, timer.durations[timing.DB])
+    if _access_log_enabled():
+        _log_access(timer, method, path, status, view, elapsed, replica)
+
+
+def _log_access(timer, method, path, status, view, elapsed, replica):
+    ACCESS_LOG.info(json.dumps({
+        'method': method,
+        'path': path,
+        'route': timer.route,
+        'replica': replica,
+        'status': status,
+        'queries': timer.queries,
+        'db_ms': round(timer.durations[timing.DB] * 1000, 3),
+        'serialization_ms': round(
+            timer.durations[timing.SERIALIZATION] * 1000, 3),
+        'view_ms': round(view * 1000, 3),
+        'total_ms': round(elapsed * 1000, 3),
+    }, sort_keys=True))
+
+
+def _exception_response(ae):
+    return make_response({'exception': ae.__class__.__name__,
+                          'code': ae.status_code}, code=ae.status_code)
+
+
 def handle_exceptions(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwds):
+    def call(*args, **kwds):
         try:
             return func(*args, **kwds)
         except exceptions.BaseAPIException as ae:
-            response = jsonify({'exception': ae.__class__.__name__,
-                                'code': ae.status_code})
-            response.status_code = ae.status_code
-            return response
+            return _exception_response(ae)
         except:
             logging.exception('Internal server error')
-            response = jsonify({'exception': 'InternalServerException',
-                                'code': 500})
-            response.status_code = 500
-            return response
+            return make_response({'exception': 'InternalServerException',
+                                  'code': 500}, code=500)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        if profiling.should_profile(request.headers):
+            return profiling.profile(request.method, request.url_rule.rule,
+                                     call, *args, **kwds)
+        return call(*args, **kwds)
 
     return wrapper
 
 
+def transactional(func):
+    """Runs a write view in one database transaction, committed once after
+    it returns and run again after a serialization failure or deadlock.
+
+    With replicas, the response carries the WAL position following the
+    write, for the client's next reads to wait for.
+    """
+    @functools.wraps(func)
+    def wrapper(*args, **kwds):
+        response = db_api.run_in_transaction(func, *args, **kwds)
+        if replicas.enabled():
+            _set_position(response, db_api.get_wal_position())
+        return response
+
+    return wrapper
+
+
+def _set_position(response, position):
+    response.headers[POSITION_HEADER] = position
+    response.set_cookie(POSITION_COOKIE, position,
+                        max_age=POSITION_COOKIE_MAX_AGE)
+
+
 def make_response(data, code=200):
-    response = flask.make_response(json.dumps(data))
-    response.status_code = code
-    return response
+    return flask.Response(serialization.dumps(data), status=code,
+                          mimetype=serialization.MIMETYPE)
 
 
 def _check_fields(body, fields):
@@ -66,49 +245,502 @@ def _check_fields(body, fields):
             raise exceptions.MissingRequiredFieldException()
 
 
+def _check_id_list(values):
+    if not isinstance(values, list):
+        raise exceptions.InvalidRequestException()
+    if not all(isinstance(value, basestring) for value in values):
+        raise exceptions.InvalidRequestException()
+
+
+def _check_user(body):
+    if not isinstance(body, dict):
+        raise exceptions.InvalidRequestException()
+    _check_fields(body, REQUIRED_USER_FIELDS)
+    if not all(isinstance(body[field], basestring)
+               for field in REQUIRED_USER_FIELDS):
+        raise exceptions.InvalidRequestException()
+    if 'groups' in body:
+        _check_id_list(body['groups'])
+
+
+def _check_delta(body):
+    """Returns the add and remove lists of a membership change."""
+    if not isinstance(body, dict):
+        raise exceptions.InvalidRequestException()
+    add = body.get('add', [])
+    remove = body.get('remove', [])
+    _check_id_list(add)
+    _check_id_list(remove)
+    if set(add) & set(remove):
+        raise exceptions.InvalidRequestException()
+    return add, remove
+
+
+def _is_conditional():
+    return bool(request.if_none_match or request.if_modified_since)
+
+
+def _validators(version):
+    # The row id keeps a recreated user or group from matching the ETag of
+    # a deleted one with the same version.
+    row_id, row_version, modified_at = version
+    return '%d.%d' % (row_id, row_version), modified_at
+
+
+def _not_modified(version):
+    etag, modified_at = _validators(version)
+    if request.if_none_match:
+        return request.if_none_match.contains_weak(etag)
+    if request.if_modified_since:
+        return modified_at.replace(microsecond=0) <= request.if_modified_since
+    return False
+
+
+def _with_validators(response, version):
+    # Weak, since only the data and not the exact encoding is versioned.
+    etag, modified_at = _validators(version)
+    response.set_etag(etag, weak=True)
+    response.last_modified = modified_at
+    return response
+
+
+def _not_modified_response(version):
+    return _with_validators(flask.Response(status=304), version)
+
+
+def _json_response(body):
+    # body is JSON text, or an iterable of JSON text chunks, ready to send.
+    return flask.Response(body, mimetype=serialization.MIMETYPE)
+
+
+def _encode_cursor(key):
+    return base64.urlsafe_b64encode(json.dumps(key))
+
+
+def _decode_cursor(cursor, key_type):
+    try:
+        key = json.loads(base64.urlsafe_b64decode(str(cursor)))
+    except (TypeError, ValueError):
+        raise exceptions.InvalidRequestException()
+    if key_type is int:
+        # Ids are 32 bit integers, and bool is a subclass of int.
+        valid = (isinstance(key, (int, long)) and
+                 not isinstance(key, bool) and MIN_ID <= key <= MAX_ID)
+    else:
+        valid = isinstance(key, basestring)
+    if not valid:
+        raise exceptions.InvalidRequestException()
+    return key
+
+
+def _get_page_args(key_type):
+    """Returns (after, limit) for a listing keyed by key_type, either
+    basestring for names or int for ids."""
+    try:
+        limit = int(request.args.get('limit', DEFAULT_PAGE_SIZE))
+    except ValueError:
+        raise exceptions.InvalidRequestException()
+    if not 0 < limit <= MAX_PAGE_SIZE:
+        raise exceptions.InvalidRequestException()
+    cursor = request.args.get('cursor')
+    after = _decode_cursor(cursor, key_type) if cursor else None
+    return after, limit
+
+
+def _page(key, items, rows, limit, get_key):
+    # One extra row is fetched to tell whether another page exists.
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = _encode_cursor(get_key(rows[-1]))
+    return {key: items(rows), 'next_cursor': next_cursor}
+
+
+def _get_lookup_args(key):
+    """Returns the ids of a multi-get, from repeated or comma separated
+    query arguments, or None when there are none."""
+    if key not in request.args:
+        return None
+    return _check_lookup([value
+                          for arg in request.args.getlist(key)
+                          for value in arg.split(',') if value])
+
+
+def _get_lookup_body(key):
+    body = request.get_json()
+    if not isinstance(body, dict):
+        raise exceptions.InvalidRequestException()
+    ids = body.get(key)
+    _check_id_list(ids)
+    return _check_lookup(ids)
+
+
+def _check_lookup(ids):
+    if not ids or len(ids) > MAX_LOOKUP_SIZE:
+        raise exceptions.InvalidRequestException()
+    return ids
+
+
+def _lookup_users(userids):
+    users, not_found = db_api.get_users(userids)
+    return make_response({'users': users, 'not_found': not_found})
+
+
+@APP.route("/users", methods=['GET'])
+@handle_exceptions
+def list_users():
+    userids = _get_lookup_args('ids')
+    if userids is not None:
+        return _lookup_users(userids)
+    after, limit = _get_page_args(basestring)
+    users = db_api.list_users(after=after, limit=limit + 1)
+    return make_response(_page('users', list, users, limit,
+                               lambda user: user['userid']))
+
+
 @APP.route("/users/<userid>", methods=['GET'])
 @handle_exceptions
 def get_user(userid):
-    return jsonify(db_api.get_user(userid).to_dict())
+    if _is_conditional() and not cache.active():
+        # Answered from the userid index alone, without the group join.
+        version = db_api.get_user_version(userid)
+        if _not_modified(version):
+            return _not_modified_response(version)
+
+    load = lambda: _load_user(userid)
+    version, body = cache.read_through(cache.USERS, userid, load,
+                                       _in_own_connection(load))
+    if _not_modified(version):
+        return _not_modified_response(version)
+    return _with_validators(_json_response(body), version)
+
+
+def _in_own_connection(load):
+    # Background refreshes run in their own thread and so their own
+    # connection, which must go back to the pool when they finish.
+    def wrapper():
+        try:
+            return load()
+        finally:
+            if not db_api.DATABASE.is_closed():
+                db_api.DATABASE.close()
+    return wrapper
+
+
+def _load_user(userid):
+    """Returns (version, JSON body) for a user, from its precomputed
+    document when there is one."""
+    if db_api.documents_enabled():
+        version, body = db_api.get_user_document(userid)
+        if body is not None:
+            return version, body
+    version, user = db_api.get_user_data(userid)
+    return version, serialization.dumps(user)
+
+
+@APP.route("/users/<userid>/groups", methods=['GET'])
+@handle_exceptions
+def list_user_groups(userid):
+    after, limit = _get_page_args(int)
+    groups = db_api.list_user_groups(userid, after=after, limit=limit + 1)
+    return make_response(_page('groups',
+                               lambda rows: [name for _, name in rows],
+                               groups, limit, lambda group: group[0]))
+
+
+@APP.route("/users/<userid>/groups", methods=['PATCH'])
+@handle_exceptions
+@transactional
+def patch_user_groups(userid):
+    add, remove = _check_delta(request.get_json())
+    added, removed = db_api.patch_user_groups(userid, add=add, remove=remove)
+    return make_response({'added': added, 'removed': removed})
 
 
 @APP.route("/users", methods=['POST'])
 @handle_exceptions
+@transactional
 def create_user():
     body = request.get_json()
-    _check_fields(body, REQUIRED_USER_FIELDS)
-    if 'groups' in body and not isinstance(body['groups'], list):
-        raise exceptions.InvalidRequestException()
+    _check_user(body)
     new_user = db_api.create_user(body)
-    return make_response(new_user.to_dict(), code=201)
+    return _with_validators(make_response(new_user.to_dict(), code=201),
+                            new_user.get_version())
+
+
+def _bulk_result(index, body, exc=None):
+    result = {'index': index,
+              'userid': body.get('userid') if isinstance(body, dict) else None,
+              'code': 201}
+    if exc is not None:
+        result.update({'exception': exc.__class__.__name__,
+                       'code': exc.status_code})
+    return result
+
+
+def _create_users_results(bodies):
+    index = 0
+    try:
+        while True:
+            batch = list(itertools.islice(bodies, BULK_BATCH_SIZE))
+            if not batch:
+                return
+
+            errors = [None] * len(batch)
+            valid = []
+            for offset, body in enumerate(batch):
+                try:
+                    _check_user(body)
+                    valid.append(offset)
+                except exceptions.BaseAPIException as ae:
+                    errors[offset] = ae
+
+            # Each batch is committed, or retried, on its own, so the
+            # results streamed so far are never undone.
+            db_errors = db_api.run_in_transaction(
+                db_api.create_users, [batch[i] for i in valid])
+            for offset, exc in zip(valid, db_errors):
+                errors[offset] = exc
+
+            for offset, body in enumerate(batch):
+                yield _bulk_result(index + offset, body, errors[offset])
+            index += len(batch)
+    except exceptions.BaseAPIException as ae:
+        # Malformed input past this point; earlier batches are committed.
+        yield {'index': index, 'exception': ae.__class__.__name__,
+               'code': ae.status_code}
+    except Exception:
+        logging.exception('Internal server error')
+        yield {'index': index, 'exception': 'InternalServerException',
+               'code': 500}
+
+
+def _encode_ndjson(results):
+    for result in results:
+        yield serialization.dumps(result) + '\n'
+
+
+def _encode_json_array(items, chunk_size=STREAM_CHUNK_SIZE):
+    # Items are encoded and written chunk_size at a time, so a response can
+    # start before the last item exists and is never held whole in memory.
+    items = iter(items)
+    separator = '['
+    while True:
+        chunk = list(itertools.islice(items, chunk_size))
+        if not chunk:
+            break
+        # One encoder call per chunk, minus the chunk's own brackets.
+        yield separator + serialization.dumps(chunk)[1:-1]
+        separator = ','
+    yield '[]' if separator == '[' else ']'
+
+
+@APP.route("/users/bulk", methods=['POST'])
+@handle_exceptions
+def create_users():
+    # Both the body and the per-user results are streamed in batches of
+    # BULK_BATCH_SIZE, so memory does not grow with the upload.
+    if request.mimetype == NDJSON_MIMETYPE:
+        bodies = streaming.iter_ndjson(request.stream)
+        encode, mimetype = _encode_ndjson, NDJSON_MIMETYPE
+    else:
+        bodies = streaming.iter_json_array(request.stream)
+        encode, mimetype = _encode_json_array, serialization.MIMETYPE
+    results = _create_users_results(bodies)
+    response = flask.Response(flask.stream_with_context(encode(results)),
+                              mimetype=mimetype)
+    if replicas.enabled():
+        _set_position(response, POSITION_PRIMARY)
+    return response
+
+
+@APP.route("/users/lookup", methods=['POST'])
+@handle_exceptions
+def lookup_users():
+    return _lookup_users(_get_lookup_body('ids'))
 
 
 @APP.route("/users/<userid>", methods=['DELETE'])
 @handle_exceptions
+@transactional
 def delete_user(userid):
     db_api.delete_user(userid)
-    return jsonify({})
+    return make_response({})
 
 
 @APP.route("/users/<userid>", methods=['PUT'])
 @handle_exceptions
+@transactional
 def update_user(userid):
     body = request.get_json()
-    _check_fields(body, REQUIRED_USER_FIELDS)
-    if 'groups' in body and not isinstance(body['groups'], list):
-        raise exceptions.InvalidRequestException()
+    _check_user(body)
     updated_user = db_api.update_user(userid, body)
-    return jsonify(updated_user.to_dict())
+    return _with_validators(make_response(updated_user.to_dict()),
+                            updated_user.get_version())
+
+
+def _lookup_groups(names):
+    groups, not_found = db_api.get_groups(names)
+    return make_response({'groups': groups, 'not_found': not_found})
+
+
+@APP.route("/groups", methods=['GET'])
+@handle_exceptions
+def list_groups():
+    names = _get_lookup_args('names')
+    if names is not None:
+        return _lookup_groups(names)
+    after, limit = _get_page_args(basestring)
+    groups = db_api.list_groups(after=after, limit=limit + 1)
+    return make_response(_page('groups', list, groups, limit,
+                               lambda group: group['name']))
+
+
+@APP.route("/groups/lookup", methods=['POST'])
+@handle_exceptions
+def lookup_groups():
+    return _lookup_groups(_get_lookup_body('names'))
+
+
+@APP.route("/groups/<name>/members", methods=['GET'])
+@handle_exceptions
+def list_group_members(name):
+    after, limit = _get_page_args(int)
+    members = db_api.list_group_members(name, after=after, limit=limit + 1)
+    return make_response(_page('members',
+                               lambda rows: [userid for _, userid in rows],
+                               members, limit, lambda member: member[0]))
+
+
+@APP.route("/groups/<name>/members/<userid>", methods=['GET', 'HEAD'])
+@handle_exceptions
+def get_group_member(name, userid):
+    db_api.check_membership(name, userid)
+    return make_response({'name': name, 'userid': userid})
 
 
 @APP.route("/groups/<name>", methods=['GET'])
 @handle_exceptions
 def get_group(name):
-    return make_response(db_api.get_group(name).to_list())
+    version = None
+    if _is_conditional() and not cache.active():
+        # Answered from the name index alone, without reading members.
+        version = db_api.get_group_version(name)
+        if _not_modified(version):
+            return _not_modified_response(version)
+
+    token = None
+    cached = _get_cached_group(name)
+    if cached is not None:
+        version, body = cached
+    else:
+        if cache.active():
+            # Reserved before the group is read, as in cache.read_through,
+            # so a write committing meanwhile discards what is cached.
+            token = cache.CACHES[cache.GROUPS].reserve(name)
+        try:
+            if db_api.documents_enabled():
+                version, body = _get_group_document(name, token)
+            else:
+                version = version or db_api.get_group_version(name)
+                body = None
+        except Exception:
+            _release_group(name, token)
+            raise
+    if _not_modified(version):
+        _release_group(name, token)
+        return _not_modified_response(version)
+
+    if body is None:
+        member_ids = db_api.iter_group_member_ids(version[0])
+        if token is not None:
+            member_ids = _fill_while_streaming(name, version, member_ids,
+                                               token)
+        body = flask.stream_with_context(_encode_json_array(member_ids))
+    response = _with_validators(_json_response(body), version)
+    if token is not None:
+        # Also when the body is never streamed in full.
+        response.call_on_close(functools.partial(_release_group, name,
+                                                 token))
+    return response
+
+
+class _GroupTooLarge(Exception):
+    pass
+
+
+def _load_group(name):
+    """Returns (version, JSON body) for a group of at most MAX_GROUP_SIZE
+    members."""
+    if db_api.documents_enabled():
+        version, body = db_api.get_group_document(name)
+        if body is not None:
+            return version, body
+    version = db_api.get_group_version(name)
+    member_ids = list(itertools.islice(
+        db_api.iter_group_member_ids(version[0]), cache.MAX_GROUP_SIZE + 1))
+    if len(member_ids) > cache.MAX_GROUP_SIZE:
+        raise _GroupTooLarge()
+    return version, ''.join(_encode_json_array(member_ids))
+
+
+def _get_group_document(name, token):
+    """Returns (version, body) for a group, body being its precomputed
+    document or None when it has none and must be streamed. The document
+    is cached under token, reserved by the caller."""
+    version, body = db_api.get_group_document(name)
+    if token is not None and body is not None:
+        cache.CACHES[cache.GROUPS].fill(name, (version, body), token)
+    return version, body
+
+
+def _release_group(name, token):
+    if token is not None:
+        cache.CACHES[cache.GROUPS].release(name, token)
+
+
+def _get_cached_group(name):
+    """Returns the cached (version, JSON body) of a group, or None on a
+    miss.
+
+    Misses are not loaded here so that large groups are still streamed;
+    see _fill_while_streaming.
+    """
+    if not cache.active():
+        return None
+    groups = cache.CACHES[cache.GROUPS]
+    state, cached = groups.get(name)
+    if state == cache.STALE and not groups.loading(name):
+        cache.refresh(cache.GROUPS, name,
+                      _in_own_connection(lambda: _load_group(name)))
+    return cached
+
+
+def _fill_while_streaming(name, version, member_ids, token):
+    # Caches the encoded member list under token once it has been streamed
+    # in full, unless it grew past MAX_GROUP_SIZE.
+    groups = cache.CACHES[cache.GROUPS]
+    collected = []
+    complete = False
+    try:
+        for userid in member_ids:
+            if collected is not None:
+                collected.append(userid)
+                if len(collected) > cache.MAX_GROUP_SIZE:
+                    collected = None
+            yield userid
+        complete = True
+    finally:
+        if complete and collected is not None:
+            body = ''.join(_encode_json_array(collected))
+            groups.fill(name, (version, body), token)
+        else:
+            groups.release(name, token)
 
 
 @APP.route("/groups", methods=['POST'])
 @handle_exceptions
+@transactional
 def create_group():
     body = request.get_json()
     _check_fields(body, REQUIRED_GROUP_FIELDS)
@@ -118,15 +750,54 @@ def create_group():
 
 @APP.route("/groups/<name>", methods=['DELETE'])
 @handle_exceptions
+@transactional
 def delete_group(name):
     db_api.delete_group(name)
-    return jsonify({})
+    return make_response({})
 
 
 @APP.route("/groups/<name>", methods=['PUT'])
 @handle_exceptions
+@transactional
 def update_group(name):
     body = request.get_json()
     if not isinstance(body, list):
         raise exceptions.InvalidRequestException()
     return make_response(db_api.update_group(name, body).to_list())
+
+
+@APP.route("/groups/<name>", methods=['PATCH'])
+@handle_exceptions
+@transactional
+def patch_group(name):
+    add, remove = _check_delta(request.get_json())
+    added, removed = db_api.patch_group_members(name, add=add, remove=remove)
+    return make_response({'added': added, 'removed': removed})
+
+
+@APP.route("/stats/pool", methods=['GET'])
+@handle_exceptions
+def get_pool_stats():
+    return make_response(db_api.get_pool_stats())
+
+
+@APP.route("/stats/replicas", methods=['GET'])
+@handle_exceptions
+def get_replica_stats():
+    return make_response({'replicas': replicas.stats()})
+
+
+@APP.route("/stats/cache", methods=['GET'])
+@handle_exceptions
+def get_cache_stats():
+    stats = dict((namespace, c.stats())
+                 for namespace, c in cache.CACHES.items())
+    stats['listening'] = cache.active()
+    return make_response(stats)
+
+
+@APP.route("/metrics", methods=['GET'])
+@handle_exceptions
+def get_metrics():
+    return flask.Response(metrics.collect(),
+                          content_type=metrics.CONTENT_TYPE)
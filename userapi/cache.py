@@ -0,0 +1,324 @@
+import collections
+import json
+import logging
+import os
+import select
+import threading
+import time
+
+from psycopg2 import extensions as pg_extensions
+
+LOG = logging.getLogger(__name__)
+
+CHANNEL = 'userapi_cache'
+USERS = 'users'
+GROUPS = 'groups'
+
+# NOTIFY payloads must stay under 8000 bytes, so invalidations naming more
+# keys than this flush the whole namespace instead.
+MAX_INVALIDATION_KEYS = 100
+MAX_PAYLOAD_SIZE = 7000
+
+LISTEN_POLL_INTERVAL = 5.0
+LISTEN_RETRY_INTERVAL = 1.0
+
+FRESH = 'fresh'
+STALE = 'stale'
+MISSING = 'missing'
+
+STAT_NAMES = ['hits', 'stale_hits', 'misses', 'evictions', 'expirations',
+              'invalidations', 'flushes', 'refreshes']
+
+
+class LRUCache(object):
+    """Thread safe LRU cache whose entries expire ttl seconds after they
+    were loaded.
+
+    An expired entry is still returned as STALE for up to stale_ttl more
+    seconds, so the caller can serve it while reloading it in the
+    background. The cache is disabled while max_size is 0.
+
+    Loads are bracketed by reserve() and fill(). Invalidating a key while
+    it is being loaded discards the load, so a value read before a write
+    committed can never be stored after the write's invalidation.
+    """
+
+    def __init__(self, max_size=0, ttl=0, stale_ttl=0):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self._lock = threading.Lock()
+        # key -> (loaded_at, value), least recently used first.
+        self._entries = collections.OrderedDict()
+        # key -> token of the load allowed to fill it.
+        self._loading = {}
+        self._stats = collections.Counter()
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def get(self, key):
+        """Returns (state, value) where state is FRESH, STALE or MISSING."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self._stats['misses'] += 1
+                return MISSING, None
+
+            loaded_at, value = entry
+            age = time.time() - loaded_at
+            if age > self.ttl + self.stale_ttl:
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return MISSING, None
+
+            self._entries[key] = entry
+            if age > self.ttl:
+                self._stats['stale_hits'] += 1
+                return STALE, value
+            self._stats['hits'] += 1
+            return FRESH, value
+
+    def loading(self, key):
+        with self._lock:
+            return key in self._loading
+
+    def reserve(self, key):
+        token = object()
+        with self._lock:
+            self._loading[key] = token
+        return token
+
+    def fill(self, key, value, token):
+        with self._lock:
+            if self._loading.get(key) is not token:
+                return
+            del self._loading[key]
+            self._entries.pop(key, None)
+            self._entries[key] = (time.time(), value)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self._stats['evictions'] += 1
+
+    def release(self, key, token):
+        with self._lock:
+            if self._loading.get(key) is token:
+                del self._loading[key]
+
+    def invalidate(self, keys):
+        with self._lock:
+            for key in keys:
+                self._loading.pop(key, None)
+                if self._entries.pop(key, None) is not None:
+                    self._stats['invalidations'] += 1
+
+    def clear(self):
+        with self._lock:
+            self._loading.clear()
+            self._entries.clear()
+            self._stats['flushes'] += 1
+
+    def count_refresh(self):
+        with self._lock:
+            self._stats['refreshes'] += 1
+
+    def stats(self):
+        with self._lock:
+            stats = dict((name, self._stats[name]) for name in STAT_NAMES)
+            stats.update({'size': len(self._entries),
+                          'max_size': self.max_size,
+                          'ttl': self.ttl,
+                          'stale_ttl': self.stale_ttl})
+        return stats
+
+
+CACHES = {USERS: LRUCache(), GROUPS: LRUCache()}
+MAX_GROUP_SIZE = 0
+
+_listener = None
+_listener_lock = threading.Lock()
+
+
+def configure(size=None, ttl=None, stale_ttl=None, max_group_size=None):
+    """Replaces both caches with empty ones sized from the arguments,
+    falling back to the CACHE_* environment variables."""
+    global MAX_GROUP_SIZE
+    if size is None:
+        size = int(os.environ.get('CACHE_SIZE', 0))
+    if ttl is None:
+        ttl = float(os.environ.get('CACHE_TTL', 60))
+    if stale_ttl is None:
+        stale_ttl = float(os.environ.get('CACHE_STALE_TTL', 0))
+    if max_group_size is None:
+        max_group_size = int(os.environ.get('CACHE_MAX_GROUP_SIZE', 10000))
+
+    for namespace in CACHES:
+        CACHES[namespace] = LRUCache(size, ttl, stale_ttl)
+    MAX_GROUP_SIZE = max_group_size
+
+
+def enabled():
+    return CACHES[USERS].enabled
+
+
+def active():
+    """True when cached values may be served.
+
+    Until this process is listening for invalidations it cannot tell when
+    an entry goes out of date, so reads bypass the cache.
+    """
+    return (enabled() and _listener is not None and
+            _listener.pid == os.getpid() and _listener.listening)
+
+
+def read_through(namespace, key, load, refresh_load=None):
+    """Returns the cached value for key, calling load() on a miss.
+
+    A stale value is returned as is while refresh_load(), by default
+    load(), runs in a background thread to replace it.
+    """
+    cache = CACHES[namespace]
+    if not active():
+        return load()
+
+    state, value = cache.get(key)
+    if state == FRESH:
+        return value
+    if state == STALE:
+        if not cache.loading(key):
+            refresh(namespace, key, refresh_load or load)
+        return value
+
+    token = cache.reserve(key)
+    try:
+        value = load()
+    except Exception:
+        cache.release(key, token)
+        raise
+    cache.fill(key, value, token)
+    return value
+
+
+def refresh(namespace, key, load):
+    cache = CACHES[namespace]
+    token = cache.reserve(key)
+    cache.count_refresh()
+
+    def run():
+        try:
+            value = load()
+        except Exception:
+            LOG.debug('Error refreshing %s %r.', namespace, key, exc_info=True)
+            cache.release(key, token)
+            cache.invalidate([key])
+            return
+        cache.fill(key, value, token)
+
+    thread = threading.Thread(target=run)
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def invalidation_payload(users=(), groups=(), flush=()):
+    """Encodes an invalidation message for NOTIFY.
+
+    Namespaces in flush, or with too many keys to name, are cleared
+    entirely by every receiver.
+    """
+    message = {'flush': list(flush)}
+    for namespace, keys in ((USERS, users), (GROUPS, groups)):
+        keys = sorted(set(keys))
+        if namespace in message['flush'] or not keys:
+            continue
+        if (len(keys) > MAX_INVALIDATION_KEYS or
+                len(json.dumps(keys)) > MAX_PAYLOAD_SIZE // 2):
+            message['flush'].append(namespace)
+        else:
+            message[namespace] = keys
+    if not message['flush']:
+        del message['flush']
+    return json.dumps(message, sort_keys=True)
+
+
+def handle_message(payload):
+    """Applies an invalidation message, flushing everything if it is
+    unreadable."""
+    try:
+        message = json.loads(payload)
+    except (TypeError, ValueError):
+        message = {'flush': list(CACHES)}
+    for namespace in message.get('flush', []):
+        if namespace in CACHES:
+            CACHES[namespace].clear()
+    for namespace, cache in CACHES.items():
+        cache.invalidate(message.get(namespace, []))
+
+
+def flush():
+    for cache in CACHES.values():
+        cache.clear()
+
+
+class Listener(threading.Thread):
+    """Applies invalidations published by every process to this process'
+    caches.
+
+    Messages sent while the connection is down are lost, so the caches are
+    flushed each time LISTEN is (re)established.
+    """
+
+    def __init__(self, connect):
+        super(Listener, self).__init__(name='userapi-cache-listener')
+        self.daemon = True
+        self.pid = os.getpid()
+        self.listening = False
+        self._connect = connect
+
+    def run(self):
+        while True:
+            conn = None
+            try:
+                conn = self._connect()
+                conn.set_isolation_level(
+                    pg_extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+                conn.cursor().execute('LISTEN %s' % CHANNEL)
+                flush()
+                self.listening = True
+                self._poll(conn)
+            except Exception:
+                LOG.warning('Cache invalidation listener failed, retrying.',
+                            exc_info=True)
+            finally:
+                if self.listening:
+                    self.listening = False
+                    flush()
+                if conn is not None:
+                    try:
+                        conn.close()
+                    except Exception:
+                        pass
+            time.sleep(LISTEN_RETRY_INTERVAL)
+
+    def _poll(self, conn):
+        while True:
+            select.select([conn], [], [], LISTEN_POLL_INTERVAL)
+            conn.poll()
+            while conn.notifies:
+                handle_message(conn.notifies.pop(0).payload)
+
+
+def start_listener(connect):
+    """Starts this process' listener once; safe to call on every request
+    and after a fork."""
+    global _listener
+    if not enabled():
+        return
+    with _listener_lock:
+        if _listener is None or _listener.pid != os.getpid():
+            _listener = Listener(connect)
+            _listener.start()
+
+
+configure()
@@ -1,15 +1,65 @@
+import collections
+import atexit
 import copy
+import datetime
+import logging
 import os
+import random
+import threading
+import time
 
 import peewee
-from playhouse import postgres_ext
+from peewee import fn
+import psycopg2
+from psycopg2 import errorcodes
+from psycopg2 import extensions as pg_extensions
 
+from userapi import cache
 from userapi import exceptions
+from userapi import metrics
+from userapi import serialization
+from userapi import timing
+from userapi.db import pool
+from userapi.db import prepared
 
-DATABASE = postgres_ext.PostgresqlExtDatabase(None, register_hstore=False)
+LOG = logging.getLogger(__name__)
 
+DATABASE = pool.PooledPostgresqlExtDatabase(None, register_hstore=False)
 
-class User(peewee.Model):
+SERVER_SIDE_BATCH_SIZE = 5000
+DOCUMENT_BATCH_SIZE = 1000
+# Group documents dropped by writes are rebuilt this many seconds later, so
+# a burst of changes to one group costs a single rebuild.
+DOCUMENT_REBUILD_DELAY = 0.1
+DOCUMENT_REBUILD_RETRY_INTERVAL = 1.0
+
+RETRY_BASE_DELAY = 0.01
+RETRY_MAX_DELAY = 0.5
+# Both abort a transaction that would most likely succeed if run again.
+RETRYABLE_ERRORS = (errorcodes.SERIALIZATION_FAILURE,
+                    errorcodes.DEADLOCK_DETECTED)
+
+# modified_at is kept in UTC, like datetime.utcnow().
+_UTC_NOW = peewee.SQL("(now() AT TIME ZONE 'UTC')")
+
+
+class VersionedModel(peewee.Model):
+    """Base for rows whose version is bumped by every write changing their
+    representation, including membership changes.
+
+    The database defaults also cover rows inserted with raw SQL.
+    """
+    version = peewee.BigIntegerField(default=1,
+                                     constraints=[peewee.SQL('DEFAULT 1')])
+    modified_at = peewee.DateTimeField(
+        default=datetime.datetime.utcnow,
+        constraints=[peewee.SQL('DEFAULT %s' % _UTC_NOW.value)])
+
+    def get_version(self):
+        return self.id, self.version, self.modified_at
+
+
+class User(VersionedModel):
     class Meta:
         database = DATABASE
 
@@ -21,10 +71,22 @@ class User(peewee.Model):
         return {'userid': self.userid,
                 'first_name': self.first_name,
                 'last_name': self.last_name,
-                'groups': [ug.group.name for ug in self.usergroups]}
+                'groups': self.get_group_names()}
+
+    def get_group_names(self):
+        # Populated by get_user's aggregate query, otherwise loaded with a
+        # single join instead of one lazy Group fetch per membership.
+        group_names = getattr(self, 'group_names', None)
+        if group_names is None:
+            group_names = [group.name for group in
+                           Group.select(Group.name)
+                                .join(UserGroups)
+                                .where(UserGroups.user == self)
+                                .order_by(UserGroups.id)]
+        return group_names
 
 
-class Group(peewee.Model):
+class Group(VersionedModel):
     class Meta:
         database = DATABASE
 
@@ -34,16 +96,49 @@ class Group(peewee.Model):
         return {'name': self.name}
 
     def to_list(self):
-        return [ug.user.userid for ug in self.usergroups]
+        return list(iter_group_member_ids(self, server_side=False))
 
 
 class UserGroups(peewee.Model):
     class Meta:
         database = DATABASE
+        # A membership exists at most once. Either index answers membership
+        # checks with one lookup, (user, group) lists a user's groups and
+        # (group, user) walks one group in user order.
+        indexes = ((('user', 'group'), True),
+                   (('group', 'user'), True))
 
     user = peewee.ForeignKeyField(User, index=True, related_name='usergroups')
     group = peewee.ForeignKeyField(Group, index=True, related_name='usergroups')
 
+    @classmethod
+    def _fields_to_index(cls):
+        # peewee indexes every foreign key on its own, but each of those
+        # indexes is a prefix of one of the composite indexes above.
+        return []
+
+
+class UserDocument(peewee.Model):
+    """The GET /users/<userid> body of a user, rebuilt by every write that
+    bumps its version. Kept apart from User so ordinary queries do not
+    fetch it."""
+    class Meta:
+        database = DATABASE
+
+    user = peewee.ForeignKeyField(User, primary_key=True, on_delete='CASCADE')
+    body = peewee.TextField()
+
+
+class GroupDocument(peewee.Model):
+    """The GET /groups/<name> body of a group no larger than
+    DOCUMENT_MAX_GROUP_SIZE members."""
+    class Meta:
+        database = DATABASE
+
+    group = peewee.ForeignKeyField(Group, primary_key=True,
+                                   on_delete='CASCADE')
+    body = peewee.TextField()
+
 
 def get_database(database=None, user=None, password=None, host=None):
     database = database or os.environ.get('POSTGRES_DB', None)
@@ -51,15 +146,524 @@ def get_database(database=None, user=None, password=None, host=None):
     password = password or os.environ.get('POSTGRES_PASSWORD', None)
     host = host or os.environ.get('POSTGRES_HOST', None)
 
-    DATABASE.init(database, user=user, password=password, host=host)
+    DATABASE.init(database, user=user, password=password, host=host,
+                  **_get_pool_options())
     return DATABASE
 
 
+def _get_pool_options():
+    return {
+        'max_connections': int(os.environ.get('POSTGRES_POOL_SIZE', 0)),
+        'stale_timeout': float(
+            os.environ.get('POSTGRES_POOL_STALE_TIMEOUT', 0)),
+        'idle_timeout': float(os.environ.get('POSTGRES_POOL_IDLE_TIMEOUT', 0)),
+        'wait_timeout': float(os.environ.get('POSTGRES_POOL_WAIT_TIMEOUT', 0)),
+    }
+
+
+def get_pool_stats():
+    return DATABASE.pool_stats()
+
+
+def documents_enabled():
+    return bool(int(os.environ.get('PRECOMPUTE_DOCUMENTS', 0)))
+
+
+def _document_max_group_size():
+    return int(os.environ.get('DOCUMENT_MAX_GROUP_SIZE', 10000))
+
+
+def _transaction_retries():
+    return int(os.environ.get('TRANSACTION_RETRIES', 3))
+
+
+def run_in_transaction(func, *args, **kwds):
+    """Returns func(*args, **kwds), run in one transaction which is
+    committed once func returns and rolled back if it raises.
+
+    The write functions of this module join the transaction instead of
+    committing on their own. After a serialization failure or deadlock
+    func is run again from the start, up to TRANSACTION_RETRIES times,
+    each time after a random delay of up to twice the previous one's
+    bound, before TransactionConflictException is raised.
+    """
+    retries = _transaction_retries()
+    attempt = 0
+    while True:
+        try:
+            with DATABASE.transaction():
+                return func(*args, **kwds)
+        except pg_extensions.TransactionRollbackError as e:
+            if e.pgcode not in RETRYABLE_ERRORS:
+                raise
+            if attempt >= retries:
+                raise exceptions.TransactionConflictException()
+            timer = timing.current()
+            metrics.TRANSACTION_RETRIES.inc(
+                (timer.route if timer is not None else '', e.pgcode))
+        attempt += 1
+        time.sleep(random.uniform(
+            0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)))
+
+
+def get_wal_position():
+    """Returns the primary's current WAL insert position, which follows
+    every write committed so far."""
+    cursor = DATABASE.execute_sql('SELECT pg_current_wal_insert_lsn()',
+                                  require_commit=False)
+    return cursor.fetchone()[0]
+
+
+def connect_unpooled():
+    """Opens a connection outside the pool, e.g. for LISTEN."""
+    return psycopg2.connect(database=DATABASE.database,
+                            **DATABASE.connect_kwargs)
+
+
+def _touch_users(user_ids):
+    """Bumps the version of the given users, returning their userids."""
+    if not user_ids:
+        return []
+    query = (User.update(version=User.version + 1, modified_at=_UTC_NOW)
+                 .where(User.id == _any(user_ids))
+                 .returning(User.userid)
+                 .tuples())
+    return [userid for userid, in query.execute()]
+
+
+def _touch_groups(group_ids):
+    """Bumps the version of the given groups, returning their names."""
+    if not group_ids:
+        return []
+    query = (Group.update(version=Group.version + 1, modified_at=_UTC_NOW)
+                  .where(Group.id == _any(group_ids))
+                  .returning(Group.name)
+                  .tuples())
+    return [name for name, in query.execute()]
+
+
+def _record_changes(user_ids=(), group_ids=(), deleted_users=(),
+                    deleted_groups=()):
+    """Bumps the version of changed users and groups, refreshes their
+    documents and invalidates them, along with the userids and names that
+    no longer exist.
+
+    Group documents are dropped and rebuilt after the write by the
+    DocumentRebuilder, as rebuilding one reads every member however few
+    of them changed.
+    """
+    user_ids = _unique(user_ids)
+    group_ids = _unique(group_ids)
+    users = _touch_users(user_ids) + list(deleted_users)
+    groups = _touch_groups(group_ids) + list(deleted_groups)
+    _refresh_documents(user_ids=user_ids, group_ids=group_ids,
+                       defer_groups=True)
+    _invalidate(users=users, groups=groups)
+
+
+# Documents are encoded by userapi.serialization, like every other
+# response, so they are as compact and ASCII-only as the bodies built per
+# request. These read what goes into them.
+_USER_DOCUMENT_SQL = (
+    'SELECT u.id, u.userid, u.first_name, u.last_name, '
+    'coalesce((SELECT array_agg(g.name ORDER BY ug.id) '
+    'FROM usergroups ug JOIN "group" g ON g.id = ug.group_id '
+    'WHERE ug.user_id = u.id), \'{}\') '
+    'FROM "user" u WHERE u.id = ANY(%s)')
+
+# The members are read at most once past the size limit, so a group too
+# large for a document costs no more than the limit to skip.
+_GROUP_DOCUMENT_SQL = (
+    'SELECT id, members FROM ('
+    'SELECT g.id, (SELECT CASE WHEN count(*) <= %s '
+    'THEN coalesce(array_agg(m.userid ORDER BY m.user_id), \'{}\') '
+    'END FROM (SELECT u.userid, ug.user_id FROM usergroups ug '
+    'JOIN "user" u ON u.id = ug.user_id WHERE ug.group_id = g.id '
+    'ORDER BY ug.user_id LIMIT %s) m) AS members '
+    'FROM "group" g WHERE g.id = ANY(%s)) d '
+    'WHERE members IS NOT NULL')
+
+_INSERT_DOCUMENTS_SQL = ('INSERT INTO %s (%s, body) '
+                         'SELECT * FROM unnest(%%s::integer[], %%s::text[])')
+
+
+def _insert_documents(execute, table, key, documents):
+    """Encodes {row id: document} and inserts it into table."""
+    if not documents:
+        return
+    ids = list(documents)
+    execute(_INSERT_DOCUMENTS_SQL % (table, key),
+            (ids, [serialization.dumps(documents[row_id])
+                   for row_id in ids]))
+
+
+def _refresh_documents(user_ids=(), group_ids=(), defer_groups=False):
+    """Rebuilds the documents of the given users and groups in the current
+    transaction, or with defer_groups those of the groups once it has
+    committed.
+
+    Their old documents are dropped even while documents are disabled, so
+    a process serving documents never finds an out of date one.
+    """
+    if user_ids:
+        DATABASE.execute_sql(
+            'DELETE FROM userdocument WHERE user_id = ANY(%s)',
+            (list(user_ids),))
+        if documents_enabled():
+            rows = DATABASE.execute_sql(_USER_DOCUMENT_SQL, (list(user_ids),))
+            _insert_documents(DATABASE.execute_sql, 'userdocument', 'user_id',
+                              dict((row[0], _user_dict(*row[1:]))
+                                   for row in rows))
+    if group_ids and defer_groups and documents_enabled():
+        DATABASE.execute_sql(
+            'DELETE FROM groupdocument WHERE group_id = ANY(%s)',
+            (list(group_ids),))
+        _rebuild_later(group_ids)
+    elif group_ids:
+        _refresh_group_documents(DATABASE.execute_sql, group_ids)
+
+
+def _refresh_group_documents(execute, group_ids):
+    """Rebuilds the given groups' documents, execute(sql, params) running
+    a statement and returning its cursor."""
+    execute('DELETE FROM groupdocument WHERE group_id = ANY(%s)',
+            (list(group_ids),))
+    if documents_enabled():
+        max_size = _document_max_group_size()
+        rows = execute(_GROUP_DOCUMENT_SQL,
+                       (max_size, max_size + 1, list(group_ids)))
+        _insert_documents(execute, 'groupdocument', 'group_id',
+                          dict(rows.fetchall()))
+
+
+def rebuild_group_document(conn, group_id):
+    """Rebuilds one group's document in its own transaction on conn, a
+    psycopg2 connection."""
+    with conn:
+        cursor = conn.cursor()
+
+        def execute(sql, params):
+            cursor.execute(sql, params)
+            return cursor
+
+        # Waits for writes to the group in progress to commit, and keeps
+        # new ones from committing before this rebuild, which then reads
+        # the members matching the group's version.
+        execute('SELECT 1 FROM "group" WHERE id = %s FOR SHARE', (group_id,))
+        _refresh_group_documents(execute, [group_id])
+
+
+class DocumentRebuilder(threading.Thread):
+    """Rebuilds the group documents dropped by this process' writes.
+
+    The groups are queued before the write commits; rebuild_group_document
+    waits for it. Until a document is rebuilt its group is read from the
+    members directly. Rebuilds that fail are retried.
+
+    Rebuilds use a connection of their own outside the pool, so they never
+    take a pooled connection away from requests.
+    """
+
+    def __init__(self):
+        super(DocumentRebuilder, self).__init__(
+            name='userapi-document-rebuilder')
+        self.daemon = True
+        self.pid = os.getpid()
+        self._pending = set()
+        self._condition = threading.Condition(threading.Lock())
+
+    def add(self, group_ids):
+        with self._condition:
+            self._pending.update(group_ids)
+            self._condition.notify()
+
+    def _take(self, wait=True):
+        with self._condition:
+            while wait and not self._pending:
+                self._condition.wait()
+        if wait:
+            time.sleep(DOCUMENT_REBUILD_DELAY)
+        with self._condition:
+            group_ids, self._pending = self._pending, set()
+        return sorted(group_ids)
+
+    def _connect(self):
+        conn = connect_unpooled()
+        # Reads text as unicode, as peewee's connections do.
+        pg_extensions.register_type(pg_extensions.UNICODE, conn)
+        pg_extensions.register_type(pg_extensions.UNICODEARRAY, conn)
+        return conn
+
+    def rebuild(self, conn, group_ids):
+        """Rebuilds the given groups' documents on conn, returning those
+        that failed."""
+        failed = []
+        for group_id in group_ids:
+            try:
+                rebuild_group_document(conn, group_id)
+            except Exception:
+                LOG.warning('Rebuilding the document of group %s failed.',
+                            group_id, exc_info=True)
+                failed.append(group_id)
+        return failed
+
+    def run(self):
+        conn = None
+        while True:
+            group_ids = self._take()
+            try:
+                if conn is None or conn.closed:
+                    conn = self._connect()
+                failed = self.rebuild(conn, group_ids)
+            except psycopg2.Error:
+                LOG.warning('Connecting to rebuild documents failed.',
+                            exc_info=True)
+                failed = group_ids
+            if failed:
+                time.sleep(DOCUMENT_REBUILD_RETRY_INTERVAL)
+                self.add(failed)
+
+    def flush(self):
+        """Rebuilds every queued document now, in the calling thread and
+        its own connection."""
+        group_ids = self._take(wait=False)
+        if not group_ids:
+            return
+        try:
+            conn = self._connect()
+        except psycopg2.Error:
+            LOG.warning('Connecting to rebuild documents failed.',
+                        exc_info=True)
+            return
+        try:
+            self.rebuild(conn, group_ids)
+        finally:
+            conn.close()
+
+
+_rebuilder = None
+_rebuilder_lock = threading.Lock()
+
+
+def _rebuild_later(group_ids):
+    """Queues group documents for this process' DocumentRebuilder, starting
+    it once and again after a fork."""
+    global _rebuilder
+    with _rebuilder_lock:
+        if _rebuilder is None or _rebuilder.pid != os.getpid():
+            _rebuilder = DocumentRebuilder()
+            _rebuilder.start()
+    _rebuilder.add(group_ids)
+
+
+@atexit.register
+def _flush_rebuilds():
+    # A worker exiting, e.g. after gunicorn's max_requests, still rebuilds
+    # the documents its last writes dropped.
+    if _rebuilder is not None and _rebuilder.pid == os.getpid():
+        _rebuilder.flush()
+
+
+def refresh_all_documents(batch_size=DOCUMENT_BATCH_SIZE):
+    """Rebuilds every document, batch_size rows per transaction, and
+    returns the number of users and groups visited."""
+    counts = []
+    for model, key in ((User, 'user_ids'), (Group, 'group_ids')):
+        count = 0
+        after = 0
+        while True:
+            with DATABASE.atomic():
+                ids = [row_id for row_id, in
+                       model.select(model.id)
+                            .where(model.id > after)
+                            .order_by(model.id)
+                            .limit(batch_size)
+                            .tuples()]
+                if not ids:
+                    break
+                _refresh_documents(**{key: ids})
+            count += len(ids)
+            after = ids[-1]
+        counts.append(count)
+    return tuple(counts)
+
+
+def _invalidate(users=(), groups=(), flush=()):
+    # NOTIFY is transactional, so other processes drop their entries only
+    # once the write is committed. This process drops them immediately and
+    # again when its own notification arrives.
+    if not cache.enabled():
+        return
+    payload = cache.invalidation_payload(users=users, groups=groups,
+                                         flush=flush)
+    DATABASE.execute_sql('SELECT pg_notify(%s, %s)', (cache.CHANNEL, payload))
+    cache.handle_message(payload)
+
+
 def _create_tables(database):
-    database.create_tables([User, Group, UserGroups], safe=True)
+    database.create_tables([User, Group, UserGroups, UserDocument,
+                            GroupDocument], safe=True)
+
+
+def _any(values):
+    # "= ANY(%s)" sends the whole list as one array parameter, unlike IN
+    # which needs a placeholder per value.
+    return fn.ANY(peewee.Passthrough(list(values)))
+
+
+def _select_users_with_groups():
+    group_names = fn.array_remove(
+        fn.array_agg(peewee.Clause(Group.name, peewee.SQL('ORDER BY'),
+                                   UserGroups.id)),
+        peewee.SQL('NULL'))
+    return (User.select(User, group_names.alias('group_names'))
+                .join(UserGroups, peewee.JOIN.LEFT_OUTER)
+                .join(Group, peewee.JOIN.LEFT_OUTER)
+                .group_by(User.id))
+
+
+def _fetch_one(statement, *params):
+    """Runs a prepared statement, returning its first row or None."""
+    return statement.execute(DATABASE, *params).fetchone()
+
+
+def _fetch_model(model, statement, *params):
+    cursor = statement.execute(DATABASE, *params)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return model(**dict(zip([column[0] for column in cursor.description],
+                            row)))
+
+
+# The hot lookups run as prepared statements. Each is defined with
+# placeholder values standing in for its parameters.
+_GET_USER = prepared.PreparedQuery(
+    'userapi_get_user',
+    _select_users_with_groups().where(User.userid == ''))
+_GET_USER_VERSION = prepared.PreparedQuery(
+    'userapi_get_user_version',
+    User.select(User.id, User.version, User.modified_at)
+        .where(User.userid == ''))
+_GET_USER_DOCUMENT = prepared.PreparedQuery(
+    'userapi_get_user_document',
+    User.select(User.id, User.version, User.modified_at, UserDocument.body)
+        .join(UserDocument, peewee.JOIN.LEFT_OUTER)
+        .where(User.userid == ''))
+_USER_EXISTS = prepared.PreparedQuery(
+    'userapi_user_exists',
+    User.select(peewee.SQL('1')).where(User.userid == '').limit(1))
+_GET_GROUP = prepared.PreparedQuery(
+    'userapi_get_group',
+    Group.select().where(Group.name == ''))
+_GET_GROUP_VERSION = prepared.PreparedQuery(
+    'userapi_get_group_version',
+    Group.select(Group.id, Group.version, Group.modified_at)
+         .where(Group.name == ''))
+_GET_GROUP_DOCUMENT = prepared.PreparedQuery(
+    'userapi_get_group_document',
+    Group.select(Group.id, Group.version, Group.modified_at,
+                 GroupDocument.body)
+         .join(GroupDocument, peewee.JOIN.LEFT_OUTER)
+         .where(Group.name == ''))
+_GROUP_EXISTS = prepared.PreparedQuery(
+    'userapi_group_exists',
+    Group.select(peewee.SQL('1')).where(Group.name == '').limit(1))
+# Always one row: the group's id, the user's id, each NULL when missing,
+# and whether the (group, user) index holds the pair.
+_GET_MEMBERSHIP = prepared.PreparedQuery(
+    'userapi_get_membership',
+    UserGroups.raw(
+        'SELECT g.id, u.id, EXISTS (SELECT 1 FROM usergroups ug '
+        'WHERE ug.group_id = g.id AND ug.user_id = u.id) '
+        'FROM (SELECT 1) one '
+        'LEFT JOIN "group" g ON g.name = %s '
+        'LEFT JOIN "user" u ON u.userid = %s', '', ''))
+# A page of a user's groups, read in order from the (user, group) index and
+# stopping at the limit. A user without groups gets a single NULL row.
+_LIST_USER_GROUPS = prepared.PreparedQuery(
+    'userapi_list_user_groups',
+    UserGroups.raw(
+        'SELECT m.group_id, g.name FROM "user" u '
+        'LEFT JOIN LATERAL (SELECT ug.group_id FROM usergroups ug '
+        'WHERE ug.user_id = u.id AND ug.group_id > %s '
+        'ORDER BY ug.group_id LIMIT %s) m ON true '
+        'LEFT JOIN "group" g ON g.id = m.group_id '
+        'WHERE u.userid = %s ORDER BY m.group_id', 0, 0, ''))
 
 
 def get_user(userid):
+    user = _fetch_model(User, _GET_USER, userid)
+    if user is None:
+        raise exceptions.UserNotFoundException
+    return user
+
+
+def _user_dict(userid, first_name, last_name, group_names):
+    # The same shape as User.to_dict().
+    return {'userid': userid,
+            'first_name': first_name,
+            'last_name': last_name,
+            'groups': group_names}
+
+
+def get_user_data(userid):
+    """Returns ((id, version, modified_at), user dict) without building a
+    model, for reads."""
+    row = _fetch_one(_GET_USER, userid)
+    if row is None:
+        raise exceptions.UserNotFoundException
+    return row[:3], _user_dict(*row[3:])
+
+
+def _get_group_names_by_user(user_ids):
+    if not user_ids:
+        return {}
+    group_names = fn.array_agg(peewee.Clause(Group.name, peewee.SQL('ORDER BY'),
+                                             UserGroups.id))
+    return dict(UserGroups.select(UserGroups.user, group_names)
+                          .join(Group)
+                          .where(UserGroups.user == _any(user_ids))
+                          .group_by(UserGroups.user)
+                          .tuples())
+
+
+def list_users(after=None, limit=100):
+    """Returns up to limit user dicts ordered by userid, starting after the
+    given userid, with their group names loaded in one extra query."""
+    query = (User.select(User.id, User.userid, User.first_name,
+                         User.last_name)
+                 .order_by(User.userid)
+                 .limit(limit)
+                 .tuples())
+    if after is not None:
+        query = query.where(User.userid > after)
+    rows = list(query)
+    group_names = _get_group_names_by_user([row[0] for row in rows])
+    return [_user_dict(userid, first_name, last_name,
+                       group_names.get(user_id, []))
+            for user_id, userid, first_name, last_name in rows]
+
+
+def get_users(userids):
+    """Returns (user dicts, missing userids) for the given userids, each in
+    the order requested, with two queries however many are asked for."""
+    userids = _unique(userids)
+    if not userids:
+        return [], []
+    rows = list(User.select(User.id, User.userid, User.first_name,
+                            User.last_name)
+                    .where(User.userid == _any(userids))
+                    .tuples())
+    group_names = _get_group_names_by_user([row[0] for row in rows])
+    users = dict((userid, _user_dict(userid, first_name, last_name,
+                                     group_names.get(user_id, [])))
+                 for user_id, userid, first_name, last_name in rows)
+    return ([users[userid] for userid in userids if userid in users],
+            [userid for userid in userids if userid not in users])
+
+
+def _get_user(userid):
     try:
         return User.get(User.userid == userid)
     except User.DoesNotExist as dne:
@@ -67,86 +671,398 @@ def get_user(userid):
 
 
 def _user_exists(userid):
-    return User.select().where(User.userid == userid).exists()
+    return _fetch_one(_USER_EXISTS, userid) is not None
 
 
 def _group_exists(name):
-    return Group.select().where(Group.name == name).exists()
+    return _fetch_one(_GROUP_EXISTS, name) is not None
 
 
-def create_user(user):
-    userid = user['userid']
+def _unique(values):
+    seen = set()
+    return [v for v in values if not (v in seen or seen.add(v))]
 
-    if _user_exists(userid):
-        raise exceptions.UserAlreadyExistsException()
 
-    requested_groups = [get_group(name) for name in user.get('groups', list())]
+def create_user(user):
+    with DATABASE.transaction():
+        requested_groups = _get_requested_groups(user)
 
-    new_user = User(userid=userid,
-                    first_name=user['first_name'],
-                    last_name=user['last_name'])
-    new_user.save()
+        new_user = User(userid=user['userid'],
+                        first_name=user['first_name'],
+                        last_name=user['last_name'])
+        _save_unique_user(new_user)
 
-    for group in requested_groups:
-        UserGroups(user=new_user, group=group).save()
+        _record_changes(
+            group_ids=_add_new_groups(new_user, requested_groups))
+        _refresh_documents(user_ids=[new_user.id])
 
+    new_user.group_names = _unique(user.get('groups', list()))
     return new_user
 
 
+def _get_group_ids(names):
+    if not names:
+        return {}
+    return {group.name: group.id for group in
+            Group.select(Group.id, Group.name)
+                 .where(Group.name == _any(names))}
+
+
 def _get_requested_groups(user):
-    return {name: get_group(name) for name in user.get('groups', list())}
+    """Returns the requested group names mapped to their ids, in the order
+    requested."""
+    names = _unique(user.get('groups', list()))
+    group_ids = _get_group_ids(names)
+    if len(group_ids) != len(names):
+        raise exceptions.GroupNotFoundException()
+    return collections.OrderedDict((name, group_ids[name]) for name in names)
+
+
+_INSERT_USERS_SQL = (
+    'INSERT INTO "user" ("userid", "first_name", "last_name") '
+    'SELECT * FROM unnest(%s::text[], %s::text[], %s::text[]) '
+    'ON CONFLICT ("userid") DO NOTHING '
+    'RETURNING "userid", "id"')
+
+
+def create_users(users):
+    """Creates a batch of users in one transaction.
+
+    Returns a list with one entry per requested user, None when it was
+    created or the exception explaining why it was not.
+    """
+    results = [None] * len(users)
+    with DATABASE.transaction():
+        group_ids = _get_group_ids(
+            set(name for user in users for name in user.get('groups', [])))
+
+        pending = []
+        seen = set()
+        for index, user in enumerate(users):
+            if user['userid'] in seen:
+                results[index] = exceptions.UserAlreadyExistsException()
+            elif any(name not in group_ids for name in user.get('groups', [])):
+                results[index] = exceptions.GroupNotFoundException()
+            else:
+                seen.add(user['userid'])
+                pending.append(index)
+
+        if not pending:
+            return results
+
+        # unnest() turns three array parameters into one row per user, and
+        # ON CONFLICT skips userids that already exist instead of failing
+        # the whole batch.
+        cursor = DATABASE.execute_sql(_INSERT_USERS_SQL, (
+            [users[index]['userid'] for index in pending],
+            [users[index]['first_name'] for index in pending],
+            [users[index]['last_name'] for index in pending]))
+        user_ids = dict(cursor.fetchall())
+
+        memberships = []
+        for index in pending:
+            user = users[index]
+            user_id = user_ids.get(user['userid'])
+            if user_id is None:
+                results[index] = exceptions.UserAlreadyExistsException()
+                continue
+            memberships.extend({'user': user_id, 'group': group_ids[name]}
+                               for name in _unique(user.get('groups', [])))
+        if memberships:
+            UserGroups.insert_many(memberships).execute()
+            _record_changes(group_ids=[m['group'] for m in memberships])
+        _refresh_documents(user_ids=user_ids.values())
+
+    return results
+
+
+def _save_unique_user(db_user, only=None):
+    # The unique userid index decides conflicts, so two concurrent writes of
+    # the same userid cannot both pass a separate existence check. The
+    # savepoint keeps the surrounding transaction usable after the error.
+    try:
+        with DATABASE.atomic():
+            if only is None:
+                db_user.save()
+            else:
+                db_user.save(only=only)
+    except (peewee.IntegrityError, psycopg2.IntegrityError):
+        # Newer psycopg2 raises subclasses peewee does not wrap.
+        raise exceptions.UserAlreadyExistsException()
 
 
 def _save_user_fields(db_user, api_user):
     db_user.userid = api_user['userid']
     db_user.first_name = api_user['first_name']
     db_user.last_name = api_user['last_name']
-    db_user.save()
+    # version and modified_at were read without a lock, so writing them back
+    # could undo a concurrent write's bump; _record_changes bumps them.
+    _save_unique_user(db_user, only=[User.userid, User.first_name,
+                                     User.last_name])
 
 
 def _remove_unrequested_groups(user, requested_groups):
-    existing_groups = set()
-    for usergroup in user.usergroups:
-        if usergroup.group.name not in requested_groups:
-            usergroup.delete_instance()
-        else:
-            existing_groups.add(usergroup.group.name)
-    return existing_groups
+    """Returns the ids of the groups the user was removed from."""
+    query = (UserGroups.delete()
+                       .where(UserGroups.user == user)
+                       .returning(UserGroups.group)
+                       .tuples())
+    if requested_groups:
+        query = query.where(
+            ~(UserGroups.group == _any(requested_groups.values())))
+    return [group_id for group_id, in query.execute()]
 
 
-def _add_new_groups(user, requested_groups, existing_groups):
-    for name, group in requested_groups.iteritems():
-        if name not in existing_groups:
-            UserGroups(user=user, group=group).save()
+def _insert_memberships(query, returning):
+    """Inserts the (user id, group id) rows selected by query, skipping
+    memberships that already exist, and returns the returning column of
+    the rows actually inserted."""
+    # peewee cannot express ON CONFLICT, which must precede RETURNING.
+    sql, params = UserGroups.insert_from([UserGroups.user, UserGroups.group],
+                                         query).sql()
+    cursor = DATABASE.execute_sql(
+        '%s ON CONFLICT DO NOTHING RETURNING "%s"' %
+        (sql, returning.db_column), params)
+    return [value for value, in cursor.fetchall()]
 
 
-def update_user(userid, api_user):
-    db_user = get_user(userid)
+# Memberships are listed in id order, so they are inserted in the order
+# the groups were requested: WITH ORDINALITY numbers the requested ids.
+_ADD_GROUPS_SQL = (
+    'INSERT INTO usergroups (user_id, group_id) '
+    'SELECT %s, g.id FROM unnest(%s::integer[]) WITH ORDINALITY r(id, n) '
+    'JOIN "group" g ON g.id = r.id ORDER BY r.n '
+    'ON CONFLICT DO NOTHING RETURNING group_id')
 
-    if userid != api_user['userid'] and _user_exists(api_user['userid']):
-        raise exceptions.UserAlreadyExistsException()
 
-    requested_groups = _get_requested_groups(api_user)
+def _add_new_groups(user, requested_groups):
+    """Returns the ids of the groups the user was added to, in the order of
+    requested_groups."""
+    if not requested_groups:
+        return []
+    cursor = DATABASE.execute_sql(
+        _ADD_GROUPS_SQL, (user.id, list(requested_groups.values())))
+    return [group_id for group_id, in cursor.fetchall()]
+
+
+def _remove_memberships(column, ids, where):
+    """Deletes the memberships matching where whose column is one of ids,
+    returning the ids actually removed."""
+    if not ids:
+        return []
+    query = (UserGroups.delete()
+                       .where(where & (column == _any(ids)))
+                       .returning(column)
+                       .tuples())
+    return [value for value, in query.execute()]
+
 
-    _save_user_fields(db_user, api_user)
+def patch_user_groups(userid, add=(), remove=()):
+    """Adds a user to and removes it from groups and returns the names of
+    the groups it was actually added to and removed from, as
+    patch_group_members does for a group's members."""
+    with DATABASE.transaction():
+        version = _fetch_one(_GET_USER_VERSION, userid)
+        if version is None:
+            raise exceptions.UserNotFoundException()
+        user_id = version[0]
+        groups = _get_group_ids(_unique(list(add) + list(remove)))
+        if any(name not in groups for name in add):
+            raise exceptions.GroupNotFoundException()
 
-    existing_groups = _remove_unrequested_groups(db_user, requested_groups)
-    _add_new_groups(db_user, requested_groups, existing_groups)
+        added = _add_new_groups(
+            User(id=user_id),
+            collections.OrderedDict((name, groups[name])
+                                    for name in _unique(add)))
+        removed = _remove_memberships(
+            UserGroups.group,
+            [groups[name] for name in remove if name in groups],
+            UserGroups.user == user_id)
+        if added or removed:
+            _record_changes(user_ids=[user_id], group_ids=added + removed)
+
+    names = dict((group_id, name) for name, group_id in groups.items())
+    return ([names[group_id] for group_id in added],
+            [names[group_id] for group_id in removed])
+
+
+def update_user(userid, api_user):
+    with DATABASE.transaction():
+        db_user = _get_user(userid)
+        requested_groups = _get_requested_groups(api_user)
+
+        _save_user_fields(db_user, api_user)
+
+        changed_groups = _remove_unrequested_groups(db_user,
+                                                    requested_groups)
+        changed_groups += _add_new_groups(db_user, requested_groups)
+        deleted_users = []
+        if api_user['userid'] != userid:
+            # Renaming a user changes every member list it appears in.
+            changed_groups += requested_groups.values()
+            deleted_users.append(userid)
+        _record_changes(user_ids=[db_user.id], group_ids=changed_groups,
+                        deleted_users=deleted_users)
 
     return get_user(api_user['userid'])
 
 
 def delete_user(userid):
-    user = get_user(userid)
-    UserGroups.delete().where(UserGroups.user == user).execute()
-    User.delete().where(User.userid == userid).execute()
+    with DATABASE.transaction():
+        user = _get_user(userid)
+        removed = (UserGroups.delete()
+                             .where(UserGroups.user == user)
+                             .returning(UserGroups.group)
+                             .tuples()
+                             .execute())
+        group_ids = [group_id for group_id, in removed]
+        User.delete().where(User.userid == userid).execute()
+        _record_changes(group_ids=group_ids, deleted_users=[userid])
+
+
+def get_user_version(userid):
+    """Returns (id, version, modified_at) for a user from the userid index,
+    without loading its groups."""
+    version = _fetch_one(_GET_USER_VERSION, userid)
+    if version is None:
+        raise exceptions.UserNotFoundException
+    return version
+
+
+def get_user_document(userid):
+    """Returns ((id, version, modified_at), body) for a user from the userid
+    index and its document's primary key, body being None when the user
+    has no document."""
+    row = _fetch_one(_GET_USER_DOCUMENT, userid)
+    if row is None:
+        raise exceptions.UserNotFoundException
+    return row[:3], row[3]
 
 
 def get_group(name):
-    try:
-        return Group.get(Group.name == name)
-    except Group.DoesNotExist as dne:
+    group = _fetch_model(Group, _GET_GROUP, name)
+    if group is None:
         raise exceptions.UserNotFoundException
+    return group
+
+
+def get_group_version(name):
+    """Returns (id, version, modified_at) for a group from the name index,
+    without loading its members."""
+    version = _fetch_one(_GET_GROUP_VERSION, name)
+    if version is None:
+        raise exceptions.GroupNotFoundException
+    return version
+
+
+def get_group_document(name):
+    """Returns ((id, version, modified_at), body) for a group, body being
+    None when the group has no document."""
+    row = _fetch_one(_GET_GROUP_DOCUMENT, name)
+    if row is None:
+        raise exceptions.GroupNotFoundException
+    return row[:3], row[3]
+
+
+def iter_group_member_ids(group, server_side=True):
+    """Yields the userids of a group's members in user id order.
+
+    With server_side the rows come from a named cursor a batch at a time,
+    so memory stays flat however large the group is.
+    """
+    query = (User.select(User.userid)
+                 .join(UserGroups)
+                 .where(UserGroups.group == group)
+                 .order_by(UserGroups.user)
+                 .tuples())
+    if not server_side:
+        for userid, in query:
+            yield userid
+        return
+
+    # Iterating the named cursor directly fetches SERVER_SIDE_BATCH_SIZE rows
+    # per round trip; peewee's result wrapper would fetch them one by one.
+    sql, params = query.sql()
+    with DATABASE.atomic():
+        cursor = DATABASE.execute_sql(sql, params, require_commit=False,
+                                      named_cursor=True)
+        cursor.itersize = SERVER_SIDE_BATCH_SIZE
+        for userid, in cursor:
+            yield userid
+
+
+def list_groups(after=None, limit=100):
+    """Returns up to limit group dicts ordered by name, starting after the
+    given name."""
+    query = Group.select(Group.name).order_by(Group.name).limit(limit)
+    if after is not None:
+        query = query.where(Group.name > after)
+    return [{'name': name} for name, in query.tuples()]
+
+
+def _get_member_ids_by_group(group_ids):
+    if not group_ids:
+        return {}
+    member_ids = fn.array_agg(peewee.Clause(User.userid, peewee.SQL('ORDER BY'),
+                                            UserGroups.user))
+    return dict(UserGroups.select(UserGroups.group, member_ids)
+                          .join(User)
+                          .where(UserGroups.group == _any(group_ids))
+                          .group_by(UserGroups.group)
+                          .tuples())
+
+
+def get_groups(names):
+    """Returns (group dicts with their member userids, missing names) for
+    the given names, each in the order requested, with two queries however
+    many are asked for."""
+    names = _unique(names)
+    if not names:
+        return [], []
+    group_ids = _get_group_ids(names)
+    member_ids = _get_member_ids_by_group(list(group_ids.values()))
+    return ([{'name': name, 'members': member_ids.get(group_ids[name], [])}
+             for name in names if name in group_ids],
+            [name for name in names if name not in group_ids])
+
+
+def list_group_members(name, after=None, limit=100):
+    """Returns (user id, userid) tuples for up to limit members of a group,
+    ordered by user id and starting after the given user id."""
+    group_id = get_group_version(name)[0]
+    query = (UserGroups.select(UserGroups.user, User.userid)
+                       .join(User)
+                       .where(UserGroups.group == group_id)
+                       .order_by(UserGroups.user)
+                       .limit(limit)
+                       .tuples())
+    if after is not None:
+        # Bounding both sides of the join lets a merge join start at the
+        # cursor instead of scanning users from the beginning.
+        query = query.where((UserGroups.user > after) & (User.id > after))
+    return list(query)
+
+
+def list_user_groups(userid, after=None, limit=100):
+    """Returns (group id, name) tuples for up to limit groups of a user,
+    ordered by group id and starting after the given group id."""
+    rows = _LIST_USER_GROUPS.execute(DATABASE, after or 0, limit,
+                                     userid).fetchall()
+    if not rows:
+        raise exceptions.UserNotFoundException()
+    return [row for row in rows if row[0] is not None]
+
+
+def check_membership(name, userid):
+    """Raises unless the user is a member of the group, with one lookup
+    in each unique index whatever the size of either."""
+    group_id, user_id, is_member = _fetch_one(_GET_MEMBERSHIP, name, userid)
+    if group_id is None:
+        raise exceptions.GroupNotFoundException()
+    if user_id is None:
+        raise exceptions.UserNotFoundException()
+    if not is_member:
+        raise exceptions.MembershipNotFoundException()
 
 
 def create_group(name):
@@ -154,35 +1070,98 @@ def create_group(name):
         raise exceptions.GroupAlreadyExistsException()
 
     new_group = Group(name=name)
-    new_group.save()
+    with DATABASE.transaction():
+        new_group.save()
+        _refresh_documents(group_ids=[new_group.id])
     return new_group
 
 
+def _get_user_ids(userids):
+    if not userids:
+        return {}
+    return {user.userid: user.id for user in
+            User.select(User.id, User.userid)
+                .where(User.userid == _any(userids))}
+
+
+def _get_requested_users(member_ids):
+    requested_users = _get_user_ids(member_ids)
+    if len(requested_users) != len(set(member_ids)):
+        raise exceptions.UserNotFoundException()
+    return requested_users
+
+
 def _remove_unrequested_users(group, requested_users):
-    existing_users = set()
-    for usergroup in group.usergroups:
-        if usergroup.user.userid not in requested_users:
-            usergroup.delete_instance()
-        else:
-            existing_users.add(usergroup.user.userid)
-    return existing_users
+    """Returns the ids of the users removed from the group."""
+    query = (UserGroups.delete()
+                       .where(UserGroups.group == group)
+                       .returning(UserGroups.user)
+                       .tuples())
+    if requested_users:
+        query = query.where(
+            ~(UserGroups.user == _any(requested_users.values())))
+    return [user_id for user_id, in query.execute()]
 
 
-def _add_new_users(group, requested_users, existing_users):
-    for userid, user in requested_users.iteritems():
-        if userid not in existing_users:
-            UserGroups(user=user, group=group).save()
+def _add_new_users(group, requested_users):
+    """Returns the ids of the users added to the group."""
+    if not requested_users:
+        return []
+    new_users = (User.select(User.id, peewee.Param(group.id))
+                     .where(User.id == _any(requested_users.values())))
+    return _insert_memberships(new_users, UserGroups.user)
 
 
 def update_group(name, member_ids):
     group = get_group(name)
-    requested_users = {userid: get_user(userid) for userid in member_ids}
-    existing_users = _remove_unrequested_users(group, requested_users)
-    _add_new_users(group, requested_users, existing_users)
-    return get_group(name)
+    with DATABASE.transaction():
+        requested_users = _get_requested_users(member_ids)
+        changed_users = (_remove_unrequested_users(group, requested_users) +
+                         _add_new_users(group, requested_users))
+        _record_changes(user_ids=changed_users, group_ids=[group.id])
+    return group
+
+
+def patch_group_members(name, add=(), remove=()):
+    """Adds and removes members of a group and returns the userids that
+    were actually added and removed.
+
+    Each side is one statement keyed on the userids given, so the cost
+    follows the size of the change rather than of the group. Adding a
+    member or removing a non-member changes nothing; removing an unknown
+    userid is ignored, adding one raises.
+    """
+    with DATABASE.transaction():
+        version = _fetch_one(_GET_GROUP_VERSION, name)
+        if version is None:
+            raise exceptions.GroupNotFoundException()
+        group_id = version[0]
+        users = _get_user_ids(_unique(list(add) + list(remove)))
+        if any(userid not in users for userid in add):
+            raise exceptions.UserNotFoundException()
+
+        added = _add_new_users(
+            Group(id=group_id), dict((userid, users[userid]) for userid in add))
+        removed = _remove_memberships(
+            UserGroups.user,
+            [users[userid] for userid in remove if userid in users],
+            UserGroups.group == group_id)
+        if added or removed:
+            _record_changes(user_ids=added + removed, group_ids=[group_id])
+
+    userids = dict((user_id, userid) for userid, user_id in users.items())
+    return ([userids[user_id] for user_id in added],
+            [userids[user_id] for user_id in removed])
 
 
 def delete_group(name):
     group = get_group(name)
-    UserGroups.delete().where(UserGroups.group == group).execute()
-    group.delete_instance()
+    with DATABASE.transaction():
+        removed = (UserGroups.delete()
+                             .where(UserGroups.group == group)
+                             .returning(UserGroups.user)
+                             .tuples()
+                             .execute())
+        user_ids = [user_id for user_id, in removed]
+        group.delete_instance()
+        _record_changes(user_ids=user_ids, deleted_groups=[name])
@@ -2,6 +2,8 @@ import argparse
 import contextlib
 
 from userapi.db import api as db_api
+from userapi.db import dump
+from userapi.db import migrations
 
 
 @contextlib.contextmanager
@@ -14,9 +16,30 @@ def connect_database():
         database.close()
 
 
-def create_tables():
+def create_tables(args):
     with connect_database() as database:
-        db_api._create_tables(database)
+        migrations.create_tables(database)
+
+
+def migrate(args):
+    with connect_database() as database:
+        migrations.migrate(database)
+
+
+def refresh_documents(args):
+    with connect_database():
+        users, groups = db_api.refresh_all_documents()
+    print('Refreshed documents of %d users and %d groups.' % (users, groups))
+
+
+def export_tables(args):
+    with connect_database() as database:
+        dump.export_tables(database, args.directory)
+
+
+def import_tables(args):
+    with connect_database() as database:
+        dump.import_tables(database, args.directory)
 
 
 def main():
@@ -26,5 +49,24 @@ def main():
     create_tables_parser = subparsers.add_parser('create-tables')
     create_tables_parser.set_defaults(func=create_tables)
 
+    migrate_parser = subparsers.add_parser(
+        'migrate', help='Apply pending schema migrations online')
+    migrate_parser.set_defaults(func=migrate)
+
+    refresh_documents_parser = subparsers.add_parser(
+        'refresh-documents',
+        help='Rebuild every precomputed user and group document')
+    refresh_documents_parser.set_defaults(func=refresh_documents)
+
+    export_parser = subparsers.add_parser(
+        'export', help='Dump users, groups and memberships to CSV files')
+    export_parser.add_argument('directory')
+    export_parser.set_defaults(func=export_tables)
+
+    import_parser = subparsers.add_parser(
+        'import', help='Load CSV files written by export')
+    import_parser.add_argument('directory')
+    import_parser.set_defaults(func=import_tables)
+
     args = parser.parse_args()
-    args.func()
+    args.func(args)
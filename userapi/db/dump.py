@@ -0,0 +1,163 @@
+import os
+import sys
+import time
+
+from userapi import cache
+
+COPY_BUFFER_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 1.0
+
+USERS_FILE = 'users.csv'
+GROUPS_FILE = 'groups.csv'
+MEMBERSHIPS_FILE = 'memberships.csv'
+
+# Memberships are written as (userid, group name) pairs so a dump can be
+# loaded into a database whose surrogate ids differ.
+EXPORT_QUERIES = [
+    (USERS_FILE,
+     'SELECT userid, first_name, last_name FROM "user" ORDER BY id'),
+    (GROUPS_FILE,
+     'SELECT name FROM "group" ORDER BY id'),
+    (MEMBERSHIPS_FILE,
+     'SELECT u.userid, g.name FROM usergroups ug '
+     'JOIN "user" u ON u.id = ug.user_id '
+     'JOIN "group" g ON g.id = ug.group_id '
+     'ORDER BY ug.id'),
+]
+
+# (file, staging table, columns, statement merging the staged rows). Rows
+# are merged in file order so memberships keep their original ordering.
+IMPORT_TABLES = [
+    (USERS_FILE, 'import_users', ['userid', 'first_name', 'last_name'],
+     'INSERT INTO "user" (userid, first_name, last_name) '
+     'SELECT userid, first_name, last_name FROM import_users '
+     'ORDER BY position '
+     'ON CONFLICT (userid) DO UPDATE '
+     'SET first_name = EXCLUDED.first_name, last_name = EXCLUDED.last_name, '
+     'version = "user".version + 1, '
+     'modified_at = now() AT TIME ZONE \'UTC\''),
+    (GROUPS_FILE, 'import_groups', ['name'],
+     'INSERT INTO "group" (name) SELECT name FROM import_groups '
+     'ORDER BY position '
+     'ON CONFLICT (name) DO NOTHING'),
+    (MEMBERSHIPS_FILE, 'import_memberships', ['userid', 'name'],
+     'INSERT INTO usergroups (user_id, group_id) '
+     'SELECT u.id, g.id FROM import_memberships im '
+     'JOIN "user" u ON u.userid = im.userid '
+     'JOIN "group" g ON g.name = im.name '
+     'ORDER BY im.position '
+     'ON CONFLICT (user_id, group_id) DO NOTHING'),
+]
+
+# Bumps the version of every user and group named in the memberships file,
+# since their member and group lists may have grown.
+IMPORT_TOUCH_SQL = [
+    'UPDATE "user" SET version = version + 1, '
+    'modified_at = now() AT TIME ZONE \'UTC\' '
+    'WHERE userid IN (SELECT userid FROM import_memberships)',
+    'UPDATE "group" SET version = version + 1, '
+    'modified_at = now() AT TIME ZONE \'UTC\' '
+    'WHERE name IN (SELECT name FROM import_memberships)',
+    # Documents of changed rows are dropped rather than rebuilt, so reads
+    # fall back to the tables until "userapi-db refresh-documents" runs.
+    'DELETE FROM userdocument WHERE user_id IN (SELECT id FROM "user" '
+    'WHERE userid IN (SELECT userid FROM import_users '
+    'UNION SELECT userid FROM import_memberships))',
+    'DELETE FROM groupdocument WHERE group_id IN (SELECT id FROM "group" '
+    'WHERE name IN (SELECT name FROM import_memberships))',
+]
+
+
+class ProgressFile(object):
+    """Wraps a file and reports bytes transferred through it.
+
+    COPY streams through read()/write() in fixed size buffers, so neither
+    side ever holds more than one buffer of rows in memory.
+    """
+
+    def __init__(self, fileobj, label, total=None, out=sys.stderr):
+        self._file = fileobj
+        self._label = label
+        self._total = total
+        self._out = out
+        self._last_report = 0
+        self.bytes = 0
+
+    def _count(self, size):
+        self.bytes += size
+        now = time.time()
+        if now - self._last_report >= PROGRESS_INTERVAL:
+            self._last_report = now
+            self.report()
+
+    def report(self, rows=None):
+        message = '%s: %.1f MB' % (self._label, self.bytes / 1048576.0)
+        if self._total:
+            message += ' (%d%%)' % (100 * self.bytes / self._total)
+        if rows is not None:
+            message += ', %d rows' % rows
+        self._out.write(message + '\n')
+        self._out.flush()
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._count(len(data))
+        return data
+
+    def readline(self, size=-1):
+        data = self._file.readline(size)
+        self._count(len(data))
+        return data
+
+    def write(self, data):
+        self._file.write(data)
+        self._count(len(data))
+
+
+def export_tables(database, directory, out=sys.stderr):
+    """Writes users, groups and memberships to CSV files in directory."""
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    with database.atomic():
+        # One repeatable read snapshot keeps the three files consistent.
+        database.execute_sql('SET TRANSACTION ISOLATION LEVEL '
+                             'REPEATABLE READ, READ ONLY')
+        for filename, query in EXPORT_QUERIES:
+            with open(os.path.join(directory, filename), 'wb') as f:
+                progress = ProgressFile(f, filename, out=out)
+                cursor = database.get_cursor()
+                cursor.copy_expert(
+                    'COPY (%s) TO STDOUT WITH (FORMAT csv, HEADER true)' %
+                    query, progress, size=COPY_BUFFER_SIZE)
+                progress.report(rows=cursor.rowcount)
+
+
+def import_tables(database, directory, out=sys.stderr):
+    """Loads files written by export_tables in a single transaction.
+
+    Existing users are updated, existing groups and memberships are kept.
+    """
+    with database.atomic():
+        for filename, table, columns, merge_sql in IMPORT_TABLES:
+            path = os.path.join(directory, filename)
+            database.execute_sql(
+                'CREATE TEMPORARY TABLE %s (position bigserial, %s) '
+                'ON COMMIT DROP' %
+                (table, ', '.join('%s text' % c for c in columns)))
+            with open(path, 'rb') as f:
+                progress = ProgressFile(f, filename,
+                                        total=os.path.getsize(path), out=out)
+                cursor = database.get_cursor()
+                cursor.copy_expert(
+                    'COPY %s (%s) FROM STDIN WITH (FORMAT csv, HEADER true)' %
+                    (table, ', '.join(columns)), progress,
+                    size=COPY_BUFFER_SIZE)
+            cursor = database.execute_sql(merge_sql)
+            progress.report(rows=cursor.rowcount)
+        for sql in IMPORT_TOUCH_SQL:
+            database.execute_sql(sql)
+        # Sent even when this process has no cache configured, since the
+        # API processes may.
+        database.execute_sql('SELECT pg_notify(%s, %s)', (
+            cache.CHANNEL,
+            cache.invalidation_payload(flush=[cache.USERS, cache.GROUPS])))
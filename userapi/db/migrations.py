@@ -0,0 +1,184 @@
+"""Versioned schema changes for databases created by older releases.
+
+Every step is idempotent, so a migration interrupted part way can simply be
+run again. Steps that would block reads or writes on a large table are
+avoided: columns are added with constant defaults (a catalog only change),
+indexes are built and dropped CONCURRENTLY, and statements needing a table
+lock give up after LOCK_TIMEOUT instead of queueing behind long
+transactions, then retry.
+"""
+import sys
+import time
+
+import psycopg2
+
+from userapi.db import api as db_api
+
+MIGRATIONS_TABLE = 'schema_migrations'
+# Serializes concurrent "userapi-db migrate" runs.
+ADVISORY_LOCK_ID = 0x75736572
+LOCK_TIMEOUT = '5s'
+LOCK_RETRIES = 5
+LOCK_RETRY_INTERVAL = 1.0
+LOCK_NOT_AVAILABLE = '55P03'
+
+
+class Statement(object):
+    """SQL run in its own transaction with a lock timeout."""
+
+    def __init__(self, sql):
+        self.sql = sql
+
+    def apply(self, database):
+        for attempt in range(LOCK_RETRIES):
+            try:
+                with database.atomic():
+                    database.execute_sql('SET LOCAL lock_timeout = %s',
+                                         (LOCK_TIMEOUT,))
+                    database.execute_sql(self.sql)
+                return
+            except psycopg2.OperationalError as e:
+                if (e.pgcode != LOCK_NOT_AVAILABLE or
+                        attempt == LOCK_RETRIES - 1):
+                    raise
+            time.sleep(LOCK_RETRY_INTERVAL)
+
+    def __str__(self):
+        return self.sql
+
+
+class Concurrently(Statement):
+    """SQL which cannot run inside a transaction block, such as
+    CREATE INDEX CONCURRENTLY."""
+
+    def apply(self, database):
+        conn = database.get_conn()
+        conn.autocommit = True
+        try:
+            database.execute_sql(self.sql, require_commit=False)
+        finally:
+            conn.autocommit = False
+
+
+class CreateIndex(Concurrently):
+    def __init__(self, name, table, columns, unique=False):
+        self.name = name
+        super(CreateIndex, self).__init__(
+            'CREATE %sINDEX CONCURRENTLY IF NOT EXISTS "%s" ON "%s" (%s)' %
+            ('UNIQUE ' if unique else '', name, table,
+             ', '.join('"%s"' % c for c in columns)))
+
+    def apply(self, database):
+        # A failed concurrent build leaves an invalid index behind, which
+        # IF NOT EXISTS would otherwise mistake for a finished one.
+        cursor = database.execute_sql(
+            'SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid '
+            'WHERE c.relname = %s AND NOT i.indisvalid', (self.name,))
+        if cursor.fetchone():
+            Concurrently('DROP INDEX CONCURRENTLY IF EXISTS "%s"' %
+                         self.name).apply(database)
+        super(CreateIndex, self).apply(database)
+
+
+class Migration(object):
+    def __init__(self, version, name, steps):
+        self.version = version
+        self.name = name
+        self.steps = steps
+
+
+MIGRATIONS = [
+    Migration(1, 'Add row versions to users and groups', [
+        Statement('ALTER TABLE "%s" '
+                  'ADD COLUMN IF NOT EXISTS version bigint NOT NULL '
+                  'DEFAULT 1, '
+                  'ADD COLUMN IF NOT EXISTS modified_at timestamp NOT NULL '
+                  'DEFAULT (now() AT TIME ZONE \'UTC\')' % table)
+        for table in ('user', 'group')
+    ]),
+    Migration(2, 'Make memberships unique in both column orders', [
+        # Duplicates would fail the unique builds below.
+        Statement('DELETE FROM usergroups a USING usergroups b '
+                  'WHERE a.user_id = b.user_id AND a.group_id = b.group_id '
+                  'AND a.id > b.id'),
+        CreateIndex('usergroups_user_id_group_id', 'usergroups',
+                    ['user_id', 'group_id'], unique=True),
+        # Replaces the non-unique (group_id, user_id) index under its name.
+        CreateIndex('usergroups_group_id_user_id_unique', 'usergroups',
+                    ['group_id', 'user_id'], unique=True),
+        Concurrently('DROP INDEX CONCURRENTLY IF EXISTS '
+                     '"usergroups_group_id_user_id"'),
+        Statement('ALTER INDEX IF EXISTS "usergroups_group_id_user_id_unique" '
+                  'RENAME TO "usergroups_group_id_user_id"'),
+        # Both are prefixes of the composite indexes.
+        Concurrently('DROP INDEX CONCURRENTLY IF EXISTS "usergroups_user_id"'),
+        Concurrently('DROP INDEX CONCURRENTLY IF EXISTS "usergroups_group_id"'),
+    ]),
+    # The tables start empty; "userapi-db refresh-documents" fills them.
+    Migration(3, 'Add precomputed user and group documents', [
+        Statement('CREATE TABLE IF NOT EXISTS "%sdocument" ('
+                  '"%s_id" integer NOT NULL PRIMARY KEY '
+                  'REFERENCES "%s" ("id") ON DELETE CASCADE, '
+                  '"body" text NOT NULL)' % (table, table, table))
+        for table in ('user', 'group')
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _create_migrations_table(database):
+    database.execute_sql(
+        'CREATE TABLE IF NOT EXISTS %s ('
+        'version integer PRIMARY KEY, '
+        'name text NOT NULL, '
+        'applied_at timestamp NOT NULL DEFAULT (now() AT TIME ZONE \'UTC\'))'
+        % MIGRATIONS_TABLE)
+
+
+def _record(database, migration):
+    database.execute_sql(
+        'INSERT INTO %s (version, name) VALUES (%%s, %%s) '
+        'ON CONFLICT (version) DO NOTHING' % MIGRATIONS_TABLE,
+        (migration.version, migration.name))
+
+
+def applied_versions(database):
+    cursor = database.execute_sql('SELECT version FROM %s' % MIGRATIONS_TABLE)
+    return set(version for version, in cursor.fetchall())
+
+
+def create_tables(database):
+    """Creates any missing tables.
+
+    Tables created here already have the latest schema, so a new database is
+    marked fully migrated. Existing tables are left for migrate().
+    """
+    fresh = not db_api.User.table_exists()
+    db_api._create_tables(database)
+    _create_migrations_table(database)
+    if fresh:
+        for migration in MIGRATIONS:
+            _record(database, migration)
+
+
+def migrate(database, out=sys.stderr):
+    """Applies every migration not yet recorded, oldest first."""
+    _create_migrations_table(database)
+    database.execute_sql('SELECT pg_advisory_lock(%s)', (ADVISORY_LOCK_ID,))
+    try:
+        applied = applied_versions(database)
+        for migration in MIGRATIONS:
+            if migration.version in applied:
+                continue
+            out.write('Applying migration %d: %s\n' %
+                      (migration.version, migration.name))
+            for step in migration.steps:
+                out.write('  %s\n' % step)
+                out.flush()
+                step.apply(database)
+            _record(database, migration)
+        out.write('Schema is at version %d.\n' % LATEST_VERSION)
+    finally:
+        database.execute_sql('SELECT pg_advisory_unlock(%s)',
+                             (ADVISORY_LOCK_ID,))
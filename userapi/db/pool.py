@@ -0,0 +1,270 @@
+import collections
+import logging
+import os
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions as pg_extensions
+from playhouse import postgres_ext
+
+from userapi import exceptions
+from userapi import timing
+from userapi.db import slowlog
+
+LOG = logging.getLogger(__name__)
+
+STAT_NAMES = ['checkouts', 'connections_created', 'connections_reused',
+              'connections_closed', 'waits', 'exhausted']
+
+
+class PooledPostgresqlExtDatabase(postgres_ext.PostgresqlExtDatabase):
+    """PostgresqlExtDatabase which can keep connections open between requests.
+
+    Pooling is disabled while max_connections is 0, in which case every
+    close() really closes the connection, exactly like the parent class.
+
+    stale_timeout bounds the total age of a pooled connection and
+    idle_timeout bounds how long it may sit unused in the pool. When every
+    connection is checked out, connect() waits up to wait_timeout seconds
+    for one to be returned before raising DatabasePoolExhaustedException.
+
+    The pool remembers the pid it was populated in. Connections inherited
+    across a fork (e.g. gunicorn --preload) are dropped, never closed, so
+    the parent's sockets are left alone.
+
+    Every statement and commit is timed and reported to userapi.timing,
+    and slow statements to userapi.db.slowlog.
+
+    Connections go to the primary unless route() sends a thread's next
+    ones to a replica. Each server has its own idle connections, while
+    max_connections counts them all.
+    """
+
+    def __init__(self, database, max_connections=0, stale_timeout=None,
+                 idle_timeout=None, wait_timeout=0, **kwargs):
+        self.max_connections = max_connections
+        self.stale_timeout = stale_timeout
+        self.idle_timeout = idle_timeout
+        self.wait_timeout = wait_timeout
+        self._route = threading.local()
+        self._reset_pool()
+        super(PooledPostgresqlExtDatabase, self).__init__(database, **kwargs)
+
+    def init(self, database, max_connections=None, stale_timeout=None,
+             idle_timeout=None, wait_timeout=None, **connect_kwargs):
+        if max_connections is not None:
+            self.max_connections = max_connections
+        if stale_timeout is not None:
+            self.stale_timeout = stale_timeout
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if wait_timeout is not None:
+            self.wait_timeout = wait_timeout
+        super(PooledPostgresqlExtDatabase, self).init(database,
+                                                      **connect_kwargs)
+
+    def _reset_pool(self):
+        self._pid = os.getpid()
+        self._pool_lock = threading.Condition(threading.Lock())
+        # Replica key, None for the primary -> idle connections as
+        # (created_at, returned_at, conn), newest last.
+        self._idle = collections.defaultdict(list)
+        # id(conn) -> (created_at, replica key) for every checked out
+        # connection.
+        self._in_use = {}
+        self._reserved = 0
+        self._stats = collections.Counter()
+        self._wait_time = 0.0
+
+    @property
+    def pooled(self):
+        return bool(self.max_connections)
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            LOG.debug('Process forked, discarding inherited pool.')
+            self._reset_pool()
+
+    def _wait_for_slot(self):
+        with self._pool_lock:
+            if len(self._in_use) + self._reserved < self.max_connections:
+                self._reserved += 1
+                return
+
+            self._stats['waits'] += 1
+            start = time.time()
+            deadline = start + (self.wait_timeout or 0)
+            while len(self._in_use) + self._reserved >= self.max_connections:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self._wait_time += time.time() - start
+                    self._stats['exhausted'] += 1
+                    raise exceptions.DatabasePoolExhaustedException()
+                self._pool_lock.wait(remaining)
+            self._wait_time += time.time() - start
+            self._reserved += 1
+
+    def _release_slot(self):
+        with self._pool_lock:
+            self._reserved = max(0, self._reserved - 1)
+            self._pool_lock.notify()
+
+    def connect(self):
+        if not self.pooled:
+            return super(PooledPostgresqlExtDatabase, self).connect()
+
+        self._check_pid()
+        self._wait_for_slot()
+        try:
+            super(PooledPostgresqlExtDatabase, self).connect()
+        except Exception:
+            self._release_slot()
+            raise
+
+    def _is_expired(self, now, created_at, returned_at=None):
+        if self.stale_timeout and now - created_at > self.stale_timeout:
+            return True
+        if (returned_at is not None and self.idle_timeout and
+                now - returned_at > self.idle_timeout):
+            return True
+        return False
+
+    def route(self, replica):
+        """Sends this thread's next connections to replica, a
+        userapi.db.replicas.Replica, or to the primary when None.
+
+        When a replica cannot be connected to it is marked down and the
+        primary is used instead.
+        """
+        self._route.replica = replica
+
+    def routed_replica(self):
+        """Returns the replica this thread's connection is open to, or None
+        for the primary."""
+        return getattr(self._route, 'connected', None)
+
+    def _pop_idle(self, key):
+        now = time.time()
+        idle = self._idle[key]
+        while idle:
+            created_at, returned_at, conn = idle.pop()
+            if conn.closed or self._is_expired(now, created_at, returned_at):
+                self._close_conn(conn)
+                continue
+            return created_at, conn
+        return None, None
+
+    def _close_conn(self, conn):
+        self._stats['connections_closed'] += 1
+        try:
+            conn.close()
+        except Exception:
+            LOG.debug('Error closing pooled connection.', exc_info=True)
+
+    def _connect(self, database, **kwargs):
+        replica = getattr(self._route, 'replica', None)
+        if replica is not None:
+            try:
+                conn = self._connect_to(replica.key,
+                                        *replica.connect_args(database,
+                                                              kwargs))
+                self._route.connected = replica
+                return conn
+            except psycopg2.OperationalError:
+                LOG.warning('Could not connect to replica %s, using the '
+                            'primary.', replica.name, exc_info=True)
+                replica.mark_down()
+        self._route.connected = None
+        return self._connect_to(None, database, kwargs)
+
+    def _connect_to(self, key, database, kwargs):
+        if not self.pooled:
+            return super(PooledPostgresqlExtDatabase, self)._connect(
+                database, **kwargs)
+
+        with self._pool_lock:
+            created_at, conn = self._pop_idle(key)
+            if conn is not None:
+                self._stats['connections_reused'] += 1
+
+        if conn is None:
+            conn = super(PooledPostgresqlExtDatabase, self)._connect(
+                database, **kwargs)
+            created_at = time.time()
+            with self._pool_lock:
+                self._stats['connections_created'] += 1
+
+        with self._pool_lock:
+            # The slot reserved by connect() is now held by this connection.
+            self._reserved = max(0, self._reserved - 1)
+            self._in_use[id(conn)] = (created_at, key)
+            self._stats['checkouts'] += 1
+        return conn
+
+    def _close(self, conn):
+        if not self.pooled:
+            return super(PooledPostgresqlExtDatabase, self)._close(conn)
+
+        with self._pool_lock:
+            created_at, key = self._in_use.pop(id(conn), (None, None))
+            if created_at is None:
+                # Either already returned or checked out before a fork.
+                return
+            self._pool_lock.notify()
+
+            if conn.closed or self._is_expired(time.time(), created_at):
+                self._close_conn(conn)
+                return
+
+            status = conn.get_transaction_status()
+            if status != pg_extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    self._close_conn(conn)
+                    return
+            self._idle[key].append((created_at, time.time(), conn))
+
+    def execute_sql(self, sql, params=None, require_commit=True, **kwargs):
+        # The autocommit is issued here rather than by the parent so that
+        # commit() times it apart from the statement.
+        start = time.time()
+        failed = True
+        try:
+            cursor = super(PooledPostgresqlExtDatabase, self).execute_sql(
+                sql, params, False, **kwargs)
+            failed = False
+        finally:
+            elapsed = time.time() - start
+            timing.record_query(elapsed)
+            slowlog.statement_finished(self, sql, params, elapsed, failed)
+        if require_commit and self.get_autocommit():
+            with self.exception_wrapper():
+                self.commit()
+        return cursor
+
+    def commit(self):
+        start = time.time()
+        try:
+            super(PooledPostgresqlExtDatabase, self).commit()
+        finally:
+            timing.record(timing.DB, time.time() - start)
+
+    def close_all(self):
+        """Close every idle connection held by the pool."""
+        with self._pool_lock:
+            for idle in self._idle.values():
+                while idle:
+                    _, _, conn = idle.pop()
+                    self._close_conn(conn)
+
+    def pool_stats(self):
+        with self._pool_lock:
+            stats = dict((name, self._stats[name]) for name in STAT_NAMES)
+            stats.update({'max_connections': self.max_connections,
+                          'in_use': len(self._in_use),
+                          'idle': sum(len(idle)
+                                      for idle in self._idle.values()),
+                          'wait_time': self._wait_time})
+        return stats
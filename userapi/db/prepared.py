@@ -0,0 +1,56 @@
+import threading
+import weakref
+
+
+class PreparedQuery(object):
+    """A fixed shape query run as a server side prepared statement.
+
+    The SQL is generated from a peewee query once, when the statement is
+    defined; every parameter of that query becomes a statement parameter.
+    Each pooled connection PREPAREs the statement the first time it runs
+    it, so PostgreSQL parses and plans it once per connection rather than
+    once per call. A connection replacing a closed one prepares it again.
+
+    Without pooling each connection serves a single request, so preparing
+    would only add a round trip and the SQL is sent as is.
+    """
+
+    def __init__(self, name, query):
+        sql, params = query.sql()
+        self.name = name
+        self.sql = sql
+        placeholders = tuple('$%d' % i for i in range(1, len(params) + 1))
+        self.prepare_sql = 'PREPARE %s AS %s' % (name, sql % placeholders)
+        self.execute_sql = 'EXECUTE %s (%s)' % (
+            name, ', '.join(['%s'] * len(params)))
+
+    def execute(self, database, *params):
+        """Runs the statement with params and returns the cursor."""
+        if not database.pooled:
+            return database.execute_sql(self.sql, params,
+                                        require_commit=False)
+        conn = database.get_conn()
+        if not is_prepared(conn, self.name):
+            # A prepared statement outlives the transaction creating it,
+            # even one that is rolled back, so it is marked once PREPARE
+            # has succeeded.
+            database.execute_sql(self.prepare_sql, require_commit=False)
+            _mark_prepared(conn, self.name)
+        return database.execute_sql(self.execute_sql, params,
+                                    require_commit=False)
+
+
+# connection -> names of the statements prepared on it. Closed connections
+# drop out once they are garbage collected.
+_prepared = weakref.WeakKeyDictionary()
+_prepared_lock = threading.Lock()
+
+
+def is_prepared(conn, name):
+    with _prepared_lock:
+        return name in _prepared.get(conn, ())
+
+
+def _mark_prepared(conn, name):
+    with _prepared_lock:
+        _prepared.setdefault(conn, set()).add(name)
@@ -0,0 +1,269 @@
+"""Sends reads to PostgreSQL streaming replicas.
+
+POSTGRES_REPLICAS lists replicas as libpq connection strings separated by
+commas, e.g. "host=replica1,host=replica2 port=5433". Settings a replica
+leaves out, such as the user and password, are those of the primary.
+
+Each process checks every replica every REPLICA_CHECK_INTERVAL seconds
+from a background thread, after reading the primary's WAL position. It
+keeps one connection open to each server between checks. A replica's lag
+is the time since the primary first wrote past the position the replica
+has replayed, so an idle primary does not make it look behind and a
+replica cut off from the primary does. A replica is in rotation while it
+answers, is still in recovery and lags no more than REPLICA_MAX_LAG
+seconds. Until its first check it is not.
+
+Writes return the primary's WAL position once they have committed. A read
+that carries one only goes to a replica known to have replayed that far,
+and to the primary otherwise, so a client always sees its own writes.
+"""
+import collections
+import logging
+import os
+import random
+import threading
+import time
+
+import psycopg2
+from psycopg2 import extensions as pg_extensions
+
+LOG = logging.getLogger(__name__)
+
+PRIMARY_SQL = 'SELECT pg_current_wal_insert_lsn()'
+REPLICA_SQL = 'SELECT pg_is_in_recovery(), pg_last_wal_replay_lsn()'
+
+REPLICAS = []
+MAX_LAG = 5.0
+CHECK_INTERVAL = 1.0
+CONNECT_TIMEOUT = 2
+
+_monitor = None
+_monitor_lock = threading.Lock()
+
+
+class Connection(object):
+    """An autocommit connection opened on first use and again after an
+    error."""
+
+    def __init__(self, database, kwargs):
+        self._database = database
+        self._kwargs = dict(kwargs)
+        self._kwargs.setdefault('connect_timeout', CONNECT_TIMEOUT)
+        self._conn = None
+
+    def _execute(self, sql):
+        if self._conn is None:
+            self._conn = psycopg2.connect(database=self._database,
+                                          **self._kwargs)
+            self._conn.autocommit = True
+        try:
+            cursor = self._conn.cursor()
+            cursor.execute(sql)
+            return cursor.fetchone()
+        except psycopg2.Error:
+            self.close()
+            raise
+
+    def query(self, sql):
+        """Returns the first row of sql. A connection kept from an earlier
+        query that has since been lost, e.g. by a server restart, is
+        replaced once."""
+        reused = self._conn is not None
+        try:
+            return self._execute(sql)
+        except (psycopg2.OperationalError, psycopg2.InterfaceError):
+            if not reused:
+                raise
+        return self._execute(sql)
+
+    def close(self):
+        conn, self._conn = self._conn, None
+        if conn is not None:
+            try:
+                conn.close()
+            except Exception:
+                pass
+
+
+def lag(samples, position, now):
+    """Returns the seconds since the primary first wrote past position,
+    given (time, primary position) samples, oldest first.
+
+    Returns None when that is unknown: without samples, or when the
+    primary was already past position at the oldest one.
+    """
+    if not samples or position is None or samples[0][1] > position:
+        return None
+    for taken_at, primary_position in samples:
+        if primary_position > position:
+            return now - taken_at
+    return 0.0
+
+
+def parse_position(position):
+    """Returns a WAL position such as "16/B374D848" as a number, or None
+    when it is not one."""
+    try:
+        high, low = position.split('/')
+        return (int(high, 16) << 32) + int(low, 16)
+    except (AttributeError, ValueError):
+        return None
+
+
+class Replica(object):
+    def __init__(self, dsn):
+        self.dsn = dsn
+        self.key = dsn
+        self.settings = pg_extensions.parse_dsn(dsn)
+        self.name = '%s:%s' % (self.settings.get('host', ''),
+                               self.settings.get('port', 5432))
+        self.healthy = False
+        self.lag = None
+        self.position = None
+        self.checked_at = None
+        self.error = None
+
+    def connect_args(self, database, kwargs):
+        """Returns the database and connect keyword arguments of this
+        replica, filled in from the primary's."""
+        kwargs = dict(kwargs)
+        settings = dict(self.settings)
+        database = settings.pop('dbname', database)
+        kwargs.update(settings)
+        return database, kwargs
+
+    def mark_down(self, error=None):
+        self.healthy = False
+        self.error = error
+
+    def check(self, query, samples):
+        """Updates the replica's status, query running SQL on the replica
+        and samples being the primary's recent (time, position), oldest
+        first."""
+        try:
+            in_recovery, position = query(REPLICA_SQL)
+        except psycopg2.Error as e:
+            self.mark_down(str(e).strip().splitlines()[0])
+            return
+        finally:
+            self.checked_at = time.time()
+
+        self.position = parse_position(position)
+        self.lag = lag(samples, self.position, self.checked_at)
+        if not in_recovery:
+            self.mark_down('not in recovery')
+        elif self.lag is None and samples:
+            self.mark_down('more than %.1f seconds behind' %
+                           (self.checked_at - samples[0][0]))
+        elif self.lag is None:
+            self.mark_down('primary position unknown')
+        elif self.lag > MAX_LAG:
+            self.mark_down('%.1f seconds behind' % self.lag)
+        else:
+            self.healthy = True
+            self.error = None
+
+    def to_dict(self):
+        return {'name': self.name,
+                'healthy': self.healthy,
+                'lag': self.lag,
+                'position': self.position,
+                'checked_at': self.checked_at,
+                'error': self.error}
+
+
+def configure(dsns=None, max_lag=None, check_interval=None):
+    """Applies the arguments, falling back to the POSTGRES_REPLICAS and
+    REPLICA_* environment variables."""
+    global REPLICAS, MAX_LAG, CHECK_INTERVAL
+    if dsns is None:
+        dsns = [dsn.strip() for dsn in
+                os.environ.get('POSTGRES_REPLICAS', '').split(',')]
+    if max_lag is None:
+        max_lag = float(os.environ.get('REPLICA_MAX_LAG', 5))
+    if check_interval is None:
+        check_interval = float(os.environ.get('REPLICA_CHECK_INTERVAL', 1))
+    REPLICAS = [Replica(dsn) for dsn in dsns if dsn]
+    MAX_LAG = max_lag
+    CHECK_INTERVAL = check_interval
+
+
+def enabled():
+    return bool(REPLICAS)
+
+
+def choose(position=None):
+    """Returns a random replica in rotation that has replayed up to
+    position, a number from parse_position(), or None for the primary."""
+    candidates = [replica for replica in REPLICAS if replica.healthy and
+                  (position is None or (replica.position is not None and
+                                        replica.position >= position))]
+    if not candidates:
+        return None
+    return random.choice(candidates)
+
+
+def stats():
+    return [replica.to_dict() for replica in REPLICAS]
+
+
+class Monitor(threading.Thread):
+    """Checks every replica each CHECK_INTERVAL seconds."""
+
+    def __init__(self, database):
+        super(Monitor, self).__init__(name='userapi-replica-monitor')
+        self.daemon = True
+        self.pid = os.getpid()
+        self.samples = collections.deque()
+        self._database = database
+        # Replica key, None for the primary -> Connection.
+        self._connections = {}
+
+    def _connection(self, key, database, kwargs):
+        if key not in self._connections:
+            self._connections[key] = Connection(database, kwargs)
+        return self._connections[key]
+
+    def check(self):
+        database = self._database.database
+        kwargs = self._database.connect_kwargs
+        now = time.time()
+        try:
+            position, = self._connection(None, database, kwargs).query(
+                PRIMARY_SQL)
+            self.samples.append((now, parse_position(position)))
+        except psycopg2.Error:
+            LOG.warning('Reading the primary WAL position failed.',
+                        exc_info=True)
+        # The newest sample at least MAX_LAG old is kept, as the one that
+        # decides whether a replica is too far behind.
+        while (len(self.samples) > 1 and
+               self.samples[1][0] <= now - MAX_LAG):
+            self.samples.popleft()
+        for replica in REPLICAS:
+            connection = self._connection(
+                replica.key, *replica.connect_args(database, kwargs))
+            replica.check(connection.query, self.samples)
+
+    def run(self):
+        while True:
+            try:
+                self.check()
+            except Exception:
+                LOG.warning('Checking replicas failed.', exc_info=True)
+            time.sleep(CHECK_INTERVAL)
+
+
+def start_monitor(database):
+    """Starts this process' monitor once; safe to call on every request
+    and after a fork."""
+    global _monitor
+    if not REPLICAS:
+        return
+    with _monitor_lock:
+        if _monitor is None or _monitor.pid != os.getpid():
+            _monitor = Monitor(database)
+            _monitor.start()
+
+
+configure()
@@ -0,0 +1,133 @@
+"""Logs statements slower than SLOW_QUERY_THRESHOLD seconds.
+
+Each slow statement is logged as one JSON line with its SQL, parameters,
+duration and the route of the request that ran it. With
+SLOW_QUERY_REDACT, parameters are replaced by their type names.
+
+A SLOW_QUERY_EXPLAIN_RATE fraction of slow statements that succeeded
+also get their plan captured with EXPLAIN (ANALYZE, BUFFERS), which runs
+the statement a second time inside a savepoint that is then rolled back.
+When running it again fails, e.g. an INSERT hitting the row it just
+inserted, the plan comes from a plain EXPLAIN instead.
+
+Lines go to stderr, or are appended to SLOW_QUERY_LOG_FILE by every
+worker process. The file is not rotated here, as one process rotating it
+would lose the others' lines; it is reopened once rotated away, e.g. by
+logrotate.
+"""
+import datetime
+import json
+import logging
+from logging import handlers
+import os
+import random
+import sys
+
+import psycopg2
+from psycopg2 import extensions as pg_extensions
+
+from userapi import timing
+
+LOG = logging.getLogger('userapi.slow_query')
+
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'VALUES',
+               'EXECUTE')
+
+THRESHOLD = 0
+REDACT = False
+EXPLAIN_RATE = 0.0
+
+
+def configure(threshold=None, redact=None, explain_rate=None, log_file=None):
+    """Applies the arguments, falling back to the SLOW_QUERY_* environment
+    variables. A threshold of 0 disables the log."""
+    global THRESHOLD, REDACT, EXPLAIN_RATE
+    if threshold is None:
+        threshold = float(os.environ.get('SLOW_QUERY_THRESHOLD', 0))
+    if redact is None:
+        redact = bool(int(os.environ.get('SLOW_QUERY_REDACT', 0)))
+    if explain_rate is None:
+        explain_rate = float(os.environ.get('SLOW_QUERY_EXPLAIN_RATE', 0))
+    if log_file is None:
+        log_file = os.environ.get('SLOW_QUERY_LOG_FILE')
+
+    for handler in list(LOG.handlers):
+        LOG.removeHandler(handler)
+        handler.close()
+    if threshold:
+        if log_file:
+            handler = handlers.WatchedFileHandler(log_file)
+        else:
+            handler = logging.StreamHandler(sys.stderr)
+        LOG.addHandler(handler)
+        LOG.setLevel(logging.INFO)
+        LOG.propagate = False
+
+    THRESHOLD = threshold
+    REDACT = redact
+    EXPLAIN_RATE = explain_rate
+
+
+def _redact(value):
+    if isinstance(value, (list, tuple)):
+        return '<%s of %d>' % (type(value).__name__, len(value))
+    return '<%s>' % type(value).__name__
+
+
+def _json_default(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+    return repr(value)
+
+
+def statement_finished(database, sql, params, elapsed, failed):
+    """Logs the statement just run by database if it was slow. Called for
+    every statement, so returns at once when it was not."""
+    if not THRESHOLD or elapsed < THRESHOLD:
+        return
+    params = list(params or ())
+    timer = timing.current()
+    entry = {
+        'sql': sql,
+        'params': [_redact(p) for p in params] if REDACT else params,
+        'duration_ms': round(elapsed * 1000, 3),
+        'route': timer.route if timer is not None else None,
+        'failed': failed,
+    }
+    if not failed and EXPLAIN_RATE and random.random() < EXPLAIN_RATE:
+        try:
+            entry.update(explain(database.get_conn(), sql, params))
+        except Exception:
+            LOG.debug('Could not explain slow statement.', exc_info=True)
+    LOG.info(json.dumps(entry, sort_keys=True, default=_json_default))
+
+
+def explain(conn, sql, params):
+    """Returns {'plan': text, 'analyzed': bool} for sql, or {} when it
+    cannot be explained on conn."""
+    words = sql.split(None, 1)
+    if not words or words[0].upper() not in EXPLAINABLE:
+        return {}
+    if (conn.get_transaction_status() ==
+            pg_extensions.TRANSACTION_STATUS_INERROR):
+        return {}
+
+    cursor = conn.cursor()
+    for prefix, analyzed in (('EXPLAIN (ANALYZE, BUFFERS) ', True),
+                             ('EXPLAIN ', False)):
+        # Opens a transaction if there is none, so everything the statement
+        # does again can be undone.
+        cursor.execute('SAVEPOINT userapi_explain')
+        try:
+            cursor.execute(prefix + sql, params)
+            plan = '\n'.join(row for row, in cursor.fetchall())
+        except psycopg2.Error:
+            plan = None
+        cursor.execute('ROLLBACK TO SAVEPOINT userapi_explain')
+        cursor.execute('RELEASE SAVEPOINT userapi_explain')
+        if plan is not None:
+            return {'plan': plan, 'analyzed': analyzed}
+    return {}
+
+
+configure()
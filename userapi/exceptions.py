@@ -14,6 +14,10 @@ class ConflictException(BaseAPIException):
     status_code = 409
 
 
+class ServiceUnavailableException(BaseAPIException):
+    status_code = 503
+
+
 class MissingRequiredFieldException(InvalidRequestException):
     pass
 
@@ -32,3 +36,15 @@ class UserNotFoundException(NotFoundException):
 
 class GroupNotFoundException(NotFoundException):
     pass
+
+
+class MembershipNotFoundException(NotFoundException):
+    pass
+
+
+class TransactionConflictException(ConflictException):
+    pass
+
+
+class DatabasePoolExhaustedException(ServiceUnavailableException):
+    pass
@@ -0,0 +1,403 @@
+"""Request metrics in the Prometheus text format, added up across gunicorn
+worker processes.
+
+Recording a value only updates a dict in the recording process. With
+METRICS_DIR set, every process also writes a snapshot of its metrics to
+that directory every METRICS_FLUSH_INTERVAL seconds, and collect() adds
+its own live values to the latest snapshots of its sibling processes,
+those started by the same parent (the gunicorn master). Snapshots of
+other parents which have exited are deleted.
+
+Counters and histograms of exited workers are still counted, so totals
+never go down when gunicorn replaces a worker. Their snapshots are merged
+into one archive per parent and deleted, so the directory does not grow
+as workers are replaced, and a worker reusing an exited one's pid does
+not overwrite its counts. Gauges only count running processes which have
+written a snapshot in the last STALE_INTERVALS flush intervals.
+
+Without METRICS_DIR each process reports its own metrics only.
+"""
+import atexit
+import bisect
+import contextlib
+import errno
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+
+LOG = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+HISTOGRAM = 'histogram'
+
+DIRECTORY = None
+FLUSH_INTERVAL = 1.0
+# Flush intervals after which a running process' gauges no longer count,
+# e.g. because its pid now belongs to an unrelated process.
+STALE_INTERVALS = 5
+
+# Snapshots are named "<ppid>-<pid>.json". The archive of a parent's exited
+# workers uses pid 0, which no worker has.
+ARCHIVE_PID = 0
+LOCK_FILE = '.lock'
+
+# Every metric, in exposition order.
+METRICS = []
+
+_lock = threading.Lock()
+_flusher = None
+_flusher_lock = threading.Lock()
+
+
+class _Metric(object):
+    kind = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # label values -> value
+        self.values = {}
+        METRICS.append(self)
+
+
+class Counter(_Metric):
+    kind = COUNTER
+
+    def inc(self, labels=(), amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+
+class Gauge(_Metric):
+    kind = GAUGE
+
+    def inc(self, labels=(), amount=1):
+        with _lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def dec(self, labels=(), amount=1):
+        self.inc(labels, -amount)
+
+
+class Histogram(_Metric):
+    """Values are [count per bucket..., count above the last bucket,
+    sum]."""
+    kind = HISTOGRAM
+
+    def __init__(self, name, documentation, labelnames=(), buckets=()):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, labels, value):
+        index = bisect.bisect_left(self.buckets, value)
+        with _lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                counts = self.values[labels] = [0] * (len(self.buckets) + 2)
+            counts[index] += 1
+            counts[-1] += value
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+REQUESTS = Counter(
+    'userapi_requests_total', 'Requests served.',
+    ('method', 'route', 'status'))
+REQUEST_DURATION = Histogram(
+    'userapi_request_duration_seconds',
+    'Time from the start of a request until its body was sent.',
+    ('method', 'route'), LATENCY_BUCKETS)
+REQUESTS_IN_PROGRESS = Gauge(
+    'userapi_requests_in_progress', 'Requests being served.')
+DB_QUERIES = Histogram(
+    'userapi_db_queries_per_request',
+    'Statements sent to the database per request.',
+    ('method', 'route'), QUERY_COUNT_BUCKETS)
+DB_DURATION = Histogram(
+    'userapi_db_duration_seconds',
+    'Time spent in the database per request, commits included.',
+    ('method', 'route'), LATENCY_BUCKETS)
+TRANSACTION_RETRIES = Counter(
+    'userapi_transaction_retries_total',
+    'Transactions run again after a serialization failure or deadlock.',
+    ('route', 'code'))
+
+
+def configure(directory=None, flush_interval=None):
+    """Sets where snapshots are shared, falling back to the METRICS_*
+    environment variables."""
+    global DIRECTORY, FLUSH_INTERVAL
+    if directory is None:
+        directory = os.environ.get('METRICS_DIR') or None
+    if flush_interval is None:
+        flush_interval = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+    DIRECTORY = directory
+    FLUSH_INTERVAL = flush_interval
+
+
+def snapshot():
+    """Returns this process' metrics as {name: [[label values, value]]}."""
+    with _lock:
+        return dict((metric.name,
+                     [[list(labels), list(value)
+                       if isinstance(value, list) else value]
+                      for labels, value in metric.values.items()])
+                    for metric in METRICS)
+
+
+def _snapshot_name(ppid, pid):
+    return '%d-%d.json' % (ppid, pid)
+
+
+def _parse_snapshot_name(filename):
+    try:
+        ppid, pid = filename[:-len('.json')].split('-')
+        return int(ppid), int(pid)
+    except ValueError:
+        return None, None
+
+
+def _write(path, data):
+    # Written aside and renamed so readers never see a partial file.
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as f:
+        json.dump(data, f)
+    os.rename(temp_path, path)
+
+
+def _read(path):
+    """Returns the metrics of the snapshot at path, or None when there is
+    none."""
+    try:
+        with open(path) as f:
+            return json.load(f)['metrics']
+    except (IOError, ValueError, KeyError):
+        return None
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _path(pid):
+    return os.path.join(DIRECTORY, _snapshot_name(os.getppid(), pid))
+
+
+@contextlib.contextmanager
+def _locked(operation):
+    """Holds the lock of DIRECTORY, shared while reading snapshots and
+    exclusive while moving them into the archive."""
+    with open(os.path.join(DIRECTORY, LOCK_FILE), 'a') as f:
+        fcntl.flock(f, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def write_snapshot():
+    _write(_path(os.getpid()), {'pid': os.getpid(), 'metrics': snapshot()})
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno == errno.EPERM
+    return True
+
+
+def _sibling_snapshots():
+    """Returns (alive, metrics) for the archive and the latest snapshot of
+    every other process started by this one's parent, and the paths of
+    the snapshots of those which have exited."""
+    ppid, pid = os.getppid(), os.getpid()
+    fresh_after = time.time() - STALE_INTERVALS * FLUSH_INTERVAL
+    snapshots = []
+    exited = []
+    with _locked(fcntl.LOCK_SH):
+        for filename in os.listdir(DIRECTORY):
+            if not filename.endswith('.json'):
+                continue
+            file_ppid, file_pid = _parse_snapshot_name(filename)
+            if file_pid is None or file_pid == pid:
+                continue
+            path = os.path.join(DIRECTORY, filename)
+            if file_ppid != ppid:
+                if not _alive(file_ppid):
+                    # Left behind by a previous server.
+                    _remove(path)
+                continue
+            try:
+                fresh = os.path.getmtime(path) >= fresh_after
+            except OSError:
+                continue
+            metrics = _read(path)
+            if metrics is None:
+                continue
+            if file_pid == ARCHIVE_PID:
+                alive = False
+            else:
+                alive = _alive(file_pid)
+                if not alive:
+                    exited.append(path)
+            snapshots.append((alive and fresh, metrics))
+    return snapshots, exited
+
+
+def _archive(paths):
+    """Adds the counters and histograms of the snapshots at paths to the
+    archive of this process' parent and deletes the snapshots."""
+    with _locked(fcntl.LOCK_EX):
+        # Another process may have archived some of them already.
+        snapshots = [(path, _read(path)) for path in paths]
+        snapshots = [(path, metrics) for path, metrics in snapshots
+                     if metrics is not None]
+        if not snapshots:
+            return
+        archive_path = _path(ARCHIVE_PID)
+        archived = [_read(archive_path) or {}]
+        archived.extend(metrics for _, metrics in snapshots)
+        merged = {}
+        for metric in METRICS:
+            if metric.kind == GAUGE:
+                continue
+            total = {}
+            for metrics in archived:
+                _add(total, metric, metrics, True)
+            merged[metric.name] = [[list(labels), value]
+                                   for labels, value in total.items()]
+        _write(archive_path, {'pid': ARCHIVE_PID, 'metrics': merged})
+        for path, _ in snapshots:
+            _remove(path)
+
+
+def _add(total, metric, metrics, alive):
+    if metric.kind == GAUGE and not alive:
+        return
+    for labels, value in metrics.get(metric.name, []):
+        labels = tuple(labels)
+        current = total.get(labels)
+        if current is None:
+            total[labels] = value
+        elif metric.kind == HISTOGRAM:
+            total[labels] = [a + b for a, b in zip(current, value)]
+        else:
+            total[labels] = current + value
+
+
+def collect():
+    """Returns the metrics of this process and its siblings in the
+    Prometheus text format."""
+    snapshots = [(True, snapshot())]
+    if DIRECTORY:
+        siblings, exited = _sibling_snapshots()
+        snapshots.extend(siblings)
+        if exited:
+            _archive(exited)
+
+    lines = []
+    for metric in METRICS:
+        total = {}
+        for alive, metrics in snapshots:
+            _add(total, metric, metrics, alive)
+        lines.append('# HELP %s %s' % (metric.name, metric.documentation))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        if metric.kind == GAUGE and not metric.labelnames and not total:
+            total[()] = 0
+        for labels in sorted(total):
+            lines.extend(_sample_lines(metric, labels, total[labels]))
+    return '\n'.join(lines) + '\n'
+
+
+def _sample_lines(metric, labels, value):
+    pairs = list(zip(metric.labelnames, labels))
+    if metric.kind != HISTOGRAM:
+        return ['%s%s %s' % (metric.name, _labels(pairs), _number(value))]
+
+    lines = []
+    cumulative = 0
+    for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+        cumulative += count
+        lines.append('%s_bucket%s %s' % (
+            metric.name, _labels(pairs + [('le', _number(bound))]),
+            _number(cumulative)))
+    lines.append('%s_sum%s %s' % (metric.name, _labels(pairs),
+                                  _number(value[-1])))
+    lines.append('%s_count%s %s' % (metric.name, _labels(pairs),
+                                    _number(cumulative)))
+    return lines
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (name, unicode(value).replace('\\', '\\\\')
+                     .replace('"', '\\"').replace('\n', '\\n'))
+        for name, value in pairs)
+
+
+def _number(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Flusher(threading.Thread):
+    """Writes this process' snapshot every FLUSH_INTERVAL seconds."""
+
+    def __init__(self):
+        super(Flusher, self).__init__(name='userapi-metrics-flusher')
+        self.daemon = True
+        self.pid = os.getpid()
+
+    def run(self):
+        while True:
+            try:
+                write_snapshot()
+            except Exception:
+                LOG.warning('Writing metrics snapshot failed.', exc_info=True)
+            time.sleep(FLUSH_INTERVAL)
+
+
+def start_flusher():
+    """Starts this process' flusher once; safe to call on every request
+    and after a fork."""
+    global _flusher
+    if not DIRECTORY:
+        return
+    with _flusher_lock:
+        if _flusher is None or _flusher.pid != os.getpid():
+            # A snapshot under this pid was left by an exited worker.
+            if os.path.exists(_path(os.getpid())):
+                _archive([_path(os.getpid())])
+            _flusher = Flusher()
+            _flusher.start()
+
+
+
+@atexit.register
+def _write_last_snapshot():
+    """Writes what was recorded since the last flush when a worker exits,
+    e.g. after gunicorn's max_requests."""
+    if _flusher is not None and _flusher.pid == os.getpid():
+        try:
+            write_snapshot()
+        except Exception:
+            LOG.warning('Writing metrics snapshot failed.', exc_info=True)
+
+
+configure()
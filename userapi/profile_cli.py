@@ -0,0 +1,121 @@
+"""Aggregates and compares request profiles written to PROFILE_DIR."""
+import argparse
+import collections
+import glob
+import os
+import pstats
+import sys
+
+from userapi import profiling
+
+
+def find_profiles(paths, route=None):
+    """Returns the profile files among paths, directories being searched,
+    whose method and route label contains route."""
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            files.extend(sorted(glob.glob(
+                os.path.join(path, '*' + profiling.SUFFIX))))
+        else:
+            files.append(path)
+    if route:
+        files = [f for f in files if route in profiling.parse_label(f)]
+    return files
+
+
+def load(files):
+    """Returns pstats.Stats adding up files, or None without any."""
+    if not files:
+        return None
+    return pstats.Stats(*files)
+
+
+def per_request(stats, count):
+    """Returns {function: (calls, seconds inside, seconds including
+    callees)} averaged over count requests."""
+    return dict((func, (float(nc) / count, tt / count, ct / count))
+                for func, (cc, nc, tt, ct, callers) in stats.stats.items())
+
+
+def compare(baseline, candidate, limit, sort=2):
+    """Returns (function, baseline, candidate) rows for the functions
+    whose time per request changed most, sort indexing the per_request
+    values."""
+    functions = set(baseline) | set(candidate)
+    empty = (0.0, 0.0, 0.0)
+
+    def change(func):
+        return abs(candidate.get(func, empty)[sort] -
+                   baseline.get(func, empty)[sort])
+
+    return [(func, baseline.get(func, empty), candidate.get(func, empty))
+            for func in sorted(functions, key=change, reverse=True)[:limit]]
+
+
+def _describe(func):
+    filename, line, name = func
+    if filename == '~':
+        return name
+    return '%s:%d(%s)' % (os.path.basename(filename), line, name)
+
+
+def show(args):
+    files = find_profiles(args.paths, args.route)
+    stats = load(files)
+    if stats is None:
+        sys.exit('No profiles found.')
+    counts = collections.Counter(profiling.parse_label(f) for f in files)
+    for label, count in sorted(counts.items()):
+        print('%6d  %s' % (count, label))
+    stats.sort_stats(args.sort).print_stats(args.limit)
+
+
+def compare_profiles(args):
+    sides = []
+    for paths in (args.baseline, args.candidate):
+        files = find_profiles(paths, args.route)
+        stats = load(files)
+        if stats is None:
+            sys.exit('No profiles found in %s.' % ', '.join(paths))
+        sides.append(per_request(stats, len(files)))
+        print('%s: %d profiles' % (', '.join(paths), len(files)))
+
+    sort = {'tottime': 1, 'cumulative': 2}[args.sort]
+    print('%12s %12s %10s  %s' % ('baseline ms', 'candidate ms', 'change',
+                                  'function'))
+    for func, before, after in compare(sides[0], sides[1], args.limit, sort):
+        before_ms, after_ms = before[sort] * 1000, after[sort] * 1000
+        print('%12.3f %12.3f %+10.3f  %s' % (before_ms, after_ms,
+                                             after_ms - before_ms,
+                                             _describe(func)))
+
+
+def main():
+    parser = argparse.ArgumentParser("UserAPI Profile Utility")
+    subparsers = parser.add_subparsers(help='sub-command help')
+
+    show_parser = subparsers.add_parser(
+        'show', help='Print the functions of profiles added up')
+    show_parser.add_argument('paths', nargs='+',
+                             help='Profile files or directories')
+    show_parser.add_argument('--route',
+                             help='Only profiles whose name contains this, '
+                                  'e.g. GET_groups_name')
+    show_parser.add_argument('--sort', default='cumulative',
+                             help='pstats sort key')
+    show_parser.add_argument('--limit', type=int, default=30)
+    show_parser.set_defaults(func=show)
+
+    compare_parser = subparsers.add_parser(
+        'compare', help='Compare time per request of two sets of profiles')
+    compare_parser.add_argument('--baseline', nargs='+', required=True)
+    compare_parser.add_argument('--candidate', nargs='+', required=True)
+    compare_parser.add_argument('--route')
+    compare_parser.add_argument('--sort', default='cumulative',
+                                choices=['cumulative', 'tottime'])
+    compare_parser.add_argument('--limit', type=int, default=30)
+    compare_parser.set_defaults(func=compare_profiles)
+
+    args = parser.parse_args()
+    args.func(args)
@@ -0,0 +1,104 @@
+"""Profiles single requests with cProfile.
+
+With PROFILE_DIR set, a request is profiled when its X-Profile header
+matches PROFILE_TOKEN, or at random for a PROFILE_SAMPLE_RATE fraction of
+requests. Other requests only pay for those two checks.
+
+The profile covers the view and, for streamed responses, producing the
+body. It is written to PROFILE_DIR once the body has been sent, named
+after the request's method and route, e.g.
+GET_groups_name.20160301T123015.412.1234.prof, and its name returned in
+the X-Profile-File header. The files can be read with pstats or
+userapi-profile.
+"""
+import cProfile
+import hmac
+import os
+import random
+import re
+import time
+
+HEADER = 'X-Profile'
+FILE_HEADER = 'X-Profile-File'
+SUFFIX = '.prof'
+
+DIRECTORY = None
+TOKEN = None
+SAMPLE_RATE = 0.0
+
+
+def configure(directory=None, token=None, sample_rate=None):
+    """Applies the arguments, falling back to the PROFILE_* environment
+    variables. Profiling is off without a directory."""
+    global DIRECTORY, TOKEN, SAMPLE_RATE
+    if directory is None:
+        directory = os.environ.get('PROFILE_DIR') or None
+    if token is None:
+        token = os.environ.get('PROFILE_TOKEN') or None
+    if sample_rate is None:
+        sample_rate = float(os.environ.get('PROFILE_SAMPLE_RATE', 0))
+    DIRECTORY = directory
+    TOKEN = token
+    SAMPLE_RATE = sample_rate
+
+
+def should_profile(headers):
+    if not DIRECTORY:
+        return False
+    if TOKEN:
+        value = headers.get(HEADER)
+        # Constant time, so the token cannot be guessed a byte at a time.
+        if value is not None and hmac.compare_digest(
+                value.encode('utf-8'), TOKEN):
+            return True
+    return bool(SAMPLE_RATE) and random.random() < SAMPLE_RATE
+
+
+def profile_name(method, route):
+    """Returns the file name for a profile of a method and route."""
+    label = re.sub(r'[^A-Za-z0-9]+', '_', '%s %s' % (method, route or ''))
+    now = time.time()
+    return '%s.%s.%03d.%d%s' % (
+        label.strip('_'), time.strftime('%Y%m%dT%H%M%S', time.gmtime(now)),
+        int(now * 1000) % 1000, os.getpid(), SUFFIX)
+
+
+def parse_label(filename):
+    """Returns the method and route label of a profile file name."""
+    return os.path.basename(filename).split('.', 1)[0]
+
+
+def profile(method, route, view, *args, **kwds):
+    """Returns view(*args, **kwds), profiled and dumped to DIRECTORY once
+    the response has been sent."""
+    profiler = cProfile.Profile()
+    response = profiler.runcall(view, *args, **kwds)
+    if response.is_streamed:
+        response.response = _profiled_iter(profiler, response.response)
+    name = profile_name(method, route)
+    response.headers[FILE_HEADER] = name
+    response.call_on_close(
+        lambda: profiler.dump_stats(os.path.join(DIRECTORY, name)))
+    return response
+
+
+def _profiled_iter(profiler, iterable):
+    iterator = iter(iterable)
+    try:
+        while True:
+            profiler.enable()
+            try:
+                chunk = next(iterator)
+            except StopIteration:
+                return
+            finally:
+                profiler.disable()
+            yield chunk
+    finally:
+        # Closing the response closes this generator; pass it on.
+        close = getattr(iterable, 'close', None)
+        if close is not None:
+            close()
+
+
+configure()
@@ -0,0 +1,70 @@
+"""JSON encoding shared by every response.
+
+The first installed backend in BACKENDS is used unless JSON_ENCODER names
+one. Every backend writes compact JSON, with no whitespace between tokens
+and non-ASCII characters escaped, so responses look the same whichever
+one is in use.
+"""
+import collections
+import json
+import os
+import time
+
+from userapi import timing
+
+MIMETYPE = 'application/json'
+
+
+def _ujson():
+    import ujson
+    return lambda obj: ujson.dumps(obj, escape_forward_slashes=False)
+
+
+def _stdlib():
+    return json.JSONEncoder(separators=(',', ':')).encode
+
+
+# name -> function returning an encoder, raising ImportError when the
+# backend is not installed. Fastest first.
+BACKENDS = collections.OrderedDict([
+    ('ujson', _ujson),
+    ('json', _stdlib),
+])
+
+BACKEND = None
+_dumps = None
+
+
+def configure(backend=None):
+    """Selects the named backend, by default JSON_ENCODER, or the fastest
+    installed one for "auto"."""
+    global BACKEND, _dumps
+    if backend is None:
+        backend = os.environ.get('JSON_ENCODER', 'auto')
+    if backend == 'auto':
+        for name, load in BACKENDS.items():
+            try:
+                _dumps = load()
+            except ImportError:
+                continue
+            BACKEND = name
+            return
+    if backend not in BACKENDS:
+        raise ValueError('Unknown JSON_ENCODER %r, expected one of: auto, %s'
+                         % (backend, ', '.join(BACKENDS)))
+    _dumps = BACKENDS[backend]()
+    BACKEND = backend
+
+
+def dumps(obj):
+    timer = timing.current()
+    if timer is None:
+        return _dumps(obj)
+    start = time.time()
+    try:
+        return _dumps(obj)
+    finally:
+        timer.add(timing.SERIALIZATION, time.time() - start)
+
+
+configure()
@@ -0,0 +1,101 @@
+import codecs
+import json
+
+from userapi import exceptions
+
+CHUNK_SIZE = 64 * 1024
+# Largest single array element or NDJSON line accepted from a stream.
+MAX_VALUE_SIZE = 1024 * 1024
+JSON_WHITESPACE = u' \t\n\r'
+
+
+def iter_ndjson(stream, max_value_size=MAX_VALUE_SIZE):
+    """Yields one decoded value per non-blank line of a newline delimited
+    JSON stream, reading it a line at a time."""
+    while True:
+        line = stream.readline(max_value_size + 1)
+        if not line:
+            return
+        if len(line) > max_value_size:
+            raise exceptions.InvalidRequestException()
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            yield json.loads(line.decode('utf-8'))
+        except ValueError:
+            raise exceptions.InvalidRequestException()
+
+
+def iter_json_array(stream, chunk_size=CHUNK_SIZE,
+                    max_value_size=MAX_VALUE_SIZE):
+    """Yields the elements of a top level JSON array without reading the
+    whole body, so memory is bounded by the largest single element."""
+    reader = _ArrayReader(stream, chunk_size, max_value_size)
+    reader.expect(u'[')
+    if reader.peek() == u']':
+        return
+    while True:
+        yield reader.value()
+        if reader.expect(u',]') == u']':
+            return
+
+
+def _read_chunks(stream, chunk_size):
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        yield decoder.decode(chunk)
+    yield decoder.decode(b'', final=True)
+
+
+class _ArrayReader(object):
+    def __init__(self, stream, chunk_size, max_value_size):
+        self._chunks = _read_chunks(stream, chunk_size)
+        self._decoder = json.JSONDecoder()
+        self._max_value_size = max_value_size
+        self._buf = u''
+        self._pos = 0
+        self._eof = False
+
+    def _fill(self):
+        if self._eof or len(self._buf) - self._pos > self._max_value_size:
+            raise exceptions.InvalidRequestException()
+        self._buf = self._buf[self._pos:]
+        self._pos = 0
+        try:
+            self._buf += next(self._chunks)
+        except StopIteration:
+            self._eof = True
+
+    def peek(self):
+        while True:
+            while (self._pos < len(self._buf) and
+                   self._buf[self._pos] in JSON_WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._fill()
+
+    def expect(self, chars):
+        char = self.peek()
+        if char not in chars:
+            raise exceptions.InvalidRequestException()
+        self._pos += 1
+        return char
+
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                value, end = self._decoder.raw_decode(self._buf, self._pos)
+            except ValueError:
+                self._fill()
+                continue
+            # A value ending exactly at the end of the buffer may have been
+            # cut short (e.g. a number), so only trust it once more input
+            # follows or the stream has ended.
+            if end == len(self._buf) and not self._eof:
+                self._fill()
+                continue
+            self._pos = end
+            return value
@@ -1,4 +1,5 @@
 import json
+import multiprocessing.pool
 import os
 import unittest
 import uuid
@@ -24,24 +25,36 @@ def create_test_group():
 
 
 class FunctionalTestCases(unittest.TestCase):
+    def setUp(self):
+        # Carries the WAL position cookie from writes to the reads after
+        # them, for servers with replicas.
+        self.session = requests.Session()
+        self.addCleanup(self.session.close)
+
     def _get(self, path):
-        response = requests.get(API_URL + path)
+        response = self.session.get(API_URL + path)
         return response, response.json()
 
     def _delete(self, path):
-        response = requests.delete(API_URL + path)
+        response = self.session.delete(API_URL + path)
         return response, response.json()
 
     def _post(self, path, data):
-        response = requests.post(API_URL + path,
-                                 data=json.dumps(data),
-                                 headers={'Content-Type': 'application/json'})
+        response = self.session.post(
+            API_URL + path, data=json.dumps(data),
+            headers={'Content-Type': 'application/json'})
         return response, response.json()
 
     def _put(self, path, data):
-        response = requests.put(API_URL + path,
-                                data=json.dumps(data),
-                                headers={'Content-Type': 'application/json'})
+        response = self.session.put(
+            API_URL + path, data=json.dumps(data),
+            headers={'Content-Type': 'application/json'})
+        return response, response.json()
+
+    def _patch(self, path, data):
+        response = self.session.patch(
+            API_URL + path, data=json.dumps(data),
+            headers={'Content-Type': 'application/json'})
         return response, response.json()
 
     def test_create_user(self):
@@ -63,6 +76,27 @@ class FunctionalTestCases(unittest.TestCase):
         self.assertEqual(201, result1.status_code)
         self.assertEqual(409, result2.status_code)
 
+    def test_create_user_concurrently(self):
+        test_user = create_test_user()
+
+        pool = multiprocessing.pool.ThreadPool(8)
+        results = pool.map(lambda _: self._post('/users', test_user)[0],
+                           range(8))
+        pool.close()
+
+        codes = sorted(result.status_code for result in results)
+        self.assertEqual([201] + [409] * 7, codes)
+
+    def test_create_user_group_does_not_exist(self):
+        test_user = create_test_user(groups=[create_test_group()['name']])
+
+        result, _ = self._post('/users', test_user)
+
+        self.assertEqual(404, result.status_code)
+
+        get_result, _ = self._get('/users/%s' % test_user['userid'])
+        self.assertEqual(404, get_result.status_code)
+
     def test_create_user_missing_field(self):
         test_user = create_test_user()
         del test_user['userid']
@@ -284,6 +318,19 @@ class FunctionalTestCases(unittest.TestCase):
         self.assertEqual(test_user['first_name'], get_body['first_name'])
         self.assertEqual(test_user['groups'], get_body['groups'])
 
+    def test_create_user_keeps_group_order(self):
+        test_groups = [create_test_group() for i in range(5)]
+        for test_group in test_groups:
+            self._post('/groups', test_group)
+        names = [test_group['name'] for test_group in reversed(test_groups)]
+        test_user = create_test_user(groups=names)
+
+        _, user_body = self._post('/users', test_user)
+        _, get_body = self._get('/users/%s' % test_user['userid'])
+
+        self.assertEqual(names, user_body['groups'])
+        self.assertEqual(names, get_body['groups'])
+
     def test_delete_group_removes_user_from_group(self):
         test_group = create_test_group()
         test_user = create_test_user(groups=[test_group['name']])
@@ -370,3 +417,279 @@ class FunctionalTestCases(unittest.TestCase):
         group_result, group_body = self._get(group_url)
         self.assertEqual(200, group_result.status_code)
         self.assertEqual([], group_body)
+
+    def test_create_users_bulk(self):
+        test_group = create_test_group()
+        self._post('/groups', test_group)
+        test_user1 = create_test_user(groups=[test_group['name']])
+        test_user2 = create_test_user()
+        test_user3 = create_test_user(groups=[create_test_group()['name']])
+        bad_user = create_test_user()
+        del bad_user['first_name']
+
+        result, body = self._post('/users/bulk', [test_user1, test_user2,
+                                                  test_user2, test_user3,
+                                                  bad_user])
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual([201, 201, 409, 404, 400],
+                         [r['code'] for r in body])
+        self.assertEqual(range(5), [r['index'] for r in body])
+
+        get_result, user = self._get('/users/%s' % test_user1['userid'])
+        self.assertEqual(200, get_result.status_code)
+        self.assertEqual(test_user1['groups'], user['groups'])
+
+    def test_create_users_bulk_wrong_types(self):
+        test_user1 = create_test_user()
+        test_user2 = create_test_user()
+        bad_user = create_test_user(groups=[5])
+
+        result, body = self._post('/users/bulk', [test_user1, bad_user,
+                                                  test_user2])
+
+        self.assertEqual(200, result.status_code)
+        self.assertEqual([201, 400, 201], [r['code'] for r in body])
+        get_result, _ = self._get('/users/%s' % test_user2['userid'])
+        self.assertEqual(200, get_result.status_code)
+
+    def test_create_users_bulk_ndjson(self):
+        test_users = [create_test_user() for i in range(3)]
+        data = '\n'.join(json.dumps(user) for user in test_users)
+
+        result = self.session.post(API_URL + '/users/bulk', data=data,
+                                   headers={'Content-Type':
+                                            'application/x-ndjson'})
+
+        self.assertEqual(200, result.status_code)
+        body = [json.loads(line) for line in result.text.splitlines()]
+        self.assertEqual([201, 201, 201], [r['code'] for r in body])
+        self.assertEqual([user['userid'] for user in test_users],
+                         [r['userid'] for r in body])
+
+    def test_get_missing_group(self):
+        for path in ('/groups/%s', '/groups/%s/members'):
+            result, body = self._get(path % uuid.uuid4())
+            self.assertEqual(404, result.status_code)
+            self.assertEqual('GroupNotFoundException', body['exception'])
+
+    def test_list_group_members_paginated(self):
+        test_group = create_test_group()
+        self._post('/groups', test_group)
+        test_users = [create_test_user(groups=[test_group['name']])
+                      for i in range(5)]
+        for test_user in test_users:
+            self._post('/users', test_user)
+
+        members = []
+        cursor = None
+        pages = 0
+        while True:
+            params = '?limit=2' + ('&cursor=%s' % cursor if cursor else '')
+            result, body = self._get('/groups/%s/members%s' %
+                                     (test_group['name'], params))
+            self.assertEqual(200, result.status_code)
+            members.extend(body['members'])
+            pages += 1
+            cursor = body['next_cursor']
+            if not cursor:
+                break
+
+        self.assertEqual(3, pages)
+        self.assertEqual(sorted(u['userid'] for u in test_users),
+                         sorted(members))
+
+    def test_list_users_paginated(self):
+        result, body = self._get('/users?limit=1')
+        self.assertEqual(200, result.status_code)
+        self.assertTrue(len(body['users']) <= 1)
+
+        if body['next_cursor']:
+            result2, body2 = self._get('/users?limit=1&cursor=%s' %
+                                       body['next_cursor'])
+            self.assertEqual(200, result2.status_code)
+            self.assertTrue(body['users'][0]['userid'] <
+                            body2['users'][0]['userid'])
+
+    def test_conditional_get_after_membership_change(self):
+        test_group = create_test_group()
+        self._post('/groups', test_group)
+        test_user = create_test_user()
+        self._post('/users', test_user)
+        user_path = '/users/%s' % test_user['userid']
+        group_path = '/groups/%s' % test_group['name']
+
+        user_etag = self.session.get(API_URL + user_path).headers['ETag']
+        group_etag = self.session.get(API_URL + group_path).headers['ETag']
+        result = self.session.get(API_URL + user_path,
+                                  headers={'If-None-Match': user_etag})
+        self.assertEqual(304, result.status_code)
+
+        self._put(group_path, [test_user['userid']])
+
+        for path, etag in ((user_path, user_etag), (group_path, group_etag)):
+            result = self.session.get(API_URL + path,
+                                      headers={'If-None-Match': etag})
+            self.assertEqual(200, result.status_code)
+            self.assertNotEqual(etag, result.headers['ETag'])
+
+    def test_list_user_groups_paginated(self):
+        test_groups = [create_test_group() for i in range(3)]
+        for test_group in test_groups:
+            self._post('/groups', test_group)
+        test_user = create_test_user(groups=[g['name'] for g in test_groups])
+        self._post('/users', test_user)
+
+        result, body = self._get('/users/%s/groups?limit=2' %
+                                 test_user['userid'])
+        self.assertEqual(200, result.status_code)
+        result2, body2 = self._get('/users/%s/groups?limit=2&cursor=%s' %
+                                   (test_user['userid'], body['next_cursor']))
+
+        self.assertEqual(sorted(g['name'] for g in test_groups),
+                         sorted(body['groups'] + body2['groups']))
+        self.assertIsNone(body2['next_cursor'])
+
+    def test_list_user_groups_without_groups(self):
+        test_user = create_test_user()
+        self._post('/users', test_user)
+
+        result, body = self._get('/users/%s/groups' % test_user['userid'])
+        self.assertEqual(200, result.status_code)
+        self.assertEqual([], body['groups'])
+
+        result, body = self._get('/users/%s/groups' % uuid.uuid4())
+        self.assertEqual(404, result.status_code)
+        self.assertEqual('UserNotFoundException', body['exception'])
+
+    def test_check_membership(self):
+        test_group = create_test_group()
+        self._post('/groups', test_group)
+        member = create_test_user(groups=[test_group['name']])
+        other = create_test_user()
+        self._post('/users', member)
+        self._post('/users', other)
+        path = '/groups/%s/members/%%s' % test_group['name']
+
+        result, body = self._get(path % member['userid'])
+        self.assertEqual(200, result.status_code)
+        self.assertEqual({'name': test_group['name'],
+                          'userid': member['userid']}, body)
+        self.assertEqual(200, requests.head(
+            API_URL + path % member['userid']).status_code)
+
+        result, body = self._get(path % other['userid'])
+        self.assertEqual(404, result.status_code)
+        self.assertEqual('MembershipNotFoundException', body['exception'])
+        self.assertEqual(404, requests.head(
+            API_URL + path % other['userid']).status_code)
+
+        result, body = self._get(path % uuid.uuid4())
+        self.assertEqual('UserNotFoundException', body['exception'])
+        result, body = self._get('/groups/%s/members/%s' %
+                                 (uuid.uuid4(), member['userid']))
+        self.assertEqual('GroupNotFoundException', body['exception'])
+
+    def test_patch_group(self):
+        test_group = create_test_group()
+        self._post('/groups', test_group)
+        test_users = [create_test_user() for i in range(3)]
+        for test_user in test_users:
+            self._post('/users', test_user)
+        userids = [u['userid'] for u in test_users]
+        group_path = '/groups/%s' % test_group['name']
+        self._put(group_path, userids[:2])
+
+        delta = {'add': userids[1:], 'remove': [userids[0], 'unknown']}
+        result, body = self._patch(group_path, delta)
+        self.assertEqual(200, result.status_code)
+        self.assertEqual({'added': [userids[2]], 'removed': [userids[0]]},
+                         body)
+
+        # Applying the same change again changes nothing.
+        etag = self.session.get(API_URL + group_path).headers['ETag']
+        result, body = self._patch(group_path, delta)
+        self.assertEqual({'added': [], 'removed': []}, body)
+        result, body = self._get(group_path)
+        self.assertEqual(sorted(userids[1:]), sorted(body))
+        self.assertEqual(etag, result.headers['ETag'])
+
+        result, body = self._get('/users/%s' % userids[2])
+        self.assertEqual([test_group['name']], body['groups'])
+
+        result, body = self._patch(group_path, {'add': [str(uuid.uuid4())]})
+        self.assertEqual(404, result.status_code)
+        self.assertEqual('UserNotFoundException', body['exception'])
+        result, body = self._patch('/groups/%s' % uuid.uuid4(),
+                                   {'add': [userids[0]]})
+        self.assertEqual('GroupNotFoundException', body['exception'])
+
+    def test_patch_user_groups(self):
+        test_groups = [create_test_group() for i in range(2)]
+        for test_group in test_groups:
+            self._post('/groups', test_group)
+        names = [g['name'] for g in test_groups]
+        test_user = create_test_user(groups=names[:1])
+        self._post('/users', test_user)
+        path = '/users/%s/groups' % test_user['userid']
+
+        result, body = self._patch(path, {'add': names[1:],
+                                          'remove': names[:1]})
+        self.assertEqual(200, result.status_code)
+        self.assertEqual({'added': names[1:], 'removed': names[:1]}, body)
+
+        result, body = self._get('/users/%s' % test_user['userid'])
+        self.assertEqual(names[1:], body['groups'])
+        result, body = self._get('/groups/%s' % names[1])
+        self.assertEqual([test_user['userid']], body)
+
+        result, body = self._patch(path, {'add': [str(uuid.uuid4())]})
+        self.assertEqual(404, result.status_code)
+        self.assertEqual('GroupNotFoundException', body['exception'])
+
+    def test_lookup_users(self):
+        test_group = create_test_group()
+        self._post('/groups', test_group)
+        test_users = [create_test_user(groups=[test_group['name']]),
+                      create_test_user()]
+        for test_user in test_users:
+            self._post('/users', test_user)
+        missing = str(uuid.uuid4())
+        userids = [test_users[1]['userid'], missing, test_users[0]['userid']]
+
+        result, body = self._get('/users?ids=%s' % ','.join(userids))
+        self.assertEqual(200, result.status_code)
+        self.assertEqual([test_users[1], test_users[0]], body['users'])
+        self.assertEqual([missing], body['not_found'])
+
+        result, body2 = self._post('/users/lookup', {'ids': userids})
+        self.assertEqual(body, body2)
+
+    def test_lookup_groups(self):
+        test_groups = [create_test_group() for i in range(2)]
+        for test_group in test_groups:
+            self._post('/groups', test_group)
+        test_user = create_test_user(groups=[test_groups[0]['name']])
+        self._post('/users', test_user)
+        missing = str(uuid.uuid4())
+
+        result, body = self._post('/groups/lookup', {'names': [
+            test_groups[0]['name'], missing, test_groups[1]['name']]})
+        self.assertEqual(200, result.status_code)
+        self.assertEqual([{'name': test_groups[0]['name'],
+                           'members': [test_user['userid']]},
+                          {'name': test_groups[1]['name'], 'members': []}],
+                         body['groups'])
+        self.assertEqual([missing], body['not_found'])
+
+        result, body = self._get('/groups?names=%s' % missing)
+        self.assertEqual({'groups': [], 'not_found': [missing]}, body)
+
+    def test_write_returns_wal_position_with_replicas(self):
+        _, stats = self._get('/stats/replicas')
+
+        result, _ = self._post('/groups', create_test_group())
+
+        self.assertEqual(201, result.status_code)
+        self.assertEqual(bool(stats['replicas']),
+                         'X-WAL-Position' in result.headers)
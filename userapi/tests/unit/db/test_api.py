@@ -1,13 +1,24 @@
+import collections
 import copy
+import json
 import unittest
 
 import mock
+import peewee
+import psycopg2
 
 from userapi.db import api
 from userapi import exceptions
 from userapi.tests.unit import fixtures
 
 
+def _rollback_error(pgcode):
+    error_type = type('RollbackError',
+                      (psycopg2.extensions.TransactionRollbackError,),
+                      {'pgcode': pgcode})
+    return error_type()
+
+
 class APITestCase(unittest.TestCase):
     def setUp(self):
         user_patcher = mock.patch.object(api, 'User')
@@ -22,11 +33,18 @@ class APITestCase(unittest.TestCase):
         self.UserGroups = usergroups_patcher.start()
         self.addCleanup(usergroups_patcher.stop)
 
+        database_patcher = mock.patch.object(api, 'DATABASE')
+        self.DATABASE = database_patcher.start()
+        self.addCleanup(database_patcher.stop)
+        # Prepared statements run as plain SQL; see test_prepared.
+        self.DATABASE.pooled = False
+        self.cursor = self.DATABASE.execute_sql.return_value
+
+        self.UserGroups.insert_from.return_value.sql.return_value = (
+            'INSERT', [1])
+
     def test_create_user(self):
         mock_user = mock.MagicMock()
-        (self.User.select.return_value
-                  .where.return_value
-                  .exists.return_value) = False
         self.User.return_value = mock_user
 
         user = fixtures.TEST_USER
@@ -37,59 +55,179 @@ class APITestCase(unittest.TestCase):
                                           first_name=user['first_name'],
                                           last_name=user['last_name'])
         mock_user.save.assert_called_once_with()
+        self.assertFalse(self.Group.select.called)
+        self.assertFalse(self.UserGroups.insert_from.called)
+        self.assertEqual([], new_user.group_names)
 
     def test_create_user_with_group(self):
         mock_user = mock.MagicMock()
-        (self.User.select.return_value
-                  .where.return_value
-                  .exists.return_value) = False
         self.User.return_value = mock_user
 
         mock_group = mock.MagicMock()
-        self.Group.get.return_value = mock_group
+        mock_group.name = 'admins'
+        (self.Group.select.return_value
+                   .where.return_value) = [mock_group]
 
         user = fixtures.TEST_USER_WITH_GROUP
         new_user = api.create_user(user)
 
         self.assertEqual(new_user, mock_user)
-        self.Group.get.assert_called_once_with(
-            self.Group.name == user['groups'][0])
+        self.assertFalse(self.Group.get.called)
         self.User.assert_called_once_with(userid=user['userid'],
                                           first_name=user['first_name'],
                                           last_name=user['last_name'])
         mock_user.save.assert_called_once_with()
-        self.UserGroups.assert_called_once_with(user=mock_user,
-                                                group=mock_group)
+        self.DATABASE.execute_sql.assert_any_call(
+            api._ADD_GROUPS_SQL, (mock_user.id, [mock_group.id]))
+        self.assertEqual(user['groups'], new_user.group_names)
+
+    def test_create_user_group_does_not_exist(self):
+        (self.Group.select.return_value
+                   .where.return_value) = []
+
+        self.assertRaises(exceptions.GroupNotFoundException,
+                          api.create_user,
+                          fixtures.TEST_USER_WITH_GROUP)
+        self.assertFalse(self.User.called)
+
+    @mock.patch.object(api, '_get_group_ids')
+    def test_create_users(self, mock_get_group_ids):
+        mock_get_group_ids.return_value = {'admins': 1}
+        cursor = self.DATABASE.execute_sql.return_value
+        cursor.fetchall.return_value = [('amelton', 10)]
+        existing = dict(fixtures.TEST_USER, userid='existing')
+        unknown_group = dict(fixtures.TEST_USER, userid='other',
+                             groups=['unknown'])
+
+        results = api.create_users([fixtures.TEST_USER_WITH_GROUP,
+                                    fixtures.TEST_USER_WITH_GROUP,
+                                    existing,
+                                    unknown_group])
+
+        self.assertEqual([type(None),
+                          exceptions.UserAlreadyExistsException,
+                          exceptions.UserAlreadyExistsException,
+                          exceptions.GroupNotFoundException],
+                         [type(result) for result in results])
+        mock_get_group_ids.assert_called_once_with({'admins', 'unknown'})
+        self.assertEqual((['amelton', 'existing'],
+                          ['andrew', 'andrew'],
+                          ['melton', 'melton']),
+                         self.DATABASE.execute_sql.call_args_list[0][0][1])
+        self.UserGroups.insert_many.assert_called_once_with(
+            [{'user': 10, 'group': 1}])
+
+    @mock.patch.object(api, '_get_group_ids')
+    def test_create_users_none_valid(self, mock_get_group_ids):
+        mock_get_group_ids.return_value = {}
+
+        results = api.create_users([fixtures.TEST_USER_WITH_GROUP])
+
+        self.assertIsInstance(results[0], exceptions.GroupNotFoundException)
+        self.assertFalse(self.DATABASE.execute_sql.called)
 
     def test_create_user_already_exists(self):
-        (self.User.select.return_value
-                  .where.return_value
-                  .exists.return_value) = True
+        self.User.return_value.save.side_effect = peewee.IntegrityError()
 
         self.assertRaises(exceptions.UserAlreadyExistsException,
                           api.create_user,
                           fixtures.TEST_USER)
+        self.assertFalse(self.UserGroups.insert_from.called)
 
     def test_get_user(self):
-        mock_user = mock.MagicMock()
-        self.User.get.return_value = mock_user
+        self.cursor.description = [('id',), ('userid',), ('group_names',)]
+        self.cursor.fetchone.return_value = (1, 'test_id', ['admins'])
 
         new_user = api.get_user('test_id')
 
-        self.assertEqual(new_user, mock_user)
-        self.User.get.assert_called_once_with(self.User.userid == 'test_id')
+        self.assertEqual(self.User.return_value, new_user)
+        self.User.assert_called_once_with(id=1, userid='test_id',
+                                          group_names=['admins'])
+        self.DATABASE.execute_sql.assert_called_once_with(
+            api._GET_USER.sql, ('test_id',), require_commit=False)
 
     def test_get_user_does_not_exist(self):
-        class TestException(Exception):
-            pass
-        self.User.DoesNotExist = TestException
-        self.User.get.side_effect = self.User.DoesNotExist()
+        self.cursor.fetchone.return_value = None
 
         self.assertRaises(exceptions.UserNotFoundException,
                           api.get_user,
                           'test_id')
 
-        self.User.get.assert_called_once_with(self.User.userid == 'test_id')
+    def test_get_user_data(self):
+        self.cursor.fetchone.return_value = (1, 2, None, 'test_id', 'f', 'l',
+                                             ['admins'])
+
+        version, user = api.get_user_data('test_id')
+
+        self.assertEqual((1, 2, None), version)
+        self.assertEqual({'userid': 'test_id', 'first_name': 'f',
+                          'last_name': 'l', 'groups': ['admins']}, user)
+        self.assertFalse(self.User.called)
+
+    def test_get_user_data_does_not_exist(self):
+        self.cursor.fetchone.return_value = None
+
+        self.assertRaises(exceptions.UserNotFoundException,
+                          api.get_user_data, 'test_id')
+
+    @mock.patch.object(api, '_get_group_names_by_user')
+    def test_list_users(self, mock_get_group_names):
+        limit = self.User.select.return_value.order_by.return_value.limit
+        query = limit.return_value.tuples.return_value
+        query.where.return_value = [(1, 'b', 'f', 'l'), (2, 'c', 'f', 'l')]
+        mock_get_group_names.return_value = {1: ['admins']}
+
+        users = api.list_users(after='a', limit=10)
+
+        self.assertEqual([{'userid': 'b', 'first_name': 'f',
+                           'last_name': 'l', 'groups': ['admins']},
+                          {'userid': 'c', 'first_name': 'f',
+                           'last_name': 'l', 'groups': []}], users)
+        limit.assert_called_once_with(10)
+        query.where.assert_called_once_with(self.User.userid > 'a')
+        mock_get_group_names.assert_called_once_with([1, 2])
+
+    def test_list_groups(self):
+        limit = self.Group.select.return_value.order_by.return_value.limit
+        limit.return_value.tuples.return_value = [('admins',), ('users',)]
+
+        self.assertEqual([{'name': 'admins'}, {'name': 'users'}],
+                         api.list_groups(limit=2))
+
+    @mock.patch.object(api, '_get_group_names_by_user')
+    def test_get_users(self, mock_get_group_names):
+        query = self.User.select.return_value.where.return_value
+        query.tuples.return_value = [(2, 'c', 'f', 'l'), (1, 'b', 'f', 'l')]
+        mock_get_group_names.return_value = {1: ['admins']}
+
+        users, not_found = api.get_users(['b', 'x', 'c', 'b'])
+
+        self.assertEqual([{'userid': 'b', 'first_name': 'f',
+                           'last_name': 'l', 'groups': ['admins']},
+                          {'userid': 'c', 'first_name': 'f',
+                           'last_name': 'l', 'groups': []}], users)
+        self.assertEqual(['x'], not_found)
+        mock_get_group_names.assert_called_once_with([2, 1])
+
+    def test_get_users_none_requested(self):
+        self.assertEqual(([], []), api.get_users([]))
+        self.assertFalse(self.User.select.called)
+
+    @mock.patch.object(api, '_get_member_ids_by_group')
+    @mock.patch.object(api, '_get_group_ids')
+    def test_get_groups(self, mock_get_group_ids, mock_get_member_ids):
+        mock_get_group_ids.return_value = {'admins': 1, 'users': 2}
+        mock_get_member_ids.return_value = {1: ['a', 'b']}
+
+        groups, not_found = api.get_groups(['users', 'x', 'admins'])
+
+        self.assertEqual([{'name': 'users', 'members': []},
+                          {'name': 'admins', 'members': ['a', 'b']}],
+                         groups)
+        self.assertEqual(['x'], not_found)
+        mock_get_group_ids.assert_called_once_with(['users', 'x', 'admins'])
+        self.assertEqual([1, 2],
+                         sorted(mock_get_member_ids.call_args[0][0]))
 
     def test_save_user_fields(self):
         mock_user = mock.MagicMock()
@@ -100,151 +238,193 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(api_user['userid'], mock_user.userid)
         self.assertEqual(api_user['first_name'], mock_user.first_name)
         self.assertEqual(api_user['last_name'], mock_user.last_name)
-        self.assertTrue(mock_user.save.called)
+        only = mock_user.save.call_args[1]['only']
+        self.assertEqual([self.User.userid, self.User.first_name,
+                          self.User.last_name], only)
+        self.assertNotIn(self.User.version, only)
+        self.assertNotIn(self.User.modified_at, only)
 
-    def test_remove_unrequested_groups_keeps_existing(self):
-        mock_user = mock.MagicMock()
-        mock_group = mock.MagicMock()
-        mock_group.name = 'some_name'
-        mock_usergroup = mock.MagicMock()
-        mock_usergroup.user = mock_user
-        mock_usergroup.group = mock_group
-        mock_user.usergroups = [mock_usergroup]
-        requested_groups = {mock_group.name: mock_group}
-
-        existing_groups = api._remove_unrequested_groups(mock_user,
-                                                         requested_groups)
-        self.assertIn(mock_group.name, existing_groups)
-
-    def test_remove_unrequested_groups_delete_unrequested(self):
+    def test_save_user_fields_already_exists(self):
         mock_user = mock.MagicMock()
-        mock_group = mock.MagicMock()
-        mock_group.name = 'some_name'
-        mock_usergroup = mock.MagicMock()
-        mock_usergroup.user = mock_user
-        mock_usergroup.group = mock_group
-        mock_user.usergroups = [mock_usergroup]
+        mock_user.save.side_effect = psycopg2.IntegrityError()
 
-        existing_groups = api._remove_unrequested_groups(mock_user, {})
-        self.assertEqual(0, len(existing_groups))
-        self.assertTrue(mock_usergroup.delete_instance.called)
+        self.assertRaises(exceptions.UserAlreadyExistsException,
+                          api._save_user_fields, mock_user,
+                          fixtures.TEST_USER)
 
-    def test_add_new_groups(self):
-        mock_user = mock.MagicMock()
+    def test_get_requested_groups(self):
         mock_group = mock.MagicMock()
-        mock_group.name = 'some_name'
-        requested_groups = {mock_group.name: mock_group}
+        mock_group.name = 'admins'
+        mock_group.id = 1
+        (self.Group.select.return_value
+                   .where.return_value) = [mock_group]
+
+        requested_groups = api._get_requested_groups(
+            {'groups': ['admins', 'admins']})
+
+        self.assertEqual({'admins': 1}, requested_groups)
+        self.assertEqual(1, self.Group.select.call_count)
 
-        api._add_new_groups(mock_user, requested_groups, set())
-        self.UserGroups.assert_called_once_with(user=mock_user,
-                                                group=mock_group)
-        self.assertTrue(self.UserGroups.return_value.save.called)
+    @mock.patch.object(api, '_get_group_ids')
+    def test_get_requested_groups_in_request_order(self, mock_get_group_ids):
+        mock_get_group_ids.return_value = {'a': 1, 'b': 2, 'c': 3}
 
-    def test_add_new_groups_already_exists(self):
+        requested_groups = api._get_requested_groups(
+            {'groups': ['c', 'a', 'b', 'a']})
+
+        self.assertEqual(['c', 'a', 'b'], list(requested_groups))
+        self.assertEqual([3, 1, 2], list(requested_groups.values()))
+
+    def test_get_requested_groups_none(self):
+        self.assertEqual({}, api._get_requested_groups(fixtures.TEST_USER))
+        self.assertFalse(self.Group.select.called)
+
+    def test_remove_unrequested_groups(self):
         mock_user = mock.MagicMock()
-        mock_group = mock.MagicMock()
-        mock_group.name = 'some_name'
-        requested_groups = {mock_group.name: mock_group}
+        delete_query = (self.UserGroups.delete.return_value
+                                       .where.return_value
+                                       .returning.return_value
+                                       .tuples.return_value)
+        delete_query.where.return_value.execute.return_value = [(2,)]
 
-        api._add_new_groups(mock_user, requested_groups, {mock_group.name})
-        self.assertFalse(self.UserGroups.called)
+        removed = api._remove_unrequested_groups(mock_user, {'admins': 1})
 
-    @mock.patch.object(api, '_add_new_groups')
-    @mock.patch.object(api, '_remove_unrequested_groups')
-    @mock.patch.object(api, '_save_user_fields')
-    @mock.patch.object(api, 'get_group')
-    @mock.patch.object(api, 'get_user')
-    def test_update_user(self, mock_get_user, mock_get_group,
-                         mock_save_user_fields,
-                         mock_remove_unrequested_groups,
-                         mock_add_new_groups):
+        self.assertEqual([2], removed)
+        self.UserGroups.delete.return_value.where.assert_called_once_with(
+            self.UserGroups.user == mock_user)
+        self.assertTrue(delete_query.where.return_value.execute.called)
+
+    def test_remove_unrequested_groups_removes_all_groups(self):
         mock_user = mock.MagicMock()
-        mock_get_user.return_value = mock_user
-        mock_remove_unrequested_groups.return_value = set()
+        delete_query = (self.UserGroups.delete.return_value
+                                       .where.return_value
+                                       .returning.return_value
+                                       .tuples.return_value)
 
-        api.update_user(fixtures.TEST_USER['userid'], fixtures.TEST_USER)
+        api._remove_unrequested_groups(mock_user, {})
 
-        self.assertEqual(
-            mock_get_user.call_args_list,
-            [mock.call(fixtures.TEST_USER['userid']) for i in range(0, 2)])
-        self.assertFalse(mock_get_group.called)
-        mock_save_user_fields(mock_user, fixtures.TEST_USER)
-        mock_remove_unrequested_groups.assert_called_once_with(mock_user, {})
-        mock_add_new_groups.assert_called_once_with(mock_user, {}, set())
+        self.assertFalse(delete_query.where.called)
+        self.assertTrue(delete_query.execute.called)
 
+    def test_add_new_groups(self):
+        cursor = self.DATABASE.execute_sql.return_value
+        cursor.fetchall.return_value = [(2,)]
+        mock_user = mock.MagicMock(id=10)
+
+        added = api._add_new_groups(
+            mock_user, collections.OrderedDict([('users', 2), ('admins', 1)]))
+
+        self.assertEqual([2], added)
+        self.DATABASE.execute_sql.assert_called_once_with(
+            api._ADD_GROUPS_SQL, (10, [2, 1]))
+        self.assertFalse(self.UserGroups.called)
+
+    def test_add_new_groups_none_requested(self):
+        api._add_new_groups(mock.MagicMock(), {})
+
+        self.assertFalse(self.DATABASE.execute_sql.called)
+
+    @mock.patch.object(api, '_record_changes')
     @mock.patch.object(api, '_add_new_groups')
     @mock.patch.object(api, '_remove_unrequested_groups')
     @mock.patch.object(api, '_save_user_fields')
-    @mock.patch.object(api, 'get_group')
+    @mock.patch.object(api, '_get_requested_groups')
     @mock.patch.object(api, 'get_user')
-    def test_update_user_with_group(self, mock_get_user, mock_get_group,
+    @mock.patch.object(api, '_get_user')
+    def test_update_user(self, mock_get_user_model, mock_get_user,
+                         mock_get_requested_groups,
                          mock_save_user_fields,
                          mock_remove_unrequested_groups,
-                         mock_add_new_groups):
+                         mock_add_new_groups, mock_record_changes):
         mock_user = mock.MagicMock()
-        mock_get_user.return_value = mock_user
-        mock_group = mock.MagicMock()
-        mock_get_group.return_value = mock_group
-        existing_groups = set(fixtures.TEST_USER_WITH_GROUP['groups'][0])
-        mock_remove_unrequested_groups.return_value = existing_groups
-        requested_groups = {
-            fixtures.TEST_USER_WITH_GROUP['groups'][0]: mock_group
-        }
+        mock_user.id = 10
+        mock_get_user_model.return_value = mock_user
+        requested_groups = {'admins': 1}
+        mock_get_requested_groups.return_value = requested_groups
+        mock_remove_unrequested_groups.return_value = [2]
+        mock_add_new_groups.return_value = [1]
 
         api.update_user(fixtures.TEST_USER_WITH_GROUP['userid'],
                         fixtures.TEST_USER_WITH_GROUP)
 
-        self.assertEqual(
-            mock_get_user.call_args_list,
-            [mock.call(fixtures.TEST_USER_WITH_GROUP['userid'])
-             for i in range(0, 2)])
-        self.assertEqual(
-            mock_get_group.call_args_list,
-            [mock.call(x) for x in requested_groups.keys()])
-        mock_save_user_fields(mock_user, fixtures.TEST_USER_WITH_GROUP)
+        mock_get_user_model.assert_called_once_with(
+            fixtures.TEST_USER_WITH_GROUP['userid'])
+        mock_get_user.assert_called_once_with(
+            fixtures.TEST_USER_WITH_GROUP['userid'])
+        mock_get_requested_groups.assert_called_once_with(
+            fixtures.TEST_USER_WITH_GROUP)
+        mock_save_user_fields.assert_called_once_with(
+            mock_user, fixtures.TEST_USER_WITH_GROUP)
         mock_remove_unrequested_groups.assert_called_once_with(
             mock_user, requested_groups)
         mock_add_new_groups.assert_called_once_with(
-            mock_user, requested_groups, existing_groups)
+            mock_user, requested_groups)
+        mock_record_changes.assert_called_once_with(
+            user_ids=[10], group_ids=[2, 1], deleted_users=[])
+        self.assertTrue(self.DATABASE.transaction.called)
+
+    @mock.patch.object(api, '_record_changes')
+    @mock.patch.object(api, '_add_new_groups', return_value=[])
+    @mock.patch.object(api, '_remove_unrequested_groups', return_value=[])
+    @mock.patch.object(api, '_save_user_fields')
+    @mock.patch.object(api, '_get_requested_groups')
+    @mock.patch.object(api, 'get_user')
+    @mock.patch.object(api, '_get_user')
+    def test_update_user_rename_changes_groups(
+            self, mock_get_user_model, mock_get_user,
+            mock_get_requested_groups, mock_save_user_fields,
+            mock_remove_unrequested_groups, mock_add_new_groups,
+            mock_record_changes):
+        mock_get_user_model.return_value.id = 10
+        mock_get_requested_groups.return_value = {'admins': 1}
+        updated_user = copy.deepcopy(fixtures.TEST_USER_WITH_GROUP)
+        updated_user['userid'] = 'new_id'
+
+        api.update_user(fixtures.TEST_USER_WITH_GROUP['userid'],
+                        updated_user)
+
+        mock_record_changes.assert_called_once_with(
+            user_ids=[10], group_ids=[1],
+            deleted_users=[fixtures.TEST_USER_WITH_GROUP['userid']])
 
     @mock.patch.object(api, '_add_new_groups')
     @mock.patch.object(api, '_remove_unrequested_groups')
-    @mock.patch.object(api, '_save_user_fields')
-    @mock.patch.object(api, 'get_group')
+    @mock.patch.object(api, '_get_requested_groups')
     @mock.patch.object(api, 'get_user')
-    def test_update_user_change_userid(self, mock_get_user, mock_get_group,
-                                       mock_save_user_fields,
-                                       mock_remove_unrequested_groups,
-                                       mock_add_new_groups):
+    @mock.patch.object(api, '_get_user')
+    def test_update_user_change_userid_already_exists(
+            self, mock_get_user_model, mock_get_user,
+            mock_get_requested_groups, mock_remove_unrequested_groups,
+            mock_add_new_groups):
         mock_user = mock.MagicMock()
-        mock_get_user.return_value = mock_user
-        (self.User.select.return_value
-                  .where.return_value
-                  .exists.return_value) = False
-        mock_remove_unrequested_groups.return_value = set()
+        mock_user.save.side_effect = peewee.IntegrityError()
+        mock_get_user_model.return_value = mock_user
 
         updated_user = copy.deepcopy(fixtures.TEST_USER)
         updated_user['userid'] = 'new_id'
-        api.update_user(fixtures.TEST_USER['userid'], updated_user)
-
-        self.assertEqual(
-            mock_get_user.call_args_list,
-            [mock.call(fixtures.TEST_USER['userid']),
-             mock.call(updated_user['userid'])])
-        self.assertTrue(self.User.select.return_value
-                                 .where.return_value
-                                 .exists.called)
-        self.assertFalse(mock_get_group.called)
-        mock_save_user_fields(mock_user, fixtures.TEST_USER)
-        mock_remove_unrequested_groups.assert_called_once_with(mock_user, {})
-        mock_add_new_groups.assert_called_once_with(mock_user, {}, set())
-
-    def test_delete_user(self):
+        self.assertRaises(exceptions.UserAlreadyExistsException,
+                          api.update_user, fixtures.TEST_USER['userid'],
+                          updated_user)
+
+        self.assertFalse(mock_remove_unrequested_groups.called)
+        self.assertFalse(mock_add_new_groups.called)
+        self.assertFalse(mock_get_user.called)
+
+    @mock.patch.object(api, '_record_changes')
+    def test_delete_user(self, mock_record_changes):
         mock_user = mock.MagicMock()
         self.User.get.return_value = mock_user
+        (self.UserGroups.delete.return_value
+                        .where.return_value
+                        .returning.return_value
+                        .tuples.return_value
+                        .execute.return_value) = [(1,), (2,)]
 
         api.delete_user('some_id')
 
+        mock_record_changes.assert_called_once_with(
+            group_ids=[1, 2], deleted_users=['some_id'])
+
         self.User.get.assert_called_once_with(self.User.userid == 'some_id')
         self.UserGroups.delete.return_value.where.assert_called_once_with(
             self.UserGroups.user == mock_user
@@ -265,9 +445,7 @@ class APITestCase(unittest.TestCase):
     def test_create_group(self):
         mock_group = mock.MagicMock()
 
-        (self.Group.select.return_value
-                   .where.return_value
-                   .exists.return_value) = False
+        self.cursor.fetchone.return_value = None
         self.Group.return_value = mock_group
 
         group_name = 'test_group'
@@ -278,9 +456,7 @@ class APITestCase(unittest.TestCase):
         mock_group.save.assert_called_once_with()
 
     def test_create_group_already_exists(self):
-        (self.Group.select.return_value
-                   .where.return_value
-                   .exists.return_value) = True
+        self.cursor.fetchone.return_value = (1,)
 
         group_name = 'test_group'
         self.assertRaises(exceptions.GroupAlreadyExistsException,
@@ -288,150 +464,550 @@ class APITestCase(unittest.TestCase):
         self.assertFalse(self.Group.called)
 
     def test_get_group(self):
-        mock_group = mock.MagicMock()
-        self.Group.get.return_value = mock_group
+        self.cursor.description = [('id',), ('name',)]
+        self.cursor.fetchone.return_value = (1, 'test_name')
 
         group = api.get_group('test_name')
 
-        self.assertEqual(mock_group, group)
-        self.Group.get.assert_called_once_with(self.Group.name == 'test_name')
+        self.assertEqual(self.Group.return_value, group)
+        self.Group.assert_called_once_with(id=1, name='test_name')
+        self.DATABASE.execute_sql.assert_called_once_with(
+            api._GET_GROUP.sql, ('test_name',), require_commit=False)
 
     def test_get_group_does_not_exist(self):
-        class TestException(Exception):
-            pass
-        self.Group.DoesNotExist = TestException
-        self.Group.get.side_effect = self.Group.DoesNotExist()
+        self.cursor.fetchone.return_value = None
 
         self.assertRaises(exceptions.UserNotFoundException,
                           api.get_group,
                           'test_name')
-        self.Group.get.assert_called_once_with(self.Group.name == 'test_name')
 
-    def test_remove_unrequested_users_no_changes(self):
+    def test_get_requested_users(self):
         mock_user = mock.MagicMock()
         mock_user.userid = 'id1'
-        requested_users = {mock_user.userid: mock_user}
+        mock_user.id = 1
+        (self.User.select.return_value
+                  .where.return_value) = [mock_user]
 
-        mock_group = mock.MagicMock()
-        mock_usergroup = mock.MagicMock()
-        mock_usergroup.user = mock_user
-        mock_usergroup.group = mock_group
-        mock_group.usergroups = [mock_usergroup]
+        requested_users = api._get_requested_users(['id1', 'id1'])
 
-        existing_users = api._remove_unrequested_users(mock_group,
-                                                       requested_users)
+        self.assertEqual({'id1': 1}, requested_users)
+        self.assertEqual(1, self.User.select.call_count)
 
-        self.assertEqual(1, len(existing_users))
-        self.assertTrue(mock_user.userid in existing_users)
+    def test_get_requested_users_does_not_exist(self):
+        mock_user = mock.MagicMock()
+        mock_user.userid = 'id1'
+        (self.User.select.return_value
+                  .where.return_value) = [mock_user]
 
-    def test_remove_unrequested_users_removes_user(self):
-        mock_user1 = mock.MagicMock()
-        mock_user1.userid = 'id1'
-        mock_user2 = mock.MagicMock()
-        mock_user2.userid = 'id2'
-        requested_users = {mock_user1.userid: mock_user1}
+        self.assertRaises(exceptions.UserNotFoundException,
+                          api._get_requested_users, ['id1', 'id2'])
 
+    def test_remove_unrequested_users(self):
         mock_group = mock.MagicMock()
-        mock_usergroup1 = mock.MagicMock()
-        mock_usergroup1.user = mock_user1
-        mock_usergroup1.group = mock_group
-        mock_usergroup2 = mock.MagicMock()
-        mock_usergroup2.user = mock_user2
-        mock_usergroup2.group = mock_group
-        mock_group.usergroups = [mock_usergroup1, mock_usergroup2]
+        delete_query = (self.UserGroups.delete.return_value
+                                       .where.return_value
+                                       .returning.return_value
+                                       .tuples.return_value)
+        delete_query.where.return_value.execute.return_value = [(2,)]
 
-        existing_users = api._remove_unrequested_users(mock_group,
-                                                       requested_users)
+        removed = api._remove_unrequested_users(mock_group, {'id1': 1})
 
-        self.assertEqual(1, len(existing_users))
-        self.assertTrue(mock_user1.userid in existing_users)
-        self.assertFalse(mock_user2.delete_instance.called)
+        self.assertEqual([2], removed)
+        self.assertEqual(1, self.UserGroups.delete.call_count)
+        self.UserGroups.delete.return_value.where.assert_called_once_with(
+            self.UserGroups.group == mock_group)
+        self.assertTrue(delete_query.where.called)
+        self.assertTrue(delete_query.where.return_value.execute.called)
 
     def test_remove_unrequested_users_removes_all_users(self):
-        mock_user1 = mock.MagicMock()
-        mock_user1.userid = 'id1'
-        mock_user2 = mock.MagicMock()
-        mock_user2.userid = 'id2'
-
         mock_group = mock.MagicMock()
-        mock_usergroup1 = mock.MagicMock()
-        mock_usergroup1.user = mock_user1
-        mock_usergroup1.group = mock_group
-        mock_usergroup2 = mock.MagicMock()
-        mock_usergroup2.user = mock_user2
-        mock_usergroup2.group = mock_group
-        mock_group.usergroups = [mock_usergroup1, mock_usergroup2]
+        delete_query = (self.UserGroups.delete.return_value
+                                       .where.return_value
+                                       .returning.return_value
+                                       .tuples.return_value)
 
-        existing_users = api._remove_unrequested_users(mock_group, {})
+        api._remove_unrequested_users(mock_group, {})
 
-        self.assertEqual(0, len(existing_users))
+        self.assertFalse(delete_query.where.called)
+        self.assertTrue(delete_query.execute.called)
 
     def test_add_new_users(self):
-        mock_user1 = mock.MagicMock()
-        mock_user1.userid = 'id1'
-        mock_user2 = mock.MagicMock()
-        mock_user2.userid = 'id2'
-        requested_users = {mock_user1.userid: mock_user1,
-                           mock_user2.userid: mock_user2}
         mock_group = mock.MagicMock()
 
-        api._add_new_users(mock_group, requested_users, {mock_user1.userid})
+        self.UserGroups.user.db_column = 'user_id'
+        cursor = self.DATABASE.execute_sql.return_value
+        cursor.fetchall.return_value = [(2,)]
 
-        self.UserGroups.assert_called_once_with(user=mock_user2,
-                                                group=mock_group)
-        self.assertTrue(self.UserGroups.return_value.save.called)
+        added = api._add_new_users(mock_group, {'id1': 1, 'id2': 2})
 
-    def test_add_new_users_no_new(self):
-        mock_user = mock.MagicMock()
-        mock_user.userid = 'id1'
-        requested_users = {mock_user.userid: mock_user}
-        mock_group = mock.MagicMock()
+        self.assertEqual([2], added)
+        self.assertEqual(1, self.UserGroups.insert_from.call_count)
+        self.DATABASE.execute_sql.assert_called_once_with(
+            'INSERT ON CONFLICT DO NOTHING RETURNING "user_id"', [1])
+        self.assertFalse(self.UserGroups.called)
 
-        api._add_new_users(mock_group, requested_users, {mock_user.userid})
+    def test_add_new_users_no_new(self):
+        api._add_new_users(mock.MagicMock(), {})
 
-        self.assertFalse(self.UserGroups.called)
+        self.assertFalse(self.UserGroups.insert_from.called)
 
     @mock.patch.object(api, '_add_new_users')
     @mock.patch.object(api, '_remove_unrequested_users')
-    @mock.patch.object(api, 'get_user')
+    @mock.patch.object(api, '_get_requested_users')
     @mock.patch.object(api, 'get_group')
-    def test_update_group(self, mock_get_group, mock_get_user,
+    def test_update_group(self, mock_get_group, mock_get_requested_users,
                           mock_remove_unrequested_users,
                           mock_add_new_users):
         mock_group = mock.MagicMock()
         mock_get_group.return_value = mock_group
-        mock_user1 = mock.MagicMock()
-        mock_user1.userid = 'id1'
-        mock_user2 = mock.MagicMock()
-        mock_user2.userid = 'id2'
-        mock_get_user.side_effect = [mock_user1, mock_user2]
-        requested_users = {mock_user1.userid: mock_user1,
-                           mock_user2.userid: mock_user2}
-        existing_users = {mock_user1.userid}
-        mock_remove_unrequested_users.return_value = existing_users
-
-        group = api.update_group('test_group', [mock_user1.userid,
-                                                mock_user2.userid])
+        requested_users = {'id1': 1, 'id2': 2}
+        mock_get_requested_users.return_value = requested_users
+        mock_remove_unrequested_users.return_value = []
+        mock_add_new_users.return_value = [2]
+
+        group = api.update_group('test_group', ['id1', 'id2'])
 
         self.assertEqual(mock_group, group)
-        mock_get_group.assert_has_calls([mock.call('test_group'),
-                                        mock.call('test_group')])
-        mock_get_user.assert_has_calls([mock.call(mock_user1.userid),
-                                        mock.call(mock_user2.userid)])
+        mock_get_group.assert_called_once_with('test_group')
+        mock_get_requested_users.assert_called_once_with(['id1', 'id2'])
         mock_remove_unrequested_users.assert_called_once_with(
-            mock_group, requested_users
-        )
+            mock_group, requested_users)
         mock_add_new_users.assert_called_once_with(mock_group,
-                                                   requested_users,
-                                                   existing_users)
+                                                   requested_users)
+        self.assertTrue(self.DATABASE.transaction.called)
 
-    def test_delete_group(self):
-        mock_group = mock.MagicMock()
-        self.Group.get.return_value = mock_group
+    @mock.patch.object(api, '_add_new_users')
+    @mock.patch.object(api, '_remove_unrequested_users')
+    @mock.patch.object(api, '_get_requested_users')
+    @mock.patch.object(api, 'get_group')
+    def test_update_group_user_does_not_exist(self, mock_get_group,
+                                              mock_get_requested_users,
+                                              mock_remove_unrequested_users,
+                                              mock_add_new_users):
+        exc = exceptions.UserNotFoundException()
+        mock_get_requested_users.side_effect = exc
+
+        self.assertRaises(exceptions.UserNotFoundException,
+                          api.update_group, 'test_group', ['id1'])
+
+        self.assertFalse(mock_remove_unrequested_users.called)
+        self.assertFalse(mock_add_new_users.called)
+
+    @mock.patch.object(api, '_record_changes')
+    @mock.patch.object(api, '_remove_memberships')
+    @mock.patch.object(api, '_add_new_users')
+    @mock.patch.object(api, '_get_user_ids')
+    def test_patch_group_members(self, mock_get_user_ids, mock_add_new_users,
+                                 mock_remove_memberships,
+                                 mock_record_changes):
+        self.cursor.fetchone.return_value = (7, 1, None)
+        mock_get_user_ids.return_value = {'id1': 1, 'id2': 2, 'id3': 3}
+        mock_add_new_users.return_value = [2]
+        mock_remove_memberships.return_value = [3]
+
+        added, removed = api.patch_group_members(
+            'admins', add=['id1', 'id2'], remove=['id3', 'id4'])
+
+        self.assertEqual((['id2'], ['id3']), (added, removed))
+        mock_get_user_ids.assert_called_once_with(['id1', 'id2', 'id3',
+                                                   'id4'])
+        self.assertEqual({'id1': 1, 'id2': 2},
+                         mock_add_new_users.call_args[0][1])
+        self.assertEqual((self.UserGroups.user, [3]),
+                         mock_remove_memberships.call_args[0][:2])
+        mock_record_changes.assert_called_once_with(user_ids=[2, 3],
+                                                    group_ids=[7])
+
+    @mock.patch.object(api, '_record_changes')
+    @mock.patch.object(api, '_remove_memberships', return_value=[])
+    @mock.patch.object(api, '_add_new_users', return_value=[])
+    @mock.patch.object(api, '_get_user_ids', return_value={'id1': 1})
+    def test_patch_group_members_unchanged(self, mock_get_user_ids,
+                                           mock_add_new_users,
+                                           mock_remove_memberships,
+                                           mock_record_changes):
+        self.cursor.fetchone.return_value = (7, 1, None)
+
+        self.assertEqual(([], []),
+                         api.patch_group_members('admins', add=['id1']))
+        # Nothing changed, so the version and documents are left alone.
+        self.assertFalse(mock_record_changes.called)
+
+    @mock.patch.object(api, '_add_new_users')
+    @mock.patch.object(api, '_get_user_ids', return_value={'id1': 1})
+    def test_patch_group_members_not_found(self, mock_get_user_ids,
+                                           mock_add_new_users):
+        self.cursor.fetchone.return_value = None
+        self.assertRaises(exceptions.GroupNotFoundException,
+                          api.patch_group_members, 'admins', add=['id1'])
+
+        self.cursor.fetchone.return_value = (7, 1, None)
+        self.assertRaises(exceptions.UserNotFoundException,
+                          api.patch_group_members, 'admins',
+                          add=['id1', 'id2'])
+        self.assertFalse(mock_add_new_users.called)
+
+    @mock.patch.object(api, '_record_changes')
+    @mock.patch.object(api, '_remove_memberships', return_value=[4])
+    @mock.patch.object(api, '_add_new_groups', return_value=[])
+    @mock.patch.object(api, '_get_group_ids')
+    def test_patch_user_groups(self, mock_get_group_ids, mock_add_new_groups,
+                               mock_remove_memberships, mock_record_changes):
+        self.cursor.fetchone.return_value = (9, 1, None)
+        mock_get_group_ids.return_value = {'admins': 3, 'users': 4}
+
+        added, removed = api.patch_user_groups('id1', add=['admins'],
+                                               remove=['users'])
+
+        self.assertEqual(([], ['users']), (added, removed))
+        self.assertEqual({'admins': 3}, mock_add_new_groups.call_args[0][1])
+        self.assertEqual((self.UserGroups.group, [4]),
+                         mock_remove_memberships.call_args[0][:2])
+        mock_record_changes.assert_called_once_with(user_ids=[9],
+                                                    group_ids=[4])
+
+    @mock.patch.object(api, '_get_group_ids', return_value={})
+    def test_patch_user_groups_not_found(self, mock_get_group_ids):
+        self.cursor.fetchone.return_value = None
+        self.assertRaises(exceptions.UserNotFoundException,
+                          api.patch_user_groups, 'id1', add=['admins'])
+
+        self.cursor.fetchone.return_value = (9, 1, None)
+        self.assertRaises(exceptions.GroupNotFoundException,
+                          api.patch_user_groups, 'id1', add=['admins'])
+
+    def test_remove_memberships(self):
+        query = (self.UserGroups.delete.return_value
+                                .where.return_value
+                                .returning.return_value
+                                .tuples.return_value)
+        query.execute.return_value = [(3,)]
+
+        self.assertEqual([3], api._remove_memberships(
+            self.UserGroups.user, [3, 4], self.UserGroups.group == 7))
+        self.assertEqual([], api._remove_memberships(
+            self.UserGroups.user, [], self.UserGroups.group == 7))
+        self.assertEqual(1, query.execute.call_count)
+
+    def test_run_in_transaction(self):
+        func = mock.Mock(return_value='result')
+
+        self.assertEqual('result', api.run_in_transaction(func, 1, a=2))
+
+        func.assert_called_once_with(1, a=2)
+        self.DATABASE.transaction.assert_called_once_with()
+
+    @mock.patch.object(api.time, 'sleep')
+    def test_run_in_transaction_retries(self, mock_sleep):
+        func = mock.Mock(side_effect=[_rollback_error('40P01'),
+                                      _rollback_error('40001'), 'result'])
+
+        self.assertEqual('result', api.run_in_transaction(func))
+
+        self.assertEqual(3, func.call_count)
+        self.assertEqual(3, self.DATABASE.transaction.call_count)
+        self.assertEqual(2, mock_sleep.call_count)
+        for (delay,), _ in mock_sleep.call_args_list:
+            self.assertTrue(0 <= delay <= api.RETRY_MAX_DELAY)
+
+    @mock.patch.dict(api.os.environ, {'TRANSACTION_RETRIES': '2'})
+    @mock.patch.object(api.time, 'sleep')
+    def test_run_in_transaction_gives_up(self, mock_sleep):
+        func = mock.Mock(side_effect=_rollback_error('40001'))
+
+        self.assertRaises(exceptions.TransactionConflictException,
+                          api.run_in_transaction, func)
+        self.assertEqual(3, func.call_count)
+
+    @mock.patch.object(api.time, 'sleep')
+    def test_run_in_transaction_other_errors(self, mock_sleep):
+        error = _rollback_error('40002')
+        for exc in (error, exceptions.UserNotFoundException()):
+            func = mock.Mock(side_effect=exc)
+            self.assertRaises(type(exc), api.run_in_transaction, func)
+            self.assertEqual(1, func.call_count)
+        self.assertFalse(mock_sleep.called)
+
+    @mock.patch.object(api.cache, 'handle_message')
+    @mock.patch.object(api.cache, 'enabled', return_value=True)
+    def test_invalidate(self, mock_enabled, mock_handle_message):
+        api._invalidate(users=['id1'], groups=['admins'])
+
+        payload = '{"groups": ["admins"], "users": ["id1"]}'
+        self.DATABASE.execute_sql.assert_called_once_with(
+            'SELECT pg_notify(%s, %s)', (api.cache.CHANNEL, payload))
+        mock_handle_message.assert_called_once_with(payload)
+
+    def test_invalidate_cache_disabled(self):
+        api._invalidate(users=['id1'])
+
+        self.assertFalse(self.DATABASE.execute_sql.called)
+
+    def test_touch_users(self):
+        query = (self.User.update.return_value
+                          .where.return_value
+                          .returning.return_value
+                          .tuples.return_value)
+        query.execute.return_value = [('id1',)]
+
+        self.assertEqual(['id1'], api._touch_users([1]))
+        self.assertTrue(self.User.update.called)
+
+    def test_touch_none(self):
+        self.assertEqual([], api._touch_users([]))
+        self.assertEqual([], api._touch_groups([]))
+        self.assertFalse(self.User.update.called)
+        self.assertFalse(self.Group.update.called)
+
+    @mock.patch.object(api, '_refresh_documents')
+    @mock.patch.object(api, '_invalidate')
+    @mock.patch.object(api, '_touch_groups', return_value=['admins'])
+    @mock.patch.object(api, '_touch_users', return_value=['id1'])
+    def test_record_changes(self, mock_touch_users, mock_touch_groups,
+                            mock_invalidate, mock_refresh_documents):
+        api._record_changes(user_ids=[1, 1], group_ids=[2],
+                            deleted_users=['old_id'])
+
+        mock_touch_users.assert_called_once_with([1])
+        mock_touch_groups.assert_called_once_with([2])
+        mock_refresh_documents.assert_called_once_with(
+            user_ids=[1], group_ids=[2], defer_groups=True)
+        mock_invalidate.assert_called_once_with(users=['id1', 'old_id'],
+                                                groups=['admins'])
+
+    def _executed(self):
+        return [c[0][0] for c in self.DATABASE.execute_sql.call_args_list]
+
+    @mock.patch.dict(api.os.environ, {'PRECOMPUTE_DOCUMENTS': '1',
+                                      'DOCUMENT_MAX_GROUP_SIZE': '5'})
+    def test_refresh_documents(self):
+        cursor = self.DATABASE.execute_sql.return_value
+        cursor.__iter__.return_value = [(1, u'id1', u'J\xfcrgen', u'S', [])]
+        cursor.fetchall.return_value = []
+
+        api._refresh_documents(user_ids=[1], group_ids=[2])
+
+        executed = self._executed()
+        self.assertEqual(['DELETE FROM userdocument WHERE user_id = ANY(%s)',
+                          api._USER_DOCUMENT_SQL,
+                          api._INSERT_DOCUMENTS_SQL % ('userdocument',
+                                                       'user_id'),
+                          'DELETE FROM groupdocument '
+                          'WHERE group_id = ANY(%s)',
+                          api._GROUP_DOCUMENT_SQL], executed)
+        self.assertEqual((5, 6, [2]),
+                         self.DATABASE.execute_sql.call_args[0][1])
+        ids, bodies = self.DATABASE.execute_sql.call_args_list[2][0][1]
+        self.assertEqual([1], ids)
+        # Encoded like every other response: compact and ASCII only.
+        self.assertNotIn(' ', bodies[0])
+        self.assertIn('J\\u00fcrgen', bodies[0])
+        self.assertEqual({'userid': 'id1', 'first_name': u'J\xfcrgen',
+                          'last_name': 'S', 'groups': []},
+                         json.loads(bodies[0]))
+
+    @mock.patch.object(api, '_rebuild_later')
+    @mock.patch.dict(api.os.environ, {'PRECOMPUTE_DOCUMENTS': '1'})
+    def test_refresh_documents_defer_groups(self, mock_rebuild_later):
+        api._refresh_documents(user_ids=[1], group_ids=[2, 3],
+                               defer_groups=True)
+
+        self.assertEqual(['DELETE FROM userdocument WHERE user_id = ANY(%s)',
+                          api._USER_DOCUMENT_SQL,
+                          'DELETE FROM groupdocument '
+                          'WHERE group_id = ANY(%s)'], self._executed())
+        mock_rebuild_later.assert_called_once_with([2, 3])
+
+    @mock.patch.object(api, '_rebuild_later')
+    @mock.patch.dict(api.os.environ, {'PRECOMPUTE_DOCUMENTS': '0'})
+    def test_refresh_documents_defer_groups_disabled(self,
+                                                     mock_rebuild_later):
+        api._refresh_documents(group_ids=[2], defer_groups=True)
+
+        self.assertFalse(mock_rebuild_later.called)
+
+    @mock.patch.dict(api.os.environ, {'PRECOMPUTE_DOCUMENTS': '1'})
+    def test_rebuild_group_document(self):
+        conn = mock.MagicMock()
+        cursor = conn.cursor.return_value
+        cursor.fetchall.return_value = [(7, [u'a', u'\xe9'])]
+
+        api.rebuild_group_document(conn, 7)
+
+        self.assertTrue(conn.__enter__.called)
+        executed = [c[0][0] for c in cursor.execute.call_args_list]
+        self.assertIn('FOR SHARE', executed[0])
+        self.assertEqual(api._GROUP_DOCUMENT_SQL, executed[2])
+        self.assertEqual([7], cursor.execute.call_args_list[2][0][1][2])
+        self.assertIn('INSERT INTO groupdocument', executed[3])
+        self.assertEqual(([7], ['["a","\\u00e9"]']),
+                         cursor.execute.call_args[0][1])
+        self.assertFalse(self.DATABASE.execute_sql.called)
+
+    @mock.patch.object(api, 'rebuild_group_document')
+    def test_document_rebuilder(self, mock_rebuild_group_document):
+        mock_rebuild_group_document.side_effect = [None, Exception(), None]
+        conn = mock.Mock()
+        rebuilder = api.DocumentRebuilder()
+        rebuilder.add([3, 1])
+        rebuilder.add([3, 2])
+
+        with mock.patch.object(api.time, 'sleep'):
+            failed = rebuilder.rebuild(conn, rebuilder._take())
+
+        self.assertEqual([2], failed)
+        self.assertEqual([mock.call(conn, 1), mock.call(conn, 2),
+                          mock.call(conn, 3)],
+                         mock_rebuild_group_document.call_args_list)
+
+    @mock.patch.object(api, 'rebuild_group_document')
+    @mock.patch.object(api.pg_extensions, 'register_type')
+    @mock.patch.object(api, 'connect_unpooled')
+    def test_document_rebuilder_flush(self, mock_connect, mock_register_type,
+                                      mock_rebuild_group_document):
+        rebuilder = api.DocumentRebuilder()
+        rebuilder.flush()
+        self.assertFalse(mock_connect.called)
+
+        rebuilder.add([4])
+        rebuilder.flush()
+
+        conn = mock_connect.return_value
+        mock_rebuild_group_document.assert_called_once_with(conn, 4)
+        self.assertTrue(conn.close.called)
+        # Never from the request pool.
+        self.assertFalse(self.DATABASE.connect.called)
+
+    @mock.patch.dict(api.os.environ, {'PRECOMPUTE_DOCUMENTS': '0'})
+    def test_refresh_documents_disabled_drops(self):
+        api._refresh_documents(user_ids=[1], group_ids=[2])
+
+        executed = self._executed()
+        self.assertEqual(2, len(executed))
+        self.assertTrue(all(sql.startswith('DELETE') for sql in executed))
+
+    def test_refresh_documents_none(self):
+        api._refresh_documents()
+
+        self.assertFalse(self.DATABASE.execute_sql.called)
+
+    @mock.patch.object(api, '_refresh_documents')
+    def test_refresh_all_documents(self, mock_refresh_documents):
+        for model, batches in ((self.User, [[(1,), (2,)], [(3,)], []]),
+                               (self.Group, [[(7,)], []])):
+            query = (model.select.return_value
+                          .where.return_value
+                          .order_by.return_value
+                          .limit.return_value
+                          .tuples)
+            query.side_effect = [iter(batch) for batch in batches]
+
+        self.assertEqual((3, 1), api.refresh_all_documents(batch_size=2))
+        self.assertEqual([mock.call(user_ids=[1, 2]), mock.call(user_ids=[3]),
+                          mock.call(group_ids=[7])],
+                         mock_refresh_documents.call_args_list)
+
+    def test_get_user_document(self):
+        self.cursor.fetchone.return_value = (1, 2, None, '{}')
+
+        self.assertEqual(((1, 2, None), '{}'), api.get_user_document('id1'))
+
+    def test_get_user_document_does_not_exist(self):
+        self.cursor.fetchone.return_value = None
+
+        self.assertRaises(exceptions.UserNotFoundException,
+                          api.get_user_document, 'id1')
+
+    def test_get_user_version(self):
+        version = (1, 2, None)
+        self.cursor.fetchone.return_value = version
+
+        self.assertEqual(version, api.get_user_version('id1'))
+        # Answered from the userid index, without the group join.
+        self.assertNotIn('JOIN', api._GET_USER_VERSION.sql)
+
+    def test_get_group_version_does_not_exist(self):
+        self.cursor.fetchone.return_value = None
+
+        self.assertRaises(exceptions.GroupNotFoundException,
+                          api.get_group_version, 'admins')
+
+    def test_list_user_groups(self):
+        self.cursor.fetchall.return_value = [(1, 'admins'), (4, 'users')]
+
+        groups = api.list_user_groups('id1', after=None, limit=2)
+
+        self.assertEqual([(1, 'admins'), (4, 'users')], groups)
+        self.DATABASE.execute_sql.assert_called_once_with(
+            api._LIST_USER_GROUPS.sql, (0, 2, 'id1'), require_commit=False)
+
+    def test_list_user_groups_without_groups(self):
+        self.cursor.fetchall.return_value = [(None, None)]
+
+        self.assertEqual([], api.list_user_groups('id1', after=3))
+
+    def test_list_user_groups_user_does_not_exist(self):
+        self.cursor.fetchall.return_value = []
+
+        self.assertRaises(exceptions.UserNotFoundException,
+                          api.list_user_groups, 'id1')
+
+    def test_check_membership(self):
+        self.cursor.fetchone.return_value = (1, 2, True)
+
+        api.check_membership('admins', 'id1')
+
+        self.DATABASE.execute_sql.assert_called_once_with(
+            api._GET_MEMBERSHIP.sql, ('admins', 'id1'), require_commit=False)
+
+    def test_check_membership_not_found(self):
+        for row, exc in (((None, None, False),
+                          exceptions.GroupNotFoundException),
+                         ((1, None, False), exceptions.UserNotFoundException),
+                         ((1, 2, False),
+                          exceptions.MembershipNotFoundException)):
+            self.cursor.fetchone.return_value = row
+            self.assertRaises(exc, api.check_membership, 'admins', 'id1')
+
+    def test_iter_group_member_ids(self):
+        query = (self.User.select.return_value
+                          .join.return_value
+                          .where.return_value
+                          .order_by.return_value
+                          .tuples.return_value)
+        query.sql.return_value = ('SELECT', [1])
+        cursor = self.DATABASE.execute_sql.return_value
+        cursor.__iter__.return_value = iter([('a',), ('b',)])
+
+        member_ids = list(api.iter_group_member_ids(mock.MagicMock()))
+
+        self.assertEqual(['a', 'b'], member_ids)
+        self.DATABASE.execute_sql.assert_called_once_with(
+            'SELECT', [1], require_commit=False, named_cursor=True)
+        self.assertEqual(api.SERVER_SIDE_BATCH_SIZE, cursor.itersize)
+        self.assertTrue(self.DATABASE.atomic.called)
+
+    def test_iter_group_member_ids_client_side(self):
+        query = (self.User.select.return_value
+                          .join.return_value
+                          .where.return_value
+                          .order_by.return_value
+                          .tuples.return_value)
+        query.__iter__.return_value = iter([('a',), ('b',)])
+
+        member_ids = list(api.iter_group_member_ids(mock.MagicMock(),
+                                                    server_side=False))
+
+        self.assertEqual(['a', 'b'], member_ids)
+        self.assertFalse(self.DATABASE.execute_sql.called)
+
+    @mock.patch.object(api, 'get_group')
+    def test_delete_group(self, mock_get_group):
+        mock_group = mock_get_group.return_value
 
         api.delete_group('test_name')
 
-        self.Group.get.assert_called_once_with(self.Group.name == 'test_name')
+        mock_get_group.assert_called_once_with('test_name')
         self.assertTrue(mock_group.delete_instance.called)
         self.assertTrue(self.UserGroups.delete.called)
         self.UserGroups.delete.return_value.where.assert_called_once_with(
@@ -439,4 +1015,21 @@ class APITestCase(unittest.TestCase):
         )
         self.assertTrue(self.UserGroups.delete.return_value
                                        .where.return_value
+                                       .returning.return_value
+                                       .tuples.return_value
                                        .execute.called)
+        self.assertTrue(self.DATABASE.transaction.called)
+
+
+class ModelTestCase(unittest.TestCase):
+    def test_user_to_dict_uses_aggregated_groups(self):
+        user = api.User(userid='test_id', first_name='f', last_name='l')
+        user.group_names = ['admins', 'users']
+
+        with mock.patch.object(api.Group, 'select') as mock_select:
+            self.assertEqual({'userid': 'test_id',
+                              'first_name': 'f',
+                              'last_name': 'l',
+                              'groups': ['admins', 'users']},
+                             user.to_dict())
+            self.assertFalse(mock_select.called)
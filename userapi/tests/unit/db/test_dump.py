@@ -0,0 +1,68 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from userapi.db import dump
+
+
+class DumpTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.database = mock.MagicMock()
+        self.cursor = self.database.get_cursor.return_value
+        self.out = io.BytesIO()
+
+    def test_export_tables(self):
+        def copy_expert(sql, f, size):
+            f.write(b'userid\n')
+        self.cursor.copy_expert.side_effect = copy_expert
+
+        dump.export_tables(self.database, self.directory, out=self.out)
+
+        self.assertTrue(self.database.atomic.called)
+        self.assertEqual(len(dump.EXPORT_QUERIES),
+                         self.cursor.copy_expert.call_count)
+        for filename, query in dump.EXPORT_QUERIES:
+            with open(os.path.join(self.directory, filename)) as f:
+                self.assertEqual('userid\n', f.read())
+        sql = self.cursor.copy_expert.call_args_list[0][0][0]
+        self.assertTrue(sql.startswith('COPY (SELECT'))
+        self.assertIn('TO STDOUT', sql)
+
+    def test_import_tables(self):
+        for filename, _, _, _ in dump.IMPORT_TABLES:
+            with open(os.path.join(self.directory, filename), 'w') as f:
+                f.write('header\nrow\n')
+        read = []
+        self.cursor.copy_expert.side_effect = (
+            lambda sql, f, size: read.append(f.read()))
+
+        dump.import_tables(self.database, self.directory, out=self.out)
+
+        self.assertTrue(self.database.atomic.called)
+        self.assertEqual([b'header\nrow\n'] * len(dump.IMPORT_TABLES), read)
+        executed = [c[0][0] for c in
+                    self.database.execute_sql.call_args_list]
+        self.assertEqual(
+            2 * len(dump.IMPORT_TABLES) + len(dump.IMPORT_TOUCH_SQL) + 1,
+            len(executed))
+        self.assertTrue(executed[0].startswith('CREATE TEMPORARY TABLE'))
+        self.assertEqual(dump.IMPORT_TABLES[0][3], executed[1])
+        # Caches in every API process are flushed once the import commits.
+        self.assertIn('pg_notify', executed[-1])
+
+    def test_progress_file_reports(self):
+        progress = dump.ProgressFile(io.BytesIO(b'x' * 10), 'users.csv',
+                                     total=10, out=self.out)
+
+        progress.read()
+        progress.report(rows=1)
+
+        self.assertEqual(10, progress.bytes)
+        self.assertIn('users.csv: 0.0 MB (100%), 1 rows',
+                      self.out.getvalue())
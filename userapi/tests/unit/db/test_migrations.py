@@ -0,0 +1,137 @@
+import io
+import unittest
+
+import mock
+import psycopg2
+
+from userapi.db import migrations
+
+
+class LockNotAvailable(psycopg2.OperationalError):
+    pgcode = migrations.LOCK_NOT_AVAILABLE
+
+
+class MigrationsTestCase(unittest.TestCase):
+    def setUp(self):
+        self.database = mock.MagicMock()
+        self.cursor = self.database.execute_sql.return_value
+        self.out = io.BytesIO()
+
+        sleep_patcher = mock.patch.object(migrations.time, 'sleep')
+        self.mock_sleep = sleep_patcher.start()
+        self.addCleanup(sleep_patcher.stop)
+
+    def _executed(self):
+        return [c[0][0] for c in self.database.execute_sql.call_args_list]
+
+    def test_migrate_applies_pending(self):
+        self.cursor.fetchall.return_value = [(1,)]
+        step = mock.MagicMock()
+        pending = migrations.Migration(2, 'second', [step])
+        migrations_list = [migrations.Migration(1, 'first', [step]), pending]
+
+        with mock.patch.object(migrations, 'MIGRATIONS', migrations_list):
+            migrations.migrate(self.database, out=self.out)
+
+        step.apply.assert_called_once_with(self.database)
+        executed = self._executed()
+        self.assertIn('pg_advisory_lock', executed[1])
+        self.assertTrue(executed[-2].startswith(
+            'INSERT INTO %s' % migrations.MIGRATIONS_TABLE))
+        self.assertEqual((2, 'second'),
+                         self.database.execute_sql.call_args_list[-2][0][1])
+        self.assertIn('pg_advisory_unlock', executed[-1])
+
+    def test_migrate_unlocks_on_failure(self):
+        self.cursor.fetchall.return_value = []
+        step = mock.MagicMock()
+        step.apply.side_effect = ValueError()
+        migrations_list = [migrations.Migration(1, 'first', [step])]
+
+        with mock.patch.object(migrations, 'MIGRATIONS', migrations_list):
+            self.assertRaises(ValueError, migrations.migrate, self.database,
+                              out=self.out)
+
+        executed = self._executed()
+        self.assertIn('pg_advisory_unlock', executed[-1])
+        self.assertFalse(any(sql.startswith('INSERT') for sql in executed))
+
+    def test_statement_retries_lock_timeout(self):
+        calls = []
+
+        def execute_sql(sql, params=None):
+            calls.append(sql)
+            if sql == 'ALTER' and calls.count('ALTER') == 1:
+                raise LockNotAvailable()
+        self.database.execute_sql.side_effect = execute_sql
+
+        migrations.Statement('ALTER').apply(self.database)
+
+        self.assertEqual(2, calls.count('ALTER'))
+        self.assertIn('lock_timeout', calls[0])
+        self.assertEqual(1, self.mock_sleep.call_count)
+
+    def test_statement_gives_up(self):
+        self.database.execute_sql.side_effect = LockNotAvailable()
+
+        self.assertRaises(psycopg2.OperationalError,
+                          migrations.Statement('ALTER').apply, self.database)
+        self.assertEqual(migrations.LOCK_RETRIES,
+                         self.database.atomic.call_count)
+
+    def test_concurrently_runs_outside_transaction(self):
+        conn = self.database.get_conn.return_value
+        autocommit = []
+        self.database.execute_sql.side_effect = (
+            lambda sql, **kw: autocommit.append(conn.autocommit))
+
+        migrations.Concurrently('DROP INDEX CONCURRENTLY x').apply(
+            self.database)
+
+        self.assertEqual([True], autocommit)
+        self.assertFalse(conn.autocommit)
+        self.assertFalse(self.database.atomic.called)
+
+    def test_create_index_drops_invalid_index(self):
+        self.cursor.fetchone.return_value = (1,)
+
+        migrations.CreateIndex('idx', 'usergroups', ['user_id', 'group_id'],
+                               unique=True).apply(self.database)
+
+        executed = self._executed()
+        self.assertEqual('DROP INDEX CONCURRENTLY IF EXISTS "idx"',
+                         executed[1])
+        self.assertEqual('CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS '
+                         '"idx" ON "usergroups" ("user_id", "group_id")',
+                         executed[2])
+
+    def test_create_index(self):
+        self.cursor.fetchone.return_value = None
+
+        migrations.CreateIndex('idx', 'usergroups',
+                               ['group_id']).apply(self.database)
+
+        executed = self._executed()
+        self.assertEqual(2, len(executed))
+        self.assertTrue(executed[1].startswith('CREATE INDEX CONCURRENTLY'))
+
+    @mock.patch.object(migrations.db_api, '_create_tables')
+    @mock.patch.object(migrations.db_api.User, 'table_exists',
+                       return_value=False)
+    def test_create_tables_fresh_marks_migrated(self, mock_table_exists,
+                                                mock_create_tables):
+        migrations.create_tables(self.database)
+
+        mock_create_tables.assert_called_once_with(self.database)
+        recorded = [c[0][1][0] for c in
+                    self.database.execute_sql.call_args_list[1:]]
+        self.assertEqual([m.version for m in migrations.MIGRATIONS], recorded)
+
+    @mock.patch.object(migrations.db_api, '_create_tables')
+    @mock.patch.object(migrations.db_api.User, 'table_exists',
+                       return_value=True)
+    def test_create_tables_existing_left_for_migrate(self, mock_table_exists,
+                                                     mock_create_tables):
+        migrations.create_tables(self.database)
+
+        self.assertEqual(1, self.database.execute_sql.call_count)
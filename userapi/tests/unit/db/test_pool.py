@@ -0,0 +1,154 @@
+import unittest
+
+import mock
+from playhouse import postgres_ext
+import psycopg2
+from psycopg2 import extensions as pg_extensions
+
+from userapi.db import pool
+from userapi.db import replicas
+from userapi import exceptions
+from userapi import timing
+
+
+def _mock_connection():
+    conn = mock.MagicMock()
+    conn.closed = 0
+    conn.get_transaction_status.return_value = (
+        pg_extensions.TRANSACTION_STATUS_IDLE)
+    return conn
+
+
+class PooledDatabaseTestCase(unittest.TestCase):
+    def setUp(self):
+        connect_patcher = mock.patch.object(
+            postgres_ext.PostgresqlExtDatabase, '_connect')
+        self.mock_connect = connect_patcher.start()
+        self.mock_connect.side_effect = lambda *a, **kw: _mock_connection()
+        self.addCleanup(connect_patcher.stop)
+
+        self.database = pool.PooledPostgresqlExtDatabase(
+            'test', register_hstore=False, max_connections=1)
+
+    def test_unpooled_closes_connection(self):
+        self.database.init('test', max_connections=0)
+        self.database.connect()
+        conn = self.database.get_conn()
+        self.database.close()
+
+        self.assertTrue(conn.close.called)
+        self.database.connect()
+        self.assertEqual(2, self.mock_connect.call_count)
+
+    def test_reuses_connection(self):
+        self.database.connect()
+        conn = self.database.get_conn()
+        self.database.close()
+        self.database.connect()
+
+        self.assertIs(conn, self.database.get_conn())
+        self.assertFalse(conn.close.called)
+        self.assertEqual(1, self.mock_connect.call_count)
+        stats = self.database.pool_stats()
+        self.assertEqual(2, stats['checkouts'])
+        self.assertEqual(1, stats['connections_created'])
+        self.assertEqual(1, stats['connections_reused'])
+        self.assertEqual(1, stats['in_use'])
+
+    def test_stale_connection_is_replaced(self):
+        self.database.init('test', stale_timeout=10)
+        with mock.patch.object(pool.time, 'time', return_value=100):
+            self.database.connect()
+            conn = self.database.get_conn()
+            self.database.close()
+        with mock.patch.object(pool.time, 'time', return_value=111):
+            self.database.connect()
+
+        self.assertTrue(conn.close.called)
+        self.assertIsNot(conn, self.database.get_conn())
+
+    def test_idle_connection_is_replaced(self):
+        self.database.init('test', idle_timeout=5)
+        with mock.patch.object(pool.time, 'time', return_value=100):
+            self.database.connect()
+            conn = self.database.get_conn()
+            self.database.close()
+        with mock.patch.object(pool.time, 'time', return_value=106):
+            self.database.connect()
+
+        self.assertTrue(conn.close.called)
+        self.assertEqual(1, self.database.pool_stats()['connections_closed'])
+
+    def test_open_transaction_rolled_back_on_return(self):
+        self.database.connect()
+        conn = self.database.get_conn()
+        conn.get_transaction_status.return_value = (
+            pg_extensions.TRANSACTION_STATUS_INTRANS)
+        self.database.close()
+
+        self.assertTrue(conn.rollback.called)
+        self.assertEqual(1, self.database.pool_stats()['idle'])
+
+    def test_exhausted(self):
+        self.database.connect()
+
+        self.assertRaises(exceptions.DatabasePoolExhaustedException,
+                          self.database._wait_for_slot)
+        stats = self.database.pool_stats()
+        self.assertEqual(1, stats['waits'])
+        self.assertEqual(1, stats['exhausted'])
+
+    def test_fork_discards_inherited_connections(self):
+        self.database.connect()
+        conn = self.database.get_conn()
+        self.database.close()
+
+        with mock.patch.object(pool.os, 'getpid', return_value=-1):
+            self.database.connect()
+
+        self.assertFalse(conn.close.called)
+        self.assertIsNot(conn, self.database.get_conn())
+        self.assertEqual(0, self.database.pool_stats()['connections_reused'])
+
+    def test_statements_are_timed(self):
+        self.database.connect()
+        timer = timing.begin()
+        self.addCleanup(timing.end)
+
+        self.database.execute_sql('UPDATE t SET a = 1')
+        self.database.execute_sql('SELECT 1', require_commit=False)
+
+        self.assertEqual(2, timer.queries)
+        self.assertEqual(1, self.database.get_conn().commit.call_count)
+        self.assertTrue(timer.durations[timing.DB] >= 0)
+
+    def test_routed_to_replica(self):
+        replica = replicas.Replica('host=replica port=5433')
+        self.database.route(replica)
+        self.database.connect()
+        replica_conn = self.database.get_conn()
+        self.database.close()
+
+        self.assertIs(replica, self.database.routed_replica())
+        self.mock_connect.assert_called_with('test', host='replica',
+                                             port='5433')
+
+        self.database.route(None)
+        self.database.connect()
+
+        self.assertIsNone(self.database.routed_replica())
+        self.assertIsNot(replica_conn, self.database.get_conn())
+        self.assertEqual(2, self.mock_connect.call_count)
+        self.assertEqual(1, self.database.pool_stats()['idle'])
+
+    def test_unreachable_replica_falls_back_to_primary(self):
+        replica = replicas.Replica('host=replica')
+        replica.healthy = True
+        self.mock_connect.side_effect = [psycopg2.OperationalError(),
+                                         _mock_connection()]
+        self.database.route(replica)
+        self.database.connect()
+
+        self.assertFalse(replica.healthy)
+        self.assertIsNone(self.database.routed_replica())
+        self.mock_connect.assert_called_with('test')
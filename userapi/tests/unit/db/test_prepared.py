@@ -0,0 +1,60 @@
+import unittest
+
+import mock
+
+from userapi.db import prepared
+
+
+class PreparedQueryTestCase(unittest.TestCase):
+    def setUp(self):
+        query = mock.Mock()
+        query.sql.return_value = ('SELECT 1 FROM t WHERE a = %s AND b = %s',
+                                  ['', ''])
+        self.statement = prepared.PreparedQuery('get_t', query)
+        self.database = mock.MagicMock()
+        self.database.pooled = True
+
+    def _executed(self):
+        return [c[0] for c in self.database.execute_sql.call_args_list]
+
+    def test_sql(self):
+        self.assertEqual('PREPARE get_t AS SELECT 1 FROM t '
+                         'WHERE a = $1 AND b = $2',
+                         self.statement.prepare_sql)
+        self.assertEqual('EXECUTE get_t (%s, %s)', self.statement.execute_sql)
+
+    def test_prepares_once_per_connection(self):
+        self.statement.execute(self.database, 'x', 'y')
+        cursor = self.statement.execute(self.database, 'x', 'z')
+
+        self.assertEqual(self.database.execute_sql.return_value, cursor)
+        self.assertEqual([(self.statement.prepare_sql,),
+                          (self.statement.execute_sql, ('x', 'y')),
+                          (self.statement.execute_sql, ('x', 'z'))],
+                         self._executed())
+        self.assertTrue(prepared.is_prepared(self.database.get_conn(),
+                                             'get_t'))
+
+    def test_new_connection_prepares_again(self):
+        self.statement.execute(self.database, 'x', 'y')
+        self.database.get_conn.return_value = mock.Mock()
+        self.statement.execute(self.database, 'x', 'y')
+
+        self.assertEqual(2, self._executed().count(
+            (self.statement.prepare_sql,)))
+
+    def test_failed_prepare_not_marked(self):
+        self.database.execute_sql.side_effect = ValueError()
+
+        self.assertRaises(ValueError, self.statement.execute, self.database,
+                          'x', 'y')
+        self.assertFalse(prepared.is_prepared(self.database.get_conn(),
+                                              'get_t'))
+
+    def test_unpooled_runs_sql(self):
+        self.database.pooled = False
+
+        self.statement.execute(self.database, 'x', 'y')
+
+        self.database.execute_sql.assert_called_once_with(
+            self.statement.sql, ('x', 'y'), require_commit=False)
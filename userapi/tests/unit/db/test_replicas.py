@@ -0,0 +1,176 @@
+import unittest
+
+import mock
+import psycopg2
+
+from userapi.db import replicas
+
+
+class ReplicasTestCase(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(replicas.configure)
+        replicas.configure(['host=replica1', 'host=replica2 port=5433'],
+                           max_lag=5, check_interval=1)
+        self.replica1, self.replica2 = replicas.REPLICAS
+        connect_patcher = mock.patch.object(replicas.psycopg2, 'connect')
+        self.mock_connect = connect_patcher.start()
+        self.addCleanup(connect_patcher.stop)
+        self.cursor = self.mock_connect.return_value.cursor.return_value
+
+    def test_parse_position(self):
+        self.assertEqual((0x16 << 32) + 0xB374D848,
+                         replicas.parse_position('16/B374D848'))
+        self.assertIsNone(replicas.parse_position('bogus'))
+        self.assertIsNone(replicas.parse_position(None))
+
+    def test_connect_args(self):
+        database, kwargs = self.replica2.connect_args(
+            'userapi', {'host': 'primary', 'user': 'userapi'})
+
+        self.assertEqual('userapi', database)
+        self.assertEqual({'host': 'replica2', 'port': '5433',
+                          'user': 'userapi'}, kwargs)
+        self.assertEqual('replica2:5433', self.replica2.name)
+
+    def test_choose(self):
+        self.assertIsNone(replicas.choose())
+
+        self.replica1.healthy = True
+        self.replica1.position = 100
+        self.replica2.healthy = True
+        self.replica2.position = 200
+
+        self.assertIn(replicas.choose(), replicas.REPLICAS)
+        self.assertIs(self.replica2, replicas.choose(150))
+        self.assertIsNone(replicas.choose(250))
+
+    def test_lag(self):
+        samples = [(10.0, 100), (11.0, 200), (12.0, 300)]
+
+        self.assertEqual(0.0, replicas.lag(samples, 300, 13.0))
+        self.assertEqual(2.0, replicas.lag(samples, 100, 13.0))
+        self.assertEqual(1.0, replicas.lag(samples, 250, 13.0))
+        self.assertIsNone(replicas.lag(samples, 50, 13.0))
+        self.assertIsNone(replicas.lag(samples, None, 13.0))
+        self.assertIsNone(replicas.lag([], 300, 13.0))
+
+    def test_check_healthy(self):
+        query = mock.Mock(return_value=(True, '0/C8'))
+
+        with mock.patch.object(replicas.time, 'time', return_value=13.0):
+            self.replica1.check(query, [(10.0, 100), (12.0, 300)])
+
+        self.assertTrue(self.replica1.healthy)
+        self.assertEqual(200, self.replica1.position)
+        self.assertEqual(1.0, self.replica1.lag)
+        query.assert_called_once_with(replicas.REPLICA_SQL)
+
+    def test_check_behind(self):
+        self.replica1.healthy = True
+        query = mock.Mock(return_value=(True, '0/64'))
+
+        with mock.patch.object(replicas.time, 'time', return_value=17.0):
+            self.replica1.check(query, [(10.0, 100), (11.0, 200)])
+
+        self.assertFalse(self.replica1.healthy)
+        self.assertEqual('6.0 seconds behind', self.replica1.error)
+
+    def test_check_behind_every_sample(self):
+        # A replica that stopped replaying long ago is not mistaken for an
+        # up to date one while the monitor has only recent samples.
+        query = mock.Mock(return_value=(True, '0/32'))
+
+        with mock.patch.object(replicas.time, 'time', return_value=11.0):
+            self.replica1.check(query, [(10.0, 100)])
+
+        self.assertFalse(self.replica1.healthy)
+        self.assertIsNone(self.replica1.lag)
+        self.assertEqual('more than 1.0 seconds behind', self.replica1.error)
+
+    def test_check_without_samples(self):
+        self.replica1.check(mock.Mock(return_value=(True, '0/64')), [])
+
+        self.assertFalse(self.replica1.healthy)
+        self.assertEqual('primary position unknown', self.replica1.error)
+
+    def test_check_promoted(self):
+        self.replica1.check(mock.Mock(return_value=(False, None)), [])
+
+        self.assertFalse(self.replica1.healthy)
+        self.assertEqual('not in recovery', self.replica1.error)
+
+    def test_check_unreachable(self):
+        self.replica1.healthy = True
+        query = mock.Mock(side_effect=psycopg2.OperationalError(
+            'could not connect\nis the server running?'))
+
+        self.replica1.check(query, [])
+
+        self.assertFalse(self.replica1.healthy)
+        self.assertEqual('could not connect', self.replica1.error)
+        self.assertIsNotNone(self.replica1.checked_at)
+
+    def test_monitor_keeps_deciding_sample(self):
+        self.cursor.fetchone.side_effect = [
+            ('0/64',), (True, '0/64'), (True, '0/64'),
+            ('0/C8',), (True, '0/32'), (True, '0/C8')]
+        database = mock.MagicMock(database='userapi', connect_kwargs={})
+        monitor = replicas.Monitor(database)
+
+        with mock.patch.object(replicas.time, 'time', return_value=10.0):
+            monitor.check()
+        monitor.samples.appendleft((1.0, 50))
+        with mock.patch.object(replicas.time, 'time', return_value=17.0):
+            monitor.check()
+
+        self.assertEqual([(10.0, 100), (17.0, 200)], list(monitor.samples))
+        self.assertFalse(self.replica1.healthy)
+        self.assertIsNone(self.replica1.lag)
+        self.assertTrue(self.replica2.healthy)
+
+    def test_monitor_keeps_connections(self):
+        self.cursor.fetchone.side_effect = [
+            ('0/64',), (True, '0/64'), (True, '0/64')] * 2
+        database = mock.MagicMock(database='userapi',
+                                  connect_kwargs={'host': 'primary'})
+        monitor = replicas.Monitor(database)
+
+        monitor.check()
+        monitor.check()
+
+        self.assertEqual(
+            [mock.call(database='userapi', host='primary',
+                       connect_timeout=2),
+             mock.call(database='userapi', host='replica1',
+                       connect_timeout=2),
+             mock.call(database='userapi', host='replica2', port='5433',
+                       connect_timeout=2)],
+            self.mock_connect.call_args_list)
+        self.assertFalse(self.mock_connect.return_value.close.called)
+
+    def test_connection_replaced_after_error(self):
+        connection = replicas.Connection('userapi', {})
+        self.cursor.fetchone.return_value = (1,)
+        connection.query('SELECT 1')
+        self.cursor.execute.side_effect = [psycopg2.OperationalError(), None]
+
+        self.assertEqual((1,), connection.query('SELECT 1'))
+
+        self.assertEqual(2, self.mock_connect.call_count)
+        self.assertTrue(self.mock_connect.return_value.close.called)
+
+    def test_connection_error_on_new_connection(self):
+        connection = replicas.Connection('userapi', {})
+        self.mock_connect.side_effect = psycopg2.OperationalError()
+
+        self.assertRaises(psycopg2.OperationalError, connection.query,
+                          'SELECT 1')
+        self.assertEqual(1, self.mock_connect.call_count)
+
+    def test_start_monitor_without_replicas(self):
+        replicas.configure([])
+
+        with mock.patch.object(replicas, 'Monitor') as mock_monitor:
+            replicas.start_monitor(mock.Mock())
+
+        self.assertFalse(mock_monitor.called)
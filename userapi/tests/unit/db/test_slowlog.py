@@ -0,0 +1,111 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+import psycopg2
+from psycopg2 import extensions as pg_extensions
+
+from userapi import timing
+from userapi.db import slowlog
+
+
+class SlowLogTestCase(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(slowlog.configure)
+        slowlog.configure(threshold=0.5, redact=False, explain_rate=0)
+        log_patcher = mock.patch.object(slowlog.LOG, 'info')
+        self.mock_info = log_patcher.start()
+        self.addCleanup(log_patcher.stop)
+
+        self.database = mock.MagicMock()
+        self.conn = self.database.get_conn.return_value
+        self.conn.get_transaction_status.return_value = (
+            pg_extensions.TRANSACTION_STATUS_INTRANS)
+        self.cursor = self.conn.cursor.return_value
+        self.cursor.fetchall.return_value = [('Seq Scan',), ('  Buffers',)]
+
+    def _entry(self):
+        return json.loads(self.mock_info.call_args[0][0])
+
+    def test_fast_statement_not_logged(self):
+        slowlog.statement_finished(self.database, 'SELECT 1', (), 0.1, False)
+
+        self.assertFalse(self.mock_info.called)
+
+    def test_slow_statement_logged(self):
+        timing.begin('/users/<userid>')
+        self.addCleanup(timing.end)
+
+        slowlog.statement_finished(self.database, 'SELECT %s', ('bob',),
+                                   0.75, False)
+
+        self.assertEqual({'sql': 'SELECT %s',
+                          'params': ['bob'],
+                          'duration_ms': 750.0,
+                          'route': '/users/<userid>',
+                          'failed': False}, self._entry())
+        self.assertFalse(self.conn.cursor.called)
+
+    def test_redacted_params(self):
+        slowlog.configure(threshold=0.5, redact=True)
+
+        slowlog.statement_finished(self.database, 'SELECT %s, %s',
+                                   ['bob', [1, 2]], 0.75, True)
+
+        self.assertEqual(['<str>', '<list of 2>'], self._entry()['params'])
+        self.assertIsNone(self._entry()['route'])
+
+    def test_explain_analyze(self):
+        slowlog.configure(threshold=0.5, explain_rate=1)
+
+        slowlog.statement_finished(self.database, 'SELECT %s', [1], 0.75,
+                                   False)
+
+        self.assertEqual('Seq Scan\n  Buffers', self._entry()['plan'])
+        self.assertTrue(self._entry()['analyzed'])
+        self.assertEqual([mock.call('SAVEPOINT userapi_explain'),
+                          mock.call('EXPLAIN (ANALYZE, BUFFERS) SELECT %s',
+                                    [1]),
+                          mock.call('ROLLBACK TO SAVEPOINT userapi_explain'),
+                          mock.call('RELEASE SAVEPOINT userapi_explain')],
+                         self.cursor.execute.call_args_list)
+
+    def test_explain_without_analyze(self):
+        def execute(sql, params=None):
+            if sql.startswith('EXPLAIN (ANALYZE'):
+                raise psycopg2.IntegrityError()
+        self.cursor.execute.side_effect = execute
+
+        result = slowlog.explain(self.conn, 'INSERT INTO t VALUES (%s)', [1])
+
+        self.assertEqual({'plan': 'Seq Scan\n  Buffers', 'analyzed': False},
+                         result)
+        self.assertEqual(2, self.cursor.execute.call_args_list.count(
+            mock.call('ROLLBACK TO SAVEPOINT userapi_explain')))
+
+    def test_explain_skips_other_statements(self):
+        self.assertEqual({}, slowlog.explain(self.conn, 'PREPARE a AS ...',
+                                             []))
+        self.conn.get_transaction_status.return_value = (
+            pg_extensions.TRANSACTION_STATUS_INERROR)
+        self.assertEqual({}, slowlog.explain(self.conn, 'SELECT 1', []))
+        self.assertFalse(self.cursor.execute.called)
+
+    def test_log_file_reopened_after_rotation(self):
+        log_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, log_dir)
+        log_file = os.path.join(log_dir, 'slow.log')
+        slowlog.configure(threshold=0.5, log_file=log_file)
+
+        slowlog.LOG.log(logging.INFO, 'first')
+        os.rename(log_file, log_file + '.1')
+        slowlog.LOG.log(logging.INFO, 'second')
+
+        with open(log_file + '.1') as rotated:
+            self.assertEqual('first\n', rotated.read())
+        with open(log_file) as current:
+            self.assertEqual('second\n', current.read())
@@ -1,19 +1,37 @@
 import copy
+import datetime
 import json
 import mock
 import unittest
 
 from userapi import api
 from userapi import exceptions
+from userapi import timing
 from userapi.tests.unit import fixtures
 
 
+VERSION = (7, 3, datetime.datetime(2016, 3, 1, 12, 30, 15, 500))
+ETAG = 'W/"7.3"'
+LAST_MODIFIED = 'Tue, 01 Mar 2016 12:30:15 GMT'
+
+
+def _mock_model():
+    model = mock.MagicMock()
+    model.get_version.return_value = VERSION
+    return model
+
+
 class APITestCase(unittest.TestCase):
     def setUp(self):
         self.app = api.APP.test_client()
         db_api_patcher = mock.patch.object(api, 'db_api')
         self.mock_db = db_api_patcher.start()
         self.addCleanup(db_api_patcher.stop)
+        self.mock_db.get_user_version.return_value = VERSION
+        self.mock_db.get_group_version.return_value = VERSION
+        self.mock_db.documents_enabled.return_value = False
+        self.mock_db.run_in_transaction.side_effect = (
+            lambda func, *args, **kwds: func(*args, **kwds))
 
     def _req(self, func, url, data=None):
         if data:
@@ -30,6 +48,9 @@ class APITestCase(unittest.TestCase):
     def _put(self, url, data):
         return self._req(self.app.put, url, data)
 
+    def _patch(self, url, data):
+        return self._req(self.app.patch, url, data)
+
     def _get(self, url):
         return self._req(self.app.get, url)
 
@@ -37,26 +58,66 @@ class APITestCase(unittest.TestCase):
         return self._req(self.app.delete, url)
 
     def test_get_user(self):
-        mock_user = mock.MagicMock()
-        mock_user.to_dict.return_value = fixtures.TEST_USER
-        self.mock_db.get_user.return_value = mock_user
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
 
         resp, new_user = self._get('/users/test')
 
         self.assertEqual(new_user, fixtures.TEST_USER)
-        self.mock_db.get_user.assert_called_once_with('test')
+        self.mock_db.get_user_data.assert_called_once_with('test')
+
+    def test_get_user_validators(self):
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
+
+        resp, _ = self._get('/users/test')
+
+        self.assertEqual(ETAG, resp.headers['ETag'])
+        self.assertEqual(LAST_MODIFIED, resp.headers['Last-Modified'])
+
+    def test_get_user_not_modified(self):
+        resp = self.app.get('/users/test', headers={'If-None-Match': ETAG})
+
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(ETAG, resp.headers['ETag'])
+        self.assertEqual(b'', resp.data)
+        self.mock_db.get_user_version.assert_called_once_with('test')
+        self.assertFalse(self.mock_db.get_user_data.called)
+
+    def test_get_user_modified(self):
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
+
+        resp = self.app.get('/users/test',
+                            headers={'If-None-Match': 'W/"7.2"'})
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(ETAG, resp.headers['ETag'])
+        self.assertEqual(fixtures.TEST_USER, json.loads(resp.data))
+
+    def test_get_user_not_modified_since(self):
+        resp = self.app.get('/users/test',
+                            headers={'If-Modified-Since': LAST_MODIFIED})
+
+        self.assertEqual(304, resp.status_code)
+        self.assertFalse(self.mock_db.get_user_data.called)
+
+    def test_get_user_not_modified_does_not_exist(self):
+        exc = exceptions.UserNotFoundException()
+        self.mock_db.get_user_version.side_effect = exc
+
+        resp = self.app.get('/users/test', headers={'If-None-Match': ETAG})
+
+        self.assertEqual(404, resp.status_code)
 
     def test_get_user_does_not_exist(self):
         exc = exceptions.UserNotFoundException()
-        self.mock_db.get_user.side_effect = exc
+        self.mock_db.get_user_data.side_effect = exc
 
         resp, _ = self._get('/users/test')
 
         self.assertEqual(exc.status_code, resp.status_code)
-        self.mock_db.get_user.assert_called_once_with('test')
+        self.mock_db.get_user_data.assert_called_once_with('test')
 
     def test_create_user(self):
-        mock_user = mock.MagicMock()
+        mock_user = _mock_model()
         mock_user.to_dict.return_value = fixtures.TEST_USER
         self.mock_db.create_user.return_value = mock_user
 
@@ -67,7 +128,7 @@ class APITestCase(unittest.TestCase):
         self.mock_db.create_user.assert_called_once_with(fixtures.TEST_USER)
 
     def test_create_user_with_groups(self):
-        mock_user = mock.MagicMock()
+        mock_user = _mock_model()
         mock_user.to_dict.return_value = fixtures.TEST_USER_WITH_GROUP
         self.mock_db.create_user.return_value = mock_user
 
@@ -108,6 +169,72 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(exc.status_code, resp.status_code)
         self.assertFalse(self.mock_db.create_user.called)
 
+    def test_create_users_bulk(self):
+        bad_user = copy.deepcopy(fixtures.TEST_USER)
+        del bad_user['first_name']
+        self.mock_db.create_users.return_value = [
+            None, exceptions.UserAlreadyExistsException()]
+
+        resp, body = self._post('/users/bulk', [fixtures.TEST_USER,
+                                                bad_user,
+                                                fixtures.TEST_USER])
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([201, 400, 409], [r['code'] for r in body])
+        self.assertEqual([0, 1, 2], [r['index'] for r in body])
+        self.assertEqual('MissingRequiredFieldException',
+                         body[1]['exception'])
+        self.mock_db.create_users.assert_called_once_with(
+            [fixtures.TEST_USER, fixtures.TEST_USER])
+
+    def test_create_users_bulk_wrong_types(self):
+        bad_groups = copy.deepcopy(fixtures.TEST_USER)
+        bad_groups['groups'] = [{'x': 1}]
+        bad_userid = copy.deepcopy(fixtures.TEST_USER)
+        bad_userid['userid'] = {'x': 1}
+        bad_name = copy.deepcopy(fixtures.TEST_USER)
+        bad_name['first_name'] = 5
+        self.mock_db.create_users.return_value = [None, None]
+
+        resp, body = self._post('/users/bulk', [fixtures.TEST_USER,
+                                                bad_groups, bad_userid,
+                                                bad_name,
+                                                fixtures.TEST_USER])
+
+        self.assertEqual([201, 400, 400, 400, 201],
+                         [r['code'] for r in body])
+        self.assertEqual(['InvalidRequestException'] * 3,
+                         [r['exception'] for r in body[1:4]])
+        self.mock_db.create_users.assert_called_once_with(
+            [fixtures.TEST_USER, fixtures.TEST_USER])
+
+    def test_create_users_bulk_batches(self):
+        self.mock_db.create_users.side_effect = lambda users: [None] * len(
+            users)
+
+        with mock.patch.object(api, 'BULK_BATCH_SIZE', 2):
+            resp = self.app.post('/users/bulk',
+                                 data='\n'.join([json.dumps(
+                                     fixtures.TEST_USER)] * 5),
+                                 headers={'content-type':
+                                          api.NDJSON_MIMETYPE})
+            body = [json.loads(line) for line in resp.data.splitlines()]
+
+        self.assertEqual(api.NDJSON_MIMETYPE, resp.mimetype)
+        self.assertEqual(range(5), [r['index'] for r in body])
+        self.assertEqual(3, self.mock_db.create_users.call_count)
+
+    def test_create_users_bulk_malformed(self):
+        self.mock_db.create_users.return_value = [None]
+
+        resp = self.app.post('/users/bulk',
+                             data=json.dumps([fixtures.TEST_USER])[:-1],
+                             headers={'content-type': 'application/json'})
+
+        body = json.loads(resp.data)
+        self.assertEqual('InvalidRequestException', body[-1]['exception'])
+        self.assertFalse(self.mock_db.create_users.called)
+
     def test_delete_user(self):
         resp, _ = self._delete('/users/test')
         self.assertEqual(200, resp.status_code)
@@ -117,7 +244,7 @@ class APITestCase(unittest.TestCase):
         updated_user = copy.deepcopy(fixtures.TEST_USER)
         updated_user['first_name'] = 'kyle'
 
-        mock_user = mock.MagicMock()
+        mock_user = _mock_model()
         mock_user.to_dict.return_value = updated_user
         self.mock_db.update_user.return_value = mock_user
 
@@ -132,7 +259,7 @@ class APITestCase(unittest.TestCase):
         updated_user = copy.deepcopy(fixtures.TEST_USER_WITH_GROUP)
         updated_user['first_name'] = 'kyle'
 
-        mock_user = mock.MagicMock()
+        mock_user = _mock_model()
         mock_user.to_dict.return_value = updated_user
         self.mock_db.update_user.return_value = mock_user
 
@@ -163,14 +290,60 @@ class APITestCase(unittest.TestCase):
 
     def test_get_group(self):
         user_list = ['andrew', 'sam']
-        mock_group = mock.MagicMock()
-        mock_group.to_list.return_value = user_list
-        self.mock_db.get_group.return_value = mock_group
+        self.mock_db.iter_group_member_ids.return_value = iter(user_list)
 
         resp, body = self._get('/groups/admins')
 
         self.assertEqual(200, resp.status_code)
+        self.assertEqual('application/json', resp.mimetype)
         self.assertEqual(body, user_list)
+        self.mock_db.get_group_version.assert_called_once_with('admins')
+        self.mock_db.iter_group_member_ids.assert_called_once_with(
+            VERSION[0])
+
+    def test_get_group_not_modified(self):
+        resp = self.app.get('/groups/admins', headers={'If-None-Match': ETAG})
+
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(ETAG, resp.headers['ETag'])
+        self.mock_db.get_group_version.assert_called_once_with('admins')
+        self.assertFalse(self.mock_db.iter_group_member_ids.called)
+
+    def test_get_group_modified(self):
+        self.mock_db.iter_group_member_ids.return_value = iter(['a'])
+
+        resp = self.app.get('/groups/admins', headers={'If-None-Match': '*'})
+        self.assertEqual(304, resp.status_code)
+
+        resp = self.app.get('/groups/admins',
+                            headers={'If-None-Match': 'W/"8.3"'})
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(ETAG, resp.headers['ETag'])
+        self.assertEqual(LAST_MODIFIED, resp.headers['Last-Modified'])
+        self.assertEqual(['a'], json.loads(resp.data))
+
+    def test_get_group_empty(self):
+        self.mock_db.iter_group_member_ids.return_value = iter([])
+
+        resp, body = self._get('/groups/admins')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([], body)
+
+    def test_get_group_does_not_exist(self):
+        exc = exceptions.GroupNotFoundException()
+        self.mock_db.get_group_version.side_effect = exc
+
+        resp, _ = self._get('/groups/admins')
+
+        self.assertEqual(404, resp.status_code)
+        self.assertFalse(self.mock_db.iter_group_member_ids.called)
+
+    def test_encode_json_array_chunks(self):
+        chunks = list(api._encode_json_array(range(5), chunk_size=2))
+
+        self.assertEqual(['[0,1', ',2,3', ',4', ']'], chunks)
+        self.assertEqual(range(5), json.loads(''.join(chunks)))
 
     def test_create_group(self):
         mock_group = mock.MagicMock()
@@ -204,7 +377,523 @@ class APITestCase(unittest.TestCase):
         self.assertEqual(400, resp.status_code)
         self.assertFalse(self.mock_db.update_group.called)
 
+    def test_patch_group(self):
+        self.mock_db.patch_group_members.return_value = (['user1'], [])
+
+        resp, body = self._patch('/groups/admins',
+                                 {'add': ['user1'], 'remove': ['user2']})
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({'added': ['user1'], 'removed': []}, body)
+        self.mock_db.patch_group_members.assert_called_once_with(
+            'admins', add=['user1'], remove=['user2'])
+
+    def test_patch_group_invalid(self):
+        for delta in ([], {'add': 'user1'}, {'add': [['user1']]},
+                      {'add': ['user1'], 'remove': ['user1']},
+                      {'add': [1]}, {'add': [1.5]}, {'remove': [True]},
+                      {'remove': ['user1', None]}):
+            resp, _ = self._patch('/groups/admins', delta)
+            self.assertEqual(400, resp.status_code)
+
+        self.assertFalse(self.mock_db.patch_group_members.called)
+
+    def test_patch_user_groups(self):
+        self.mock_db.patch_user_groups.return_value = ([], ['admins'])
+
+        resp, body = self._patch('/users/test/groups', {'remove': ['admins']})
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({'added': [], 'removed': ['admins']}, body)
+        self.mock_db.patch_user_groups.assert_called_once_with(
+            'test', add=[], remove=['admins'])
+
+    def test_patch_user_groups_non_string_names(self):
+        for delta in ({'add': [3]}, {'remove': [None]}, {'add': [{}]}):
+            resp, _ = self._patch('/users/test/groups', delta)
+            self.assertEqual(400, resp.status_code)
+
+        self.assertFalse(self.mock_db.patch_user_groups.called)
+
+    def test_write_in_transaction(self):
+        self._delete('/groups/admins')
+        self._get('/users/test')
+
+        self.assertEqual(1, self.mock_db.run_in_transaction.call_count)
+        self.mock_db.delete_group.assert_called_once_with('admins')
+
+    def test_write_conflict(self):
+        exc = exceptions.TransactionConflictException()
+        self.mock_db.run_in_transaction.side_effect = exc
+
+        resp, body = self._delete('/groups/admins')
+
+        self.assertEqual(409, resp.status_code)
+        self.assertEqual('TransactionConflictException', body['exception'])
+
     def test_delete_group(self):
         resp, _ = self._delete('/groups/admins')
         self.assertEqual(200, resp.status_code)
         self.mock_db.delete_group.assert_called_once_with('admins')
+
+    def test_get_pool_stats(self):
+        stats = {'checkouts': 1, 'waits': 0, 'exhausted': 0}
+        self.mock_db.get_pool_stats.return_value = stats
+
+        resp, body = self._get('/stats/pool')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(stats, body)
+
+    def test_pool_exhausted(self):
+        exc = exceptions.DatabasePoolExhaustedException()
+        self.mock_db.get_database.return_value.connect.side_effect = exc
+
+        resp, body = self._get('/users/test')
+
+        self.assertEqual(503, resp.status_code)
+        self.assertFalse(self.mock_db.get_user_data.called)
+
+    def _enable_cache(self):
+        api.cache.configure(size=10, ttl=60, stale_ttl=60, max_group_size=2)
+        self.addCleanup(api.cache.configure, size=0)
+        for name, value in (('active', True), ('start_listener', None)):
+            patcher = mock.patch.object(api.cache, name, return_value=value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_get_user_cached(self):
+        self._enable_cache()
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
+
+        self._get('/users/test')
+        resp, body = self._get('/users/test')
+
+        self.assertEqual(fixtures.TEST_USER, body)
+        self.mock_db.get_user_data.assert_called_once_with('test')
+        # Cache hits never check a connection out of the pool.
+        self.assertFalse(self.mock_db.get_database.return_value.connect.called)
+
+    def test_get_user_cached_not_modified(self):
+        self._enable_cache()
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
+
+        self._get('/users/test')
+        resp = self.app.get('/users/test', headers={'If-None-Match': ETAG})
+
+        self.assertEqual(304, resp.status_code)
+        self.assertEqual(1, self.mock_db.get_user_data.call_count)
+        # The cached version answers without a version lookup.
+        self.assertFalse(self.mock_db.get_user_version.called)
+
+    def test_get_group_cached(self):
+        self._enable_cache()
+        self.mock_db.iter_group_member_ids.return_value = iter(['a', 'b'])
+
+        self._get('/groups/admins')
+        resp, body = self._get('/groups/admins')
+
+        self.assertEqual(['a', 'b'], body)
+        self.assertEqual('application/json', resp.mimetype)
+        self.assertEqual(1, self.mock_db.get_group_version.call_count)
+
+    def test_get_group_invalidated_while_read(self):
+        self._enable_cache()
+        groups = api.cache.CACHES[api.cache.GROUPS]
+
+        def iter_group_member_ids(group):
+            # A write commits after the version was read.
+            groups.invalidate(['admins'])
+            return iter(['a'])
+        self.mock_db.iter_group_member_ids.side_effect = iter_group_member_ids
+
+        self._get('/groups/admins')
+        self._get('/groups/admins')
+
+        self.assertEqual(2, self.mock_db.get_group_version.call_count)
+
+    def test_get_group_not_modified_releases_reservation(self):
+        self._enable_cache()
+        self.mock_db.get_group_version.return_value = VERSION
+
+        resp = self.app.get('/groups/admins',
+                            headers={'If-None-Match': ETAG})
+
+        self.assertEqual(304, resp.status_code)
+        self.assertFalse(
+            api.cache.CACHES[api.cache.GROUPS].loading('admins'))
+
+    def test_get_group_too_large_to_cache(self):
+        self._enable_cache()
+        self.mock_db.iter_group_member_ids.side_effect = (
+            lambda group: iter(['a', 'b', 'c']))
+
+        self._get('/groups/admins')
+        resp, body = self._get('/groups/admins')
+
+        self.assertEqual(['a', 'b', 'c'], body)
+        self.assertEqual(2, self.mock_db.get_group_version.call_count)
+
+    def test_get_user_document(self):
+        self.mock_db.documents_enabled.return_value = True
+        self.mock_db.get_user_document.return_value = (
+            VERSION, json.dumps(fixtures.TEST_USER))
+
+        resp, body = self._get('/users/test')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('application/json', resp.mimetype)
+        self.assertEqual(fixtures.TEST_USER, body)
+        self.assertEqual(ETAG, resp.headers['ETag'])
+        self.mock_db.get_user_document.assert_called_once_with('test')
+        self.assertFalse(self.mock_db.get_user_data.called)
+
+    def test_get_user_without_document(self):
+        self.mock_db.documents_enabled.return_value = True
+        self.mock_db.get_user_document.return_value = (VERSION, None)
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
+
+        resp, body = self._get('/users/test')
+
+        self.assertEqual(fixtures.TEST_USER, body)
+        self.mock_db.get_user_data.assert_called_once_with('test')
+
+    def test_get_group_document(self):
+        self.mock_db.documents_enabled.return_value = True
+        self.mock_db.get_group_document.return_value = (VERSION, '["a"]')
+
+        resp, body = self._get('/groups/admins')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(['a'], body)
+        self.assertEqual(ETAG, resp.headers['ETag'])
+        self.assertFalse(self.mock_db.get_group_version.called)
+        self.assertFalse(self.mock_db.iter_group_member_ids.called)
+
+    def test_get_group_without_document(self):
+        self.mock_db.documents_enabled.return_value = True
+        self.mock_db.get_group_document.return_value = (VERSION, None)
+        self.mock_db.iter_group_member_ids.return_value = iter(['a'])
+
+        resp, body = self._get('/groups/admins')
+
+        self.assertEqual(['a'], body)
+        self.mock_db.iter_group_member_ids.assert_called_once_with(
+            VERSION[0])
+
+    def test_get_group_document_cached(self):
+        self._enable_cache()
+        self.mock_db.documents_enabled.return_value = True
+        self.mock_db.get_group_document.return_value = (VERSION, '["a"]')
+
+        self._get('/groups/admins')
+        resp, body = self._get('/groups/admins')
+
+        self.assertEqual(['a'], body)
+        self.assertEqual(1, self.mock_db.get_group_document.call_count)
+
+    def test_get_cache_stats(self):
+        resp, body = self._get('/stats/cache')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertFalse(body['listening'])
+        self.assertEqual(0, body['users']['max_size'])
+        self.assertIn('evictions', body['groups'])
+
+    def _enable_replicas(self):
+        api.replicas.configure(['host=replica'])
+        self.addCleanup(api.replicas.configure)
+        replica, = api.replicas.REPLICAS
+        replica.healthy = True
+        replica.position = 200
+        patcher = mock.patch.object(api.replicas, 'start_monitor')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        return replica
+
+    def _routed_to(self):
+        return self.mock_db.get_database.return_value.route.call_args[0][0]
+
+    def test_read_routed_to_replica(self):
+        replica = self._enable_replicas()
+        self.mock_db.list_users.return_value = []
+
+        self._get('/users')
+
+        self.assertIs(replica, self._routed_to())
+
+    def test_read_waits_for_position(self):
+        replica = self._enable_replicas()
+        self.mock_db.list_users.return_value = []
+
+        self.app.get('/users', headers={'X-WAL-Position': '0/C8'})
+        self.assertIs(replica, self._routed_to())
+
+        self.app.set_cookie('localhost', 'userapi_wal_position', '0/C9')
+        self.app.get('/users')
+        self.assertIsNone(self._routed_to())
+
+        self.app.get('/users', headers={'X-WAL-Position': 'bogus'})
+        self.assertIsNone(self._routed_to())
+
+    def test_cached_read_routed_to_primary(self):
+        self._enable_replicas()
+        self._enable_cache()
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
+
+        self._get('/users/test')
+
+        self.assertIsNone(self._routed_to())
+
+    def test_write_returns_position(self):
+        self._enable_replicas()
+        self.mock_db.get_wal_position.return_value = '0/C8'
+
+        resp, _ = self._delete('/groups/admins')
+
+        self.assertIsNone(self._routed_to())
+        self.assertEqual('0/C8', resp.headers['X-WAL-Position'])
+        self.assertIn('userapi_wal_position=0/C8',
+                      resp.headers['Set-Cookie'])
+
+    def test_bulk_create_reads_from_primary(self):
+        replica = self._enable_replicas()
+        self.mock_db.create_users.return_value = [None]
+
+        resp = self.app.post('/users/bulk', data=json.dumps([
+            fixtures.TEST_USER]), content_type='application/json')
+        resp.get_data()
+
+        self.assertEqual('primary', resp.headers['X-WAL-Position'])
+        self.assertIn('userapi_wal_position=primary',
+                      resp.headers['Set-Cookie'])
+        self.mock_db.list_users.return_value = []
+        self.app.get('/users')
+        self.assertIsNone(self._routed_to())
+        self.app.get('/users', headers={'X-WAL-Position': '0/C8'})
+        self.assertIs(replica, self._routed_to())
+
+    def test_write_without_replicas(self):
+        resp, _ = self._delete('/groups/admins')
+
+        self.assertNotIn('X-WAL-Position', resp.headers)
+        self.assertFalse(self.mock_db.get_wal_position.called)
+
+    def test_get_replica_stats(self):
+        self._enable_replicas()
+
+        resp, body = self._get('/stats/replicas')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual('replica:5432', body['replicas'][0]['name'])
+        self.assertTrue(body['replicas'][0]['healthy'])
+
+    def test_list_users(self):
+        self.mock_db.list_users.return_value = [{'userid': 'a'}, {'userid': 'b'}]
+
+        resp, body = self._get('/users?limit=2')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([{'userid': 'a'}, {'userid': 'b'}], body['users'])
+        self.assertIsNone(body['next_cursor'])
+        self.mock_db.list_users.assert_called_once_with(after=None, limit=3)
+
+    def test_list_users_next_page(self):
+        self.mock_db.list_users.return_value = [
+            {'userid': userid} for userid in ['a', 'b', 'c']]
+
+        resp, body = self._get('/users?limit=2')
+
+        self.assertEqual(['a', 'b'], [u['userid'] for u in body['users']])
+        self.assertIsNotNone(body['next_cursor'])
+
+        self._get('/users?limit=2&cursor=%s' % body['next_cursor'])
+        self.mock_db.list_users.assert_called_with(after='b', limit=3)
+
+    def test_list_users_bad_page_args(self):
+        for query in ['limit=0', 'limit=x', 'limit=%d' % (api.MAX_PAGE_SIZE + 1),
+                      'cursor=notacursor']:
+            resp, _ = self._get('/users?%s' % query)
+            self.assertEqual(400, resp.status_code)
+        self.assertFalse(self.mock_db.list_users.called)
+
+    def test_list_wrong_cursor_type(self):
+        for path, keys in (('/users', [1, {}, [], None]),
+                           ('/groups', [1, {'a': 1}, ['a']]),
+                           ('/groups/admins/members',
+                            ['a', 1.5, True, {}, [1], 2 ** 40]),
+                           ('/users/test/groups', ['1', False, 2 ** 31])):
+            for key in keys:
+                resp, _ = self._get('%s?cursor=%s' %
+                                    (path, api._encode_cursor(key)))
+                self.assertEqual(400, resp.status_code, (path, key))
+        self.assertFalse(self.mock_db.list_users.called)
+        self.assertFalse(self.mock_db.list_groups.called)
+        self.assertFalse(self.mock_db.list_group_members.called)
+        self.assertFalse(self.mock_db.list_user_groups.called)
+
+    def test_list_groups(self):
+        self.mock_db.list_groups.return_value = [fixtures.TEST_GROUP,
+                                                 {'name': 'users'}]
+
+        resp, body = self._get('/groups?limit=1')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual([fixtures.TEST_GROUP], body['groups'])
+        self.assertEqual('admins', api._decode_cursor(body['next_cursor'],
+                                                       basestring))
+
+    def test_list_group_members(self):
+        self.mock_db.list_group_members.return_value = [(1, 'a'), (5, 'b')]
+
+        resp, body = self._get('/groups/admins/members?limit=1')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(['a'], body['members'])
+        self.assertEqual(1, api._decode_cursor(body['next_cursor'], int))
+        self.mock_db.list_group_members.assert_called_once_with(
+            'admins', after=None, limit=2)
+
+    def test_lookup_users(self):
+        user = {'userid': 'a', 'first_name': 'f', 'last_name': 'l',
+                'groups': []}
+        self.mock_db.get_users.return_value = ([user], ['b'])
+
+        resp, body = self._get('/users?ids=a,b&ids=c')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({'users': [user], 'not_found': ['b']}, body)
+        self.mock_db.get_users.assert_called_once_with(['a', 'b', 'c'])
+        self.assertFalse(self.mock_db.list_users.called)
+
+    def test_lookup_users_post(self):
+        self.mock_db.get_users.return_value = ([], ['a'])
+
+        resp, body = self._post('/users/lookup', {'ids': ['a']})
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({'users': [], 'not_found': ['a']}, body)
+        self.mock_db.get_users.assert_called_once_with(['a'])
+
+    def test_lookup_users_invalid(self):
+        resp, _ = self._get('/users?ids=')
+        self.assertEqual(400, resp.status_code)
+
+        for body in (['a'], {'ids': 'a'}, {'ids': []}, {'ids': [{}]},
+                     {'ids': [1]}, {'ids': ['a', None]}, {'ids': [False]},
+                     {'ids': ['a'] * (api.MAX_LOOKUP_SIZE + 1)}):
+            resp, _ = self._post('/users/lookup', body)
+            self.assertEqual(400, resp.status_code)
+
+        self.assertFalse(self.mock_db.get_users.called)
+
+    def test_lookup_groups(self):
+        group = {'name': 'admins', 'members': ['a']}
+        self.mock_db.get_groups.return_value = ([group], [])
+
+        resp, body = self._get('/groups?names=admins')
+        self.assertEqual({'groups': [group], 'not_found': []}, body)
+        resp, body = self._post('/groups/lookup', {'names': ['admins']})
+        self.assertEqual({'groups': [group], 'not_found': []}, body)
+
+        self.assertEqual([mock.call(['admins'])] * 2,
+                         self.mock_db.get_groups.call_args_list)
+
+    def test_lookup_groups_non_string_names(self):
+        for names in ([1], ['admins', None], [1.5]):
+            resp, _ = self._post('/groups/lookup', {'names': names})
+            self.assertEqual(400, resp.status_code)
+
+        self.assertFalse(self.mock_db.get_groups.called)
+
+    def test_list_user_groups(self):
+        self.mock_db.list_user_groups.return_value = [(1, 'admins'),
+                                                      (4, 'users')]
+
+        resp, body = self._get('/users/test/groups?limit=1')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual(['admins'], body['groups'])
+        self.assertEqual(1, api._decode_cursor(body['next_cursor'], int))
+        self.mock_db.list_user_groups.assert_called_once_with(
+            'test', after=None, limit=2)
+
+    def test_check_membership(self):
+        resp, body = self._get('/groups/admins/members/test')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertEqual({'name': 'admins', 'userid': 'test'}, body)
+        self.mock_db.check_membership.assert_called_once_with('admins',
+                                                              'test')
+
+    def test_check_membership_not_member(self):
+        exc = exceptions.MembershipNotFoundException()
+        self.mock_db.check_membership.side_effect = exc
+
+        resp = self.app.head('/groups/admins/members/test')
+
+        self.assertEqual(404, resp.status_code)
+        self.assertEqual(b'', resp.data)
+
+    def test_list_group_members_does_not_exist(self):
+        exc = exceptions.GroupNotFoundException()
+        self.mock_db.list_group_members.side_effect = exc
+
+        resp, _ = self._get('/groups/admins/members')
+
+        self.assertEqual(404, resp.status_code)
+
+    def _get_user_with_queries(self, userid):
+        timing.record_query(0.002)
+        timing.record_query(0.001)
+        return VERSION, fixtures.TEST_USER
+
+    def test_server_timing_off_by_default(self):
+        self.mock_db.get_user_data.return_value = (VERSION, fixtures.TEST_USER)
+
+        resp, _ = self._get('/users/test')
+
+        self.assertNotIn('Server-Timing', resp.headers)
+
+    @mock.patch.dict(api.os.environ, {'SERVER_TIMING': '1'})
+    def test_server_timing(self):
+        self.mock_db.get_user_data.side_effect = self._get_user_with_queries
+
+        resp, _ = self._get('/users/test')
+
+        metrics = resp.headers['Server-Timing'].split(', ')
+        self.assertEqual('db;dur=3.000;desc="2 queries"', metrics[0])
+        self.assertTrue(metrics[1].startswith('serialization;dur='))
+        self.assertTrue(metrics[2].startswith('view;dur='))
+
+    def test_access_log(self):
+        self.mock_db.get_user_data.side_effect = self._get_user_with_queries
+
+        with mock.patch.object(api.ACCESS_LOG, 'info') as mock_info:
+            resp = self.app.get('/users/test')
+            resp.close()
+
+        line = json.loads(mock_info.call_args[0][0])
+        self.assertEqual('GET', line['method'])
+        self.assertEqual('/users/test', line['path'])
+        self.assertEqual('/users/<userid>', line['route'])
+        self.assertEqual(200, line['status'])
+        self.assertEqual(2, line['queries'])
+        self.assertEqual(3.0, line['db_ms'])
+        self.assertIsNone(timing.current())
+
+    def test_metrics(self):
+        self.mock_db.get_user_data.side_effect = self._get_user_with_queries
+        self.app.get('/users/test').close()
+        database = self.mock_db.get_database.return_value
+        database.connect.reset_mock()
+
+        resp = self.app.get('/metrics')
+
+        self.assertEqual(200, resp.status_code)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn('userapi_requests_total{method="GET",'
+                      'route="/users/<userid>",status="200"}', resp.data)
+        self.assertIn('userapi_db_queries_per_request_bucket{method="GET",'
+                      'route="/users/<userid>",le="2.0"}', resp.data)
+        self.assertFalse(database.connect.called)
@@ -0,0 +1,206 @@
+import json
+import unittest
+
+import mock
+
+from userapi import cache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+    def setUp(self):
+        self.cache = cache.LRUCache(max_size=2, ttl=10, stale_ttl=5)
+
+    def _fill(self, key, value, now=100):
+        with mock.patch.object(cache.time, 'time', return_value=now):
+            self.cache.fill(key, value, self.cache.reserve(key))
+
+    def _get(self, key, now=100):
+        with mock.patch.object(cache.time, 'time', return_value=now):
+            return self.cache.get(key)
+
+    def test_miss_then_hit(self):
+        self.assertEqual((cache.MISSING, None), self._get('a'))
+        self._fill('a', 1)
+
+        self.assertEqual((cache.FRESH, 1), self._get('a'))
+        stats = self.cache.stats()
+        self.assertEqual(1, stats['hits'])
+        self.assertEqual(1, stats['misses'])
+
+    def test_evicts_least_recently_used(self):
+        self._fill('a', 1)
+        self._fill('b', 2)
+        self._get('a')
+        self._fill('c', 3)
+
+        self.assertEqual((cache.MISSING, None), self._get('b'))
+        self.assertEqual((cache.FRESH, 1), self._get('a'))
+        self.assertEqual(1, self.cache.stats()['evictions'])
+
+    def test_stale_then_expired(self):
+        self._fill('a', 1)
+
+        self.assertEqual((cache.STALE, 1), self._get('a', now=111))
+        self.assertEqual((cache.MISSING, None), self._get('a', now=116))
+        self.assertEqual(1, self.cache.stats()['expirations'])
+
+    def test_invalidate_discards_pending_load(self):
+        token = self.cache.reserve('a')
+        self.cache.invalidate(['a'])
+        self.cache.fill('a', 'before write', token)
+
+        self.assertEqual((cache.MISSING, None), self._get('a'))
+        self.assertFalse(self.cache.loading('a'))
+
+    def test_release(self):
+        token = self.cache.reserve('a')
+        self.assertTrue(self.cache.loading('a'))
+
+        self.cache.release('a', token)
+
+        self.assertFalse(self.cache.loading('a'))
+
+
+class CacheTestCase(unittest.TestCase):
+    def setUp(self):
+        cache.configure(size=10, ttl=10, stale_ttl=10)
+        self.addCleanup(cache.configure, size=0)
+        active_patcher = mock.patch.object(cache, 'active', return_value=True)
+        active_patcher.start()
+        self.addCleanup(active_patcher.stop)
+
+    def test_read_through(self):
+        load = mock.Mock(return_value={'userid': 'a'})
+
+        cache.read_through(cache.USERS, 'a', load)
+        value = cache.read_through(cache.USERS, 'a', load)
+
+        self.assertEqual({'userid': 'a'}, value)
+        self.assertEqual(1, load.call_count)
+
+    def test_read_through_inactive(self):
+        load = mock.Mock(return_value=1)
+
+        with mock.patch.object(cache, 'active', return_value=False):
+            cache.read_through(cache.USERS, 'a', load)
+            cache.read_through(cache.USERS, 'a', load)
+
+        self.assertEqual(2, load.call_count)
+        self.assertEqual(0, cache.CACHES[cache.USERS].stats()['size'])
+
+    def test_read_through_error_not_cached(self):
+        load = mock.Mock(side_effect=ValueError)
+
+        self.assertRaises(ValueError, cache.read_through, cache.USERS, 'a',
+                          load)
+        self.assertFalse(cache.CACHES[cache.USERS].loading('a'))
+
+    def test_read_through_stale_refreshes(self):
+        users = cache.CACHES[cache.USERS]
+        with mock.patch.object(cache.time, 'time', return_value=100):
+            users.fill('a', 'old', users.reserve('a'))
+        load = mock.Mock()
+        refresh_load = mock.Mock(return_value='new')
+
+        with mock.patch.object(cache.threading, 'Thread') as mock_thread:
+            with mock.patch.object(cache.time, 'time', return_value=115):
+                value = cache.read_through(cache.USERS, 'a', load,
+                                           refresh_load)
+            self.assertTrue(users.loading('a'))
+            mock_thread.call_args[1]['target']()
+
+        self.assertEqual('old', value)
+        self.assertFalse(load.called)
+        self.assertEqual((cache.FRESH, 'new'), users.get('a'))
+        self.assertEqual(1, users.stats()['refreshes'])
+
+    def test_failed_refresh_drops_entry(self):
+        users = cache.CACHES[cache.USERS]
+        users.fill('a', 'old', users.reserve('a'))
+
+        with mock.patch.object(cache.threading, 'Thread') as mock_thread:
+            cache.refresh(cache.USERS, 'a', mock.Mock(side_effect=ValueError))
+            mock_thread.call_args[1]['target']()
+
+        self.assertEqual(cache.MISSING, users.get('a')[0])
+        self.assertFalse(users.loading('a'))
+
+    def test_invalidation_payload(self):
+        payload = cache.invalidation_payload(users=['b', 'a', 'a'],
+                                             groups=['admins'])
+
+        self.assertEqual({'users': ['a', 'b'], 'groups': ['admins']},
+                         json.loads(payload))
+
+    def test_invalidation_payload_flushes_many_keys(self):
+        users = ['user%d' % i for i in range(cache.MAX_INVALIDATION_KEYS + 1)]
+
+        payload = cache.invalidation_payload(users=users, groups=['admins'])
+
+        self.assertEqual({'flush': [cache.USERS], 'groups': ['admins']},
+                         json.loads(payload))
+
+    def test_handle_message(self):
+        users = cache.CACHES[cache.USERS]
+        groups = cache.CACHES[cache.GROUPS]
+        for key in ('a', 'b'):
+            users.fill(key, key, users.reserve(key))
+        groups.fill('admins', ['a'], groups.reserve('admins'))
+
+        cache.handle_message(json.dumps({'users': ['a'],
+                                         'flush': [cache.GROUPS]}))
+
+        self.assertEqual(cache.MISSING, users.get('a')[0])
+        self.assertEqual(cache.FRESH, users.get('b')[0])
+        self.assertEqual(cache.MISSING, groups.get('admins')[0])
+
+    def test_handle_unreadable_message_flushes(self):
+        users = cache.CACHES[cache.USERS]
+        users.fill('a', 'a', users.reserve('a'))
+
+        cache.handle_message('not json')
+
+        self.assertEqual(cache.MISSING, users.get('a')[0])
+
+
+class ListenerTestCase(unittest.TestCase):
+    def setUp(self):
+        cache.configure(size=10)
+        self.addCleanup(cache.configure, size=0)
+
+    def test_active_requires_listener_in_this_process(self):
+        listener = mock.Mock(pid=cache.os.getpid(), listening=True)
+        with mock.patch.object(cache, '_listener', listener):
+            self.assertTrue(cache.active())
+            listener.listening = False
+            self.assertFalse(cache.active())
+            listener.listening = True
+            listener.pid = -1
+            self.assertFalse(cache.active())
+
+    def test_start_listener_once_per_process(self):
+        connect = mock.Mock()
+        with mock.patch.object(cache, 'Listener') as mock_listener:
+            mock_listener.return_value.pid = cache.os.getpid()
+            with mock.patch.object(cache, '_listener', None):
+                cache.start_listener(connect)
+                cache.start_listener(connect)
+
+        mock_listener.assert_called_once_with(connect)
+        self.assertEqual(1, mock_listener.return_value.start.call_count)
+
+    def test_listener_applies_notifications(self):
+        users = cache.CACHES[cache.USERS]
+        listener = cache.Listener(mock.Mock())
+        conn = mock.Mock()
+        conn.notifies = [mock.Mock(payload='{"users": ["a"]}')]
+
+        def poll():
+            users.fill('a', 'a', users.reserve('a'))
+            conn.poll.side_effect = StopIteration
+        conn.poll.side_effect = poll
+
+        with mock.patch.object(cache.select, 'select'):
+            self.assertRaises(StopIteration, listener._poll, conn)
+
+        self.assertEqual(cache.MISSING, users.get('a')[0])
@@ -0,0 +1,176 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from userapi import metrics
+
+
+class MetricsTestCase(unittest.TestCase):
+    def setUp(self):
+        metrics_patcher = mock.patch.object(metrics, 'METRICS', [])
+        metrics_patcher.start()
+        self.addCleanup(metrics_patcher.stop)
+        self.addCleanup(metrics.configure)
+        metrics.configure(directory='')
+
+        self.requests = metrics.Counter('requests_total', 'Requests.',
+                                        ('route',))
+        self.in_progress = metrics.Gauge('in_progress', 'In progress.')
+        self.duration = metrics.Histogram('duration_seconds', 'Duration.',
+                                          ('route',), buckets=(0.1, 1))
+
+    def _write_sibling(self, directory, ppid, pid, values):
+        path = os.path.join(directory, '%d-%d.json' % (ppid, pid))
+        with open(path, 'w') as f:
+            json.dump({'pid': pid, 'metrics': values}, f)
+        return path
+
+    def test_collect(self):
+        self.requests.inc(('/a',))
+        self.requests.inc(('/a',), 2)
+        self.in_progress.inc()
+        self.duration.observe(('/a',), 0.05)
+        self.duration.observe(('/a',), 0.5)
+        self.duration.observe(('/a',), 5)
+
+        self.assertEqual(
+            '# HELP requests_total Requests.\n'
+            '# TYPE requests_total counter\n'
+            'requests_total{route="/a"} 3.0\n'
+            '# HELP in_progress In progress.\n'
+            '# TYPE in_progress gauge\n'
+            'in_progress 1.0\n'
+            '# HELP duration_seconds Duration.\n'
+            '# TYPE duration_seconds histogram\n'
+            'duration_seconds_bucket{route="/a",le="0.1"} 1.0\n'
+            'duration_seconds_bucket{route="/a",le="1.0"} 2.0\n'
+            'duration_seconds_bucket{route="/a",le="+Inf"} 3.0\n'
+            'duration_seconds_sum{route="/a"} 5.55\n'
+            'duration_seconds_count{route="/a"} 3.0\n',
+            metrics.collect())
+
+    def test_bucket_bounds_are_inclusive(self):
+        self.duration.observe(('/a',), 0.1)
+
+        self.assertEqual([1, 0, 0, 0.1], self.duration.values[('/a',)])
+
+    def test_label_values_escaped(self):
+        self.requests.inc(('a"b\\c\n',))
+
+        self.assertIn(r'requests_total{route="a\"b\\c\n"} 1.0',
+                      metrics.collect())
+
+    def test_collect_adds_siblings(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics.configure(directory=directory)
+        self.requests.inc(('/a',))
+        self.in_progress.inc()
+        self.duration.observe(('/a',), 0.5)
+
+        sibling = {'requests_total': [[['/a'], 2], [['/b'], 1]],
+                   'in_progress': [[[], 1]],
+                   'duration_seconds': [[['/a'], [1, 0, 0, 0.05]]]}
+        ppid = os.getppid()
+        self._write_sibling(directory, ppid, 1001, sibling)
+        self._write_sibling(directory, ppid, 1002, sibling)
+        other_server = self._write_sibling(directory, 99999, 1003, sibling)
+        metrics.write_snapshot()
+
+        alive = {ppid: True, 1001: True, 1002: False, 99999: False}
+        with mock.patch.object(metrics, '_alive', side_effect=alive.get):
+            text = metrics.collect()
+
+        self.assertIn('requests_total{route="/a"} 5.0\n', text)
+        self.assertIn('requests_total{route="/b"} 2.0\n', text)
+        # The exited worker's requests still count, its gauge does not.
+        self.assertIn('in_progress 2.0\n', text)
+        self.assertIn('duration_seconds_bucket{route="/a",le="0.1"} 2.0\n',
+                      text)
+        self.assertIn('duration_seconds_count{route="/a"} 3.0\n', text)
+        self.assertFalse(os.path.exists(other_server))
+        self.assertFalse(os.path.exists(
+            os.path.join(directory, '%d-1002.json' % ppid)))
+        self.assertTrue(os.path.exists(
+            os.path.join(directory, '%d-0.json' % ppid)))
+
+    def test_totals_kept_across_worker_exits(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics.configure(directory=directory)
+        ppid = os.getppid()
+        alive = {ppid: True}
+
+        def collect():
+            with mock.patch.object(metrics, '_alive', side_effect=alive.get):
+                return metrics.collect()
+
+        for pid in (1001, 1002, 1003):
+            self._write_sibling(directory, ppid, pid, {
+                'requests_total': [[['/a'], 1]],
+                'in_progress': [[[], 1]],
+                'duration_seconds': [[['/a'], [1, 0, 0, 0.05]]]})
+            alive[pid] = True
+        texts = [collect()]
+        for pid in (1001, 1002):
+            alive[pid] = False
+            texts.append(collect())
+            texts.append(collect())
+
+        for text in texts:
+            self.assertIn('requests_total{route="/a"} 3.0\n', text)
+            self.assertIn('duration_seconds_count{route="/a"} 3.0\n', text)
+        self.assertIn('in_progress 1.0\n', texts[-1])
+        self.assertEqual(['%d-0.json' % ppid, '%d-1003.json' % ppid],
+                         sorted(name for name in os.listdir(directory)
+                                if name.endswith('.json')))
+
+    def test_stale_snapshot_counts_without_gauges(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics.configure(directory=directory, flush_interval=1)
+        path = self._write_sibling(directory, os.getppid(), 1001, {
+            'requests_total': [[['/a'], 2]], 'in_progress': [[[], 1]]})
+        stale_at = os.path.getmtime(path) - metrics.STALE_INTERVALS - 1
+        os.utime(path, (stale_at, stale_at))
+
+        with mock.patch.object(metrics, '_alive', return_value=True):
+            text = metrics.collect()
+
+        self.assertIn('requests_total{route="/a"} 2.0\n', text)
+        self.assertIn('in_progress 0.0\n', text)
+        self.assertTrue(os.path.exists(path))
+
+    def test_start_flusher_archives_reused_pid(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        metrics.configure(directory=directory)
+        path = self._write_sibling(directory, os.getppid(), os.getpid(),
+                                   {'requests_total': [[['/a'], 2]]})
+        self.requests.inc(('/a',))
+
+        with mock.patch.object(metrics, '_flusher', None), \
+                mock.patch.object(metrics, 'Flusher'):
+            metrics.start_flusher()
+        text = metrics.collect()
+
+        self.assertFalse(os.path.exists(path))
+        self.assertIn('requests_total{route="/a"} 3.0\n', text)
+
+    def test_last_snapshot_written_on_exit(self):
+        flusher = mock.Mock(pid=os.getpid())
+        with mock.patch.object(metrics, '_flusher', flusher), \
+                mock.patch.object(metrics, 'write_snapshot') as mock_write:
+            metrics._write_last_snapshot()
+
+        mock_write.assert_called_once_with()
+
+    def test_flusher_needs_directory(self):
+        with mock.patch.object(metrics, 'Flusher') as mock_flusher:
+            metrics.start_flusher()
+
+        self.assertFalse(mock_flusher.called)
@@ -0,0 +1,93 @@
+import os
+import pstats
+import shutil
+import tempfile
+import unittest
+
+import flask
+import mock
+
+from userapi import profile_cli
+from userapi import profiling
+
+
+class ProfilingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.addCleanup(profiling.configure)
+        profiling.configure(directory=self.directory, token='secret',
+                            sample_rate=0)
+
+    def _profile(self, view):
+        response = profiling.profile('GET', '/groups/<name>', view)
+        ''.join(response.response)
+        response.close()
+        return response
+
+    def test_should_profile(self):
+        self.assertTrue(profiling.should_profile({'X-Profile': u'secret'}))
+        self.assertFalse(profiling.should_profile({'X-Profile': u'wrong'}))
+        self.assertFalse(profiling.should_profile({}))
+
+    def test_should_profile_sampled(self):
+        profiling.configure(directory=self.directory, token='',
+                            sample_rate=0.5)
+
+        with mock.patch.object(profiling.random, 'random',
+                               side_effect=[0.4, 0.6]):
+            self.assertTrue(profiling.should_profile({}))
+            self.assertFalse(profiling.should_profile({}))
+
+    def test_off_without_directory(self):
+        profiling.configure(directory='', token='secret', sample_rate=1)
+
+        self.assertFalse(profiling.should_profile({'X-Profile': u'secret'}))
+
+    def test_profile_dumped_on_close(self):
+        response = self._profile(lambda: flask.Response('{}'))
+
+        name = response.headers[profiling.FILE_HEADER]
+        self.assertTrue(name.startswith('GET_groups_name.'))
+        self.assertTrue(name.endswith('.%d.prof' % os.getpid()))
+        pstats.Stats(os.path.join(self.directory, name))
+
+    def test_streamed_body_profiled(self):
+        class Body(object):
+            closed = False
+
+            def __iter__(self):
+                for userid in ('a', 'b'):
+                    yield sorted([userid, userid])[0]
+
+            def close(self):
+                self.closed = True
+        body = Body()
+
+        response = self._profile(lambda: flask.Response(body))
+
+        stats = pstats.Stats(os.path.join(
+            self.directory, response.headers[profiling.FILE_HEADER]))
+        self.assertIn('sorted', str(stats.stats.keys()))
+        self.assertTrue(body.closed)
+
+    def test_compare(self):
+        baseline = {('a.py', 1, 'f'): (1.0, 0.1, 0.5),
+                    ('a.py', 2, 'g'): (1.0, 0.1, 0.2)}
+        candidate = {('a.py', 1, 'f'): (1.0, 0.1, 0.6),
+                     ('a.py', 3, 'h'): (2.0, 0.3, 0.3)}
+
+        rows = profile_cli.compare(baseline, candidate, limit=2)
+
+        self.assertEqual([('a.py', 3, 'h'), ('a.py', 2, 'g')],
+                         [func for func, _, _ in rows])
+
+    def test_find_profiles_by_route(self):
+        for name in ('GET_users_userid.1.1.1.prof',
+                     'GET_groups_name.1.1.1.prof', 'notes.txt'):
+            open(os.path.join(self.directory, name), 'w').close()
+
+        files = profile_cli.find_profiles([self.directory], 'GET_groups')
+
+        self.assertEqual([os.path.join(self.directory,
+                                       'GET_groups_name.1.1.1.prof')], files)
@@ -0,0 +1,66 @@
+import json
+import unittest
+
+import mock
+
+from userapi import serialization
+
+
+def _missing():
+    raise ImportError()
+
+
+class SerializationTestCase(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(serialization.configure)
+
+    def test_backends_agree(self):
+        data = {'userid': u'caf\xe9/1', 'groups': ['a', 'b'], 'n': [1, None]}
+        encoded = {}
+        for name in serialization.BACKENDS:
+            try:
+                serialization.configure(name)
+            except ImportError:
+                continue
+            encoded[name] = serialization.dumps(data)
+
+        for name, text in encoded.items():
+            self.assertEqual(data, json.loads(text), name)
+            self.assertNotIn(' ', text, name)
+            self.assertIn('\\u00e9', text, name)
+            self.assertIn('caf\\u00e9/1', text, name)
+
+    def test_auto_skips_missing_backends(self):
+        backends = serialization.collections.OrderedDict([
+            ('fast', _missing), ('json', serialization._stdlib)])
+        with mock.patch.object(serialization, 'BACKENDS', backends):
+            serialization.configure('auto')
+
+        self.assertEqual('json', serialization.BACKEND)
+        self.assertEqual('[1,2]', serialization.dumps([1, 2]))
+
+    def test_configure_from_environment(self):
+        with mock.patch.dict(serialization.os.environ,
+                             {'JSON_ENCODER': 'json'}):
+            serialization.configure()
+
+        self.assertEqual('json', serialization.BACKEND)
+
+    def test_named_backend_must_be_installed(self):
+        backends = {'fast': _missing}
+        with mock.patch.object(serialization, 'BACKENDS', backends):
+            self.assertRaises(ImportError, serialization.configure, 'fast')
+
+    def test_unknown_backend(self):
+        self.assertRaises(ValueError, serialization.configure, 'yaml')
+
+    def test_dumps_is_timed(self):
+        timer = serialization.timing.begin()
+        self.addCleanup(serialization.timing.end)
+
+        with mock.patch.object(serialization.time, 'time',
+                               side_effect=[10.0, 10.5]):
+            serialization.dumps([1, 2])
+
+        self.assertEqual(
+            0.5, timer.durations[serialization.timing.SERIALIZATION])
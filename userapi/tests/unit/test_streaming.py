@@ -0,0 +1,46 @@
+import io
+import unittest
+
+from userapi import exceptions
+from userapi import streaming
+
+
+class StreamingTestCase(unittest.TestCase):
+    def _array(self, data, chunk_size=3):
+        return list(streaming.iter_json_array(io.BytesIO(data),
+                                              chunk_size=chunk_size))
+
+    def test_iter_json_array(self):
+        data = b' [{"userid": "a"}, 123 , "\xc3\xa9", [1, 2]] '
+        self.assertEqual([{'userid': 'a'}, 123, u'\xe9', [1, 2]],
+                         self._array(data))
+
+    def test_iter_json_array_empty(self):
+        self.assertEqual([], self._array(b'[ ]'))
+
+    def test_iter_json_array_number_split_across_chunks(self):
+        self.assertEqual([12345], self._array(b'[12345]', chunk_size=1))
+
+    def test_iter_json_array_not_array(self):
+        self.assertRaises(exceptions.InvalidRequestException,
+                          self._array, b'{"userid": "a"}')
+
+    def test_iter_json_array_truncated(self):
+        self.assertRaises(exceptions.InvalidRequestException,
+                          self._array, b'[{"userid": "a"},')
+
+    def test_iter_json_array_value_too_large(self):
+        stream = io.BytesIO(b'["' + b'a' * 100 + b'"]')
+        self.assertRaises(exceptions.InvalidRequestException, list,
+                          streaming.iter_json_array(stream, chunk_size=10,
+                                                    max_value_size=50))
+
+    def test_iter_ndjson(self):
+        stream = io.BytesIO(b'{"userid": "a"}\n\n{"userid": "b"}')
+        self.assertEqual([{'userid': 'a'}, {'userid': 'b'}],
+                         list(streaming.iter_ndjson(stream)))
+
+    def test_iter_ndjson_invalid_line(self):
+        stream = io.BytesIO(b'{"userid": "a"}\n{"userid"\n')
+        self.assertRaises(exceptions.InvalidRequestException, list,
+                          streaming.iter_ndjson(stream))
@@ -0,0 +1,36 @@
+import unittest
+
+from userapi import timing
+
+
+class TimingTestCase(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(timing.end)
+
+    def test_records_into_current_timer(self):
+        timer = timing.begin()
+
+        timing.record_query(0.5)
+        timing.record_query(0.25)
+        timing.record(timing.SERIALIZATION, 0.125)
+
+        self.assertEqual(2, timer.queries)
+        self.assertEqual(0.75, timer.durations[timing.DB])
+        self.assertEqual(0.125, timer.durations[timing.SERIALIZATION])
+        self.assertIs(timer, timing.end())
+        self.assertIsNone(timing.current())
+
+    def test_nothing_recorded_outside_requests(self):
+        timing.record_query(0.5)
+        timing.record(timing.DB, 0.5)
+
+        self.assertIsNone(timing.current())
+
+    def test_begin_replaces_previous_timer(self):
+        first = timing.begin()
+        timing.record_query(0.5)
+
+        second = timing.begin()
+
+        self.assertIsNot(first, second)
+        self.assertEqual(0, second.queries)
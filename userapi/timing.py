@@ -0,0 +1,62 @@
+"""Per-request accounting of where the time goes.
+
+The API starts a RequestTimer for every request. While it runs, each
+statement sent through the database, each commit and each JSON encoding
+adds to it, from the request's own thread only; background cache refreshes
+are not counted.
+
+Time is measured in seconds with time.time(), so recording costs two clock
+reads per statement or encoding.
+"""
+import threading
+import time
+
+DB = 'db'
+SERIALIZATION = 'serialization'
+
+_local = threading.local()
+
+
+class RequestTimer(object):
+    def __init__(self, route=None):
+        self.route = route
+        self.started_at = time.time()
+        self.queries = 0
+        self.durations = {DB: 0.0, SERIALIZATION: 0.0}
+
+    def add(self, name, elapsed):
+        self.durations[name] = self.durations.get(name, 0.0) + elapsed
+
+    def elapsed(self):
+        return time.time() - self.started_at
+
+
+def begin(route=None):
+    """Starts accounting for the current thread's request, replacing any
+    timer left over from the previous one."""
+    _local.timer = RequestTimer(route)
+    return _local.timer
+
+
+def end():
+    """Stops accounting and returns the finished timer, or None."""
+    timer = getattr(_local, 'timer', None)
+    _local.timer = None
+    return timer
+
+
+def current():
+    return getattr(_local, 'timer', None)
+
+
+def record(name, elapsed):
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.add(name, elapsed)
+
+
+def record_query(elapsed):
+    timer = getattr(_local, 'timer', None)
+    if timer is not None:
+        timer.queries += 1
+        timer.add(DB, elapsed)